@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+后端热点路径基准测试
+
+用法：
+    python benchmark.py            # 运行全部基准
+    python benchmark.py merge      # 只运行指定基准
+    python benchmark.py cow        # 写时复制的峰值内存对比
+    python benchmark.py image_refs # 内联图像与 img:<hash> 引用的请求体积对比
+    python benchmark.py prompt_clean # 提示词清理：逐短语替换与预编译正则对比
+    python benchmark.py i18n       # 翻译查找：嵌套字典逐级查找与展平目录对比
+    python benchmark.py importtime # 冷启动：新进程中 import main 到首个 /health 响应的耗时
+
+冷启动目标：新进程从 import main 到首个 /health 响应不超过 COLD_START_BUDGET_MS，
+且导入时不加载 google.generativeai、numpy、PIL（它们在首次调用模型/处理图像时才导入）。
+超出目标时 importtime 基准以退出码1结束。
+"""
+
+import contextlib
+import copy
+import io
+import json
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+import types
+
+# 导入 main 时会打印加载信息，基准测试中统一屏蔽
+with contextlib.redirect_stdout(io.StringIO()):
+    import main
+
+FAKE_IMAGE = "data:image/png;base64," + "A" * 200_000  # 约200KB的按键背景图
+
+def build_config(button_count: int = 120, with_images: bool = True) -> dict:
+    """构造12×10满布局的测试配置"""
+    buttons = []
+    for i in range(button_count):
+        button = {
+            "id": f"btn_{i}",
+            "label": f"B{i}",
+            "action": {"type": "expression", "expression": f"x*{i + 1}"},
+            "gridPosition": {"row": i // 10 + 1, "column": i % 10},
+            "type": "primary",
+            "textColor": "#FFFFFF",
+        }
+        if with_images:
+            button["backgroundImage"] = FAKE_IMAGE
+        buttons.append(button)
+
+    return {
+        "id": "calc_bench",
+        "name": "基准测试计算器",
+        "description": "120键布局",
+        "theme": {
+            "name": "bench",
+            "backgroundColor": "#000000",
+            "backgroundImage": FAKE_IMAGE if with_images else None,
+            "backgroundGradient": ["#000000", "#111111"],
+        },
+        "appBackground": {
+            "backgroundImageUrl": FAKE_IMAGE if with_images else None,
+            "backgroundType": "image",
+            "buttonOpacity": 0.8,
+        },
+        "layout": {"name": "bench", "rows": 12, "columns": 10, "buttons": buttons},
+    }
+
+def timeit(func, repeat: int = 50) -> float:
+    """返回单次调用的平均耗时（毫秒）"""
+    func()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat * 1000
+
+def bench_merge():
+    """配置合并引擎：120键配置上的三种合并方案"""
+    current = build_config()
+    generated = build_config(with_images=False)
+    for button in generated["layout"]["buttons"]:
+        button["textColor"] = "#FF0000"
+    protection = main.ProtectionPolicy(
+        ["theme.backgroundImage", "appBackground.backgroundImageUrl"]
+        + [f"button.btn_{i}.backgroundImage" for i in range(120)]
+    )
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        results = {
+            "inherit": timeit(lambda: main.merge_config(current, generated, main.MERGE_PROFILES["inherit"])),
+            "protect": timeit(lambda: main.merge_config(current, generated, main.MERGE_PROFILES["protect"], protection)),
+            "background": timeit(lambda: main.merge_config(current, generated, main.MERGE_PROFILES["background"])),
+            "deepcopy (参考)": timeit(lambda: copy.deepcopy(current)),
+        }
+
+    print("🔧 配置合并 (120键)")
+    for name, ms in results.items():
+        print(f"  {name:<16} {ms:8.3f} ms")
+
+def peak_memory(func) -> float:
+    """返回单次调用期间的峰值内存增量（MB）"""
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    baseline = tracemalloc.get_traced_memory()[0]
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return (peak - baseline) / 1024 / 1024
+
+def bench_cow():
+    """写时复制：带图像的120键配置经过受保护字段清理和按键清理的峰值内存"""
+    config = build_config()
+    protected = ["theme.backgroundImage", "button.btn_0.backgroundImage", "button.btn_1.textColor"]
+
+    def legacy():
+        # 旧流程：整体深拷贝 + JSON往返，JSON往返会复制全部base64字符串
+        cleaned = json.loads(json.dumps(copy.deepcopy(config)))
+        return main.clean_invalid_buttons(cleaned)
+
+    def cow():
+        cleaned = main.remove_protected_fields_from_ai_output(config, protected)
+        return main.clean_invalid_buttons(cleaned)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        results = {
+            "legacy copy": (peak_memory(legacy), timeit(legacy, repeat=10)),
+            "copy-on-write": (peak_memory(cow), timeit(cow, repeat=10)),
+        }
+
+    print("🔧 写时复制 (120键，每键约200KB图像)")
+    for name, (mb, ms) in results.items():
+        print(f"  {name:<16} 峰值 {mb:8.2f} MB  {ms:8.3f} ms")
+
+def bench_image_refs():
+    """图像引用：带图像配置内联base64与 img:<hash> 引用的JSON体积和解析耗时"""
+    inline = build_config()
+    refs = main.externalize_images(inline)
+    results = {}
+    for name, config in (("inline base64", inline), ("img:<hash>", refs)):
+        body = json.dumps({"user_input": "加一个sin按键", "current_config": config}, ensure_ascii=False)
+        results[name] = (len(body.encode("utf-8")) / 1024, timeit(lambda: json.loads(body), repeat=20))
+
+    print("🔧 图像引用 (120键 customize 请求体)")
+    for name, (kb, ms) in results.items():
+        print(f"  {name:<16} {kb:10.1f} KB  解析 {ms:8.3f} ms")
+
+def legacy_clean_user_prompt(prompt: str) -> str:
+    """旧实现（对照）：每个短语各做一次正则替换和字符串替换"""
+    cleaned = prompt.strip()
+    for phrase in main.PROMPT_DESCRIPTIVE_PHRASES:
+        cleaned = main.re.sub(f"[，。、]*{main.re.escape(phrase)}[^，。]*", "", cleaned, flags=main.re.IGNORECASE)
+        cleaned = cleaned.replace(phrase, "")
+    cleaned = main.re.sub(r'[，。、；：！？\s]+', ' ', cleaned)
+    cleaned = main.re.sub(r'^[，。、；：！？\s]+|[，。、；：！？\s]+$', '', cleaned)
+    return main.re.sub(r'\s+', ' ', cleaned).strip()
+
+def bench_prompt_clean():
+    """提示词清理：generate-text-image 的典型输入"""
+    prompts = [
+        "为文字生成光影效果的图片，霓虹灯风格，蓝紫色调",
+        "橘猫在月光下，水彩质感",
+        "金属质感、火焰特效，数字图片，不能有其他字出现",
+        "赛博朋克城市夜景，透明背景",
+    ] * 25
+    for prompt in prompts:
+        assert legacy_clean_user_prompt(prompt) == main.clean_user_prompt(prompt)
+
+    results = {
+        "legacy per-phrase": timeit(lambda: [legacy_clean_user_prompt(p) for p in prompts], repeat=20),
+        "compiled": timeit(lambda: [main.clean_user_prompt(p) for p in prompts], repeat=20),
+    }
+
+    print(f"🔧 提示词清理 ({len(prompts)} 条)")
+    for name, ms in results.items():
+        print(f"  {name:<18} {ms:8.3f} ms")
+
+def bench_i18n():
+    """翻译查找：每次响应一次 t() 调用，带参数替换"""
+    nested = {}
+    for fname in os.listdir(main.I18N_DIR):
+        if fname.endswith('.json'):
+            with open(os.path.join(main.I18N_DIR, fname), encoding='utf-8') as f:
+                nested[fname.split('.')[0]] = json.load(f)
+
+    def legacy_t(request, key_path, **kwargs):
+        # 旧实现（对照）：每次解析请求头、切分key并逐级查找
+        accept = request.headers.get('accept-language', 'en')
+        lang = accept.split(',')[0].split('-')[0]
+        value = nested.get(lang if lang in nested else 'en')
+        for key in key_path.split('.'):
+            if isinstance(value, dict) and key in value:
+                value = value[key]
+            else:
+                return key_path
+        for k, v in kwargs.items():
+            value = value.replace(f"{{{k}}}", str(v))
+        return value
+
+    requests = [
+        types.SimpleNamespace(headers={"accept-language": header})
+        for header in ("zh-CN,zh;q=0.9,en;q=0.8", "en-US,en;q=0.9", "ja", "de-DE,de;q=0.8")
+    ] * 250
+    key = "api.error.task_creation_failed"
+    results = {
+        "legacy nested": timeit(lambda: [legacy_t(r, key, error="boom") for r in requests], repeat=20),
+        "flattened": timeit(lambda: [main.t(r, key, error="boom") for r in requests], repeat=20),
+    }
+
+    print(f"🔧 翻译查找 ({len(requests)} 次)")
+    for name, ms in results.items():
+        print(f"  {name:<18} {ms:8.3f} ms")
+
+COLD_START_BUDGET_MS = 600
+LAZY_MODULES = ("google.generativeai", "numpy", "PIL")
+
+# 在新进程中测量：import main，再直接调用ASGI应用得到首个 /health 响应
+HEALTH_PROBE = """
+import asyncio, contextlib, io, json, sys, time
+start = time.perf_counter()
+with contextlib.redirect_stdout(io.StringIO()):
+    import main
+imported = time.perf_counter()
+
+async def first_health():
+    messages = []
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+    async def send(message):
+        messages.append(message)
+    scope = {"type": "http", "http_version": "1.1", "method": "GET", "scheme": "http", "path": "/health",
+             "raw_path": b"/health", "root_path": "", "query_string": b"", "headers": [],
+             "client": ("127.0.0.1", 0), "server": ("127.0.0.1", 80)}
+    await main.app(scope, receive, send)
+    return messages[0]["status"]
+
+status = asyncio.run(first_health())
+print(json.dumps({
+    "import_ms": (imported - start) * 1000,
+    "health_ms": (time.perf_counter() - start) * 1000,
+    "status": status,
+    "loaded": [name for name in %r if name in sys.modules],
+}))
+""" % (LAZY_MODULES,)
+
+def bench_importtime():
+    """冷启动：-X importtime 下最重的直接依赖，以及到首个 /health 响应的耗时"""
+    backend_dir = os.path.dirname(os.path.abspath(__file__))
+    profile = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import main"],
+        cwd=backend_dir, capture_output=True, text=True,
+    )
+    imports = []
+    for line in profile.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        # 只看 main 的直接依赖（缩进两格）
+        if name.startswith("   ") and not name.startswith("    "):
+            imports.append((int(cumulative) / 1000, name.strip()))
+
+    runs = []
+    for _ in range(3):
+        probe = subprocess.run([sys.executable, "-c", HEALTH_PROBE], cwd=backend_dir, capture_output=True, text=True)
+        runs.append(json.loads(probe.stdout.strip().splitlines()[-1]))
+    best = min(runs, key=lambda run: run["health_ms"])
+
+    print("🔧 冷启动 (import main 的直接依赖，-X importtime)")
+    for ms, name in sorted(imports, reverse=True)[:8]:
+        print(f"  {name:<28} {ms:8.1f} ms")
+    print(f"  {'import main':<28} {best['import_ms']:8.1f} ms")
+    print(f"  {'first /health (%d)' % best['status']:<28} {best['health_ms']:8.1f} ms  目标 {COLD_START_BUDGET_MS} ms")
+    if best["loaded"]:
+        print(f"  ❌ 导入时加载了应延迟导入的模块: {', '.join(best['loaded'])}")
+    if best["health_ms"] > COLD_START_BUDGET_MS or best["loaded"]:
+        sys.exit(1)
+
+BENCHMARKS = {
+    "merge": bench_merge,
+    "cow": bench_cow,
+    "image_refs": bench_image_refs,
+    "prompt_clean": bench_prompt_clean,
+    "i18n": bench_i18n,
+    "importtime": bench_importtime,
+}
+
+def main_cli():
+    selected = sys.argv[1:] or list(BENCHMARKS)
+    for name in selected:
+        if name not in BENCHMARKS:
+            print(f"❌ 未知基准: {name}，可选: {', '.join(BENCHMARKS)}")
+            sys.exit(1)
+        BENCHMARKS[name]()
+
+if __name__ == "__main__":
+    main_cli()
@@ -1,8 +1,12 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import argparse
 import json
 import os
+import pickle
+import sys
+from concurrent.futures import ThreadPoolExecutor
 
 # 全球前30种语言列表
 LANGUAGES = {
@@ -62,8 +66,8 @@ def create_placeholder_translation(template, lang_code):
     
     return translate_value(template)
 
-def main():
-    """生成所有语言的本地化文件"""
+def generate_all():
+    """全量重新生成所有语言的本地化文件（会覆盖已有翻译）"""
     print("🌍 开始生成多语言文件...")
     
     # 加载英文模板
@@ -97,5 +101,130 @@ def main():
     print("📁 文件保存在 backend/i18n/ 目录中")
     print("💡 请手动翻译这些文件中的占位符文本")
 
+def merge_translation(template, existing, lang_code, changes, path=""):
+    """
+    按英文模板合并已有翻译：补齐缺失的键，删除模板中已不存在的键，保留已翻译的文本
+    英文改动后，仍是占位符的文本会按新英文更新；changes 记录 added / updated / removed 的键
+    """
+    prefix = f"[{lang_code.upper()}] "
+    existing = existing if isinstance(existing, dict) else {}
+    result = {}
+    for key, value in template.items():
+        key_path = f"{path}.{key}" if path else key
+        current = existing.get(key)
+        if isinstance(value, dict):
+            if key in existing and not isinstance(current, dict):
+                changes["removed"].append(key_path)
+            result[key] = merge_translation(value, current, lang_code, changes, key_path)
+        elif isinstance(value, str):
+            placeholder = f"{prefix}{value}"
+            if not isinstance(current, str):
+                changes["added"].append(key_path)
+                result[key] = placeholder
+            elif current.startswith(prefix) and current != placeholder:
+                changes["updated"].append(key_path)
+                result[key] = placeholder
+            else:
+                result[key] = current
+        else:
+            result[key] = current if key in existing else value
+    
+    for key in existing:
+        if key not in template:
+            changes["removed"].append(f"{path}.{key}" if path else key)
+    return result
+
+def sync_locale(template, lang_code, check=False):
+    """增量同步单个语言文件，只有内容变化时才写回；返回 (文件名, 改动)"""
+    filename = f'i18n/{lang_code}.json'
+    raw = ""
+    existing = {}
+    if os.path.exists(filename):
+        with open(filename, 'r', encoding='utf-8') as f:
+            raw = f.read()
+        existing = json.loads(raw)
+    
+    changes = {"added": [], "updated": [], "removed": []}
+    translation = merge_translation(template, existing, lang_code, changes)
+    if not os.path.exists(filename) or translation != existing or list(translation) != list(existing):
+        if not check:
+            # 保留文件末尾原有的空白，未改动的键在diff中保持不变
+            tail = raw[len(raw.rstrip()):]
+            with open(filename, 'w', encoding='utf-8') as f:
+                f.write(json.dumps(translation, ensure_ascii=False, indent=2) + tail)
+        return filename, changes
+    return filename, None
+
+def sync_all(check=False):
+    """并行增量同步所有语言文件，打印改动报告；返回有改动的文件数"""
+    template = load_template()
+    os.makedirs('i18n', exist_ok=True)
+    locales = [lang_code for lang_code in LANGUAGES if lang_code != 'en']
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        results = list(pool.map(lambda lang_code: sync_locale(template, lang_code, check), locales))
+    
+    changed = [(filename, changes) for filename, changes in results if changes is not None]
+    for filename, changes in changed:
+        summary = ", ".join(f"{kind} {len(keys)}" for kind, keys in changes.items() if keys)
+        print(f"📝 {filename}: {summary or '格式调整'}")
+        for kind, keys in changes.items():
+            for key in keys:
+                print(f"    {kind}: {key}")
+    
+    verb = "需要更新" if check else "已更新"
+    print(f"✅ {verb} {len(changed)}/{len(locales)} 个语言文件")
+    return len(changed)
+
+# 与 main.py 中的 I18N_SNAPSHOT_PATH / I18N_SNAPSHOT_VERSION 保持一致
+SNAPSHOT_PATH = 'i18n/catalog.pickle'
+SNAPSHOT_VERSION = 1
+
+def flatten_texts(value, prefix="", texts=None):
+    """把嵌套的翻译字典展平为 {"a.b.c": 文本}"""
+    texts = {} if texts is None else texts
+    for key, item in value.items():
+        dotted_key = f"{prefix}{key}"
+        if isinstance(item, dict):
+            flatten_texts(item, f"{dotted_key}.", texts)
+        elif isinstance(item, str):
+            texts[dotted_key] = item
+    return texts
+
+def write_snapshot():
+    """把所有语言文件展平后写成一个快照，服务启动和首次加载语言时不再解析JSON"""
+    catalogs = {}
+    sources = {}
+    for fname in sorted(os.listdir('i18n')):
+        if not fname.endswith('.json'):
+            continue
+        lang = fname.split('.')[0]
+        path = os.path.join('i18n', fname)
+        with open(path, 'r', encoding='utf-8') as f:
+            # 每种语言单独序列化，服务端只反序列化实际用到的语言
+            catalogs[lang] = pickle.dumps(flatten_texts(json.load(f)), protocol=pickle.HIGHEST_PROTOCOL)
+        stat = os.stat(path)
+        sources[lang] = [stat.st_mtime_ns, stat.st_size]
+    
+    temp_path = f"{SNAPSHOT_PATH}.tmp"
+    with open(temp_path, 'wb') as f:
+        pickle.dump({"version": SNAPSHOT_VERSION, "sources": sources, "catalogs": catalogs}, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_path, SNAPSHOT_PATH)
+    print(f"📦 已写入多语言快照: {SNAPSHOT_PATH}（{len(catalogs)} 种语言）")
+
+def main():
+    parser = argparse.ArgumentParser(description="按 en.json 同步多语言文件")
+    parser.add_argument("--full", action="store_true", help="全量重新生成占位翻译（会覆盖已有翻译，跳过中文）")
+    parser.add_argument("--check", action="store_true", help="只报告需要更新的文件，不写入；有改动时退出码为1")
+    parser.add_argument("--snapshot", action="store_true", help="只生成构建时使用的多语言快照，不改动语言文件")
+    args = parser.parse_args()
+    if args.snapshot:
+        write_snapshot()
+    elif args.full:
+        generate_all()
+    else:
+        changed = sync_all(check=args.check)
+        if args.check and changed:
+            sys.exit(1)
+
 if __name__ == "__main__":
     main() 
\ No newline at end of file
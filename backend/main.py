@@ -1,24 +1,130 @@
-from fastapi import FastAPI, HTTPException, BackgroundTasks, Request
+from fastapi import FastAPI, HTTPException, BackgroundTasks, Request, Response, Query, Header
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel, Field
-from typing import List, Optional, Dict, Any
-import google.generativeai as genai
+from typing import List, Optional, Dict, Any, NamedTuple, Annotated
 import json
 import os
 from datetime import datetime
 import time
 import re
+import sys
+import pickle
 import copy
 import uuid
+import hashlib
+import hmac
 import threading
+import asyncio
+import contextvars
+import bisect
+import logging
+import logging.handlers
+import queue
+import atexit
+from collections import OrderedDict
 from enum import Enum
-# 添加图像生成相关导入
-import requests
+import ast
+import math
+from functools import lru_cache
+from contextlib import contextmanager
 import base64
 from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+# google.generativeai（约0.7秒）、numpy、PIL 在首次用到时才导入，冷启动时 /health 不用等它们
 
 app = FastAPI(title="Queee Calculator AI Backend (Async)", version="3.0.0")
 
+# 🔧 新增：结构化日志 - 请求/工作线程只把日志记录放进队列，由后台线程统一输出，记录自动带上请求ID和任务ID
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")  # text | json
+_log_context = contextvars.ContextVar("log_context", default={})
+
+logger = logging.getLogger("queee")
+
+@contextmanager
+def log_context(**fields):
+    """在当前上下文中附加日志字段（request_id / task_id），退出时恢复"""
+    token = _log_context.set({**_log_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _log_context.reset(token)
+
+class LogContextFilter(logging.Filter):
+    """在产生日志的线程里读取上下文字段，放进队列前写到记录上"""
+
+    def filter(self, record):
+        context = _log_context.get()
+        record.request_id = context.get("request_id", "-")
+        record.task_id = context.get("task_id", "-")
+        return True
+
+class JsonLogFormatter(logging.Formatter):
+    """每条日志一行JSON，便于日志平台按字段检索"""
+
+    def format(self, record):
+        entry = {
+            "ts": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for field in ("request_id", "task_id"):
+            value = getattr(record, field, "-")
+            if value != "-":
+                entry[field] = value
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+def setup_logging():
+    """queee 日志经 QueueHandler 入队，QueueListener 在后台线程写stdout，不阻塞请求"""
+    output = logging.StreamHandler(sys.stdout)
+    if LOG_FORMAT == "json":
+        output.setFormatter(JsonLogFormatter())
+    else:
+        output.setFormatter(logging.Formatter(
+            "%(asctime)s %(levelname)s [req=%(request_id)s task=%(task_id)s] %(message)s"
+        ))
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(LogContextFilter())
+    logger.handlers = [queue_handler]
+    logger.setLevel(LOG_LEVEL)
+    logger.propagate = False
+    listener = logging.handlers.QueueListener(log_queue, output)
+    listener.start()
+    atexit.register(listener.stop)
+
+setup_logging()
+
+REQUEST_ID_PATTERN = re.compile(r"^[\w.:-]{1,64}$")
+
+class RequestContextMiddleware:
+    """纯ASGI中间件：沿用客户端的 X-Request-ID（格式合法时）或生成新ID，写入日志上下文和响应头"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        incoming = dict(scope.get("headers", [])).get(b"x-request-id", b"").decode("latin-1")
+        request_id = incoming if REQUEST_ID_PATTERN.match(incoming) else uuid.uuid4().hex[:16]
+
+        async def send_with_request_id(message):
+            if message["type"] == "http.response.start":
+                message = {**message, "headers": [*message.get("headers", []), (b"x-request-id", request_id.encode("latin-1"))]}
+            await send(message)
+
+        with log_context(request_id=request_id):
+            await self.app(scope, receive, send_with_request_id)
+
+app.add_middleware(RequestContextMiddleware)
+
 # 配置CORS
 app.add_middleware(
     CORSMiddleware,
@@ -28,47 +134,426 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# 多语言支持
-I18N = {}
+# 🔧 新增：请求级阶段计时 - 具名span累计各阶段耗时，同步接口写入Server-Timing响应头，后台任务附在结果的timing里
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+
+class Trace:
+    """一次请求或任务的阶段耗时（毫秒），同名span多次出现时累加（批量任务的工作线程会并发累加）"""
+    __slots__ = ("started", "spans", "_lock")
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.spans = {}
+        self._lock = threading.Lock()
+
+    def add(self, name: str, ms: float):
+        with self._lock:
+            self.spans[name] = round(self.spans.get(name, 0.0) + ms, 2)
+
+    def total_ms(self) -> float:
+        return round((time.perf_counter() - self.started) * 1000, 2)
+
+    def breakdown(self) -> Dict[str, Any]:
+        return {"spans": dict(self.spans), "total_ms": self.total_ms()}
+
+    def server_timing(self) -> str:
+        entries = [f"{name};dur={ms}" for name, ms in self.spans.items()]
+        entries.append(f"total;dur={self.total_ms()}")
+        return ", ".join(entries)
+
+def current_trace() -> Optional[Trace]:
+    return _current_trace.get()
+
+@contextmanager
+def start_trace():
+    """为当前上下文开启新的Trace，退出时恢复外层Trace"""
+    trace = Trace()
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+
+@contextmanager
+def span(name: str):
+    """把代码块耗时记到当前Trace的name下，没有Trace时不记录"""
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(name, (time.perf_counter() - start) * 1000)
+
+def add_span(name: str, started: float):
+    """把从 started（time.perf_counter()）到现在的耗时记到当前Trace，用于不便包成with块的长段代码"""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add(name, (time.perf_counter() - started) * 1000)
+
+class ServerTimingMiddleware:
+    """纯ASGI中间件：每个HTTP请求开启一个Trace，在响应头发出时附上 Server-Timing"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        with start_trace() as trace:
+            async def send_with_timing(message):
+                if message["type"] == "http.response.start":
+                    headers = list(message.get("headers", []))
+                    headers.append((b"server-timing", trace.server_timing().encode("latin-1")))
+                    headers.append((b"timing-allow-origin", b"*"))
+                    message = {**message, "headers": headers}
+                await send(message)
+
+            await self.app(scope, receive, send_with_timing)
+
+app.add_middleware(ServerTimingMiddleware)
+
+# 🔧 新增：Prometheus指标 - 进程内累计计数器/直方图，/metrics 按文本格式0.0.4输出，不依赖prometheus_client
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [
+        '{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'))
+        for name, value in zip(names, values)
+    ]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+    """一个指标族，按标签值元组分别累计；所有更新都在一把锁内完成"""
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        metrics_registry.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels.get(name, "") for name in self.labels)
+
+    def samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in sorted(items):
+            yield self.name, _format_labels(self.labels, key), value
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(f"{name}{labels} {_format_value(value)}" for name, labels, value in self.samples())
+        return "\n".join(lines)
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def set_total(self, value: float, **labels):
+        """镜像外部已累计的值（如 lru_cache 的命中统计），只在采集时调用"""
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+class Histogram(Metric):
+    """累计直方图：每组标签保存 [各桶计数..., sum, count]，观测时二分定位桶"""
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [0] * (len(self.buckets) + 3)
+            state[index] += 1  # index == len(buckets) 即 +Inf 桶
+            state[-2] += value
+            state[-1] += 1
+
+    def samples(self):
+        with self._lock:
+            items = [(key, list(state)) for key, state in self._values.items()]
+        bounds = self.buckets + (math.inf,)
+        for key, state in sorted(items):
+            cumulative = 0
+            for bound, count in zip(bounds, state):
+                cumulative += count
+                yield f"{self.name}_bucket", _format_labels(self.labels, key, f'le="{_format_value(float(bound))}"'), cumulative
+            yield f"{self.name}_sum", _format_labels(self.labels, key), state[-2]
+            yield f"{self.name}_count", _format_labels(self.labels, key), state[-1]
+
+metrics_registry = []  # 按注册顺序输出
+metrics_collectors = []  # 采集前调用，把外部统计同步到指标里
+
+HTTP_REQUESTS = Counter("queee_http_requests_total", "HTTP requests by route and status", ("method", "route", "status"))
+HTTP_REQUEST_DURATION = Histogram("queee_http_request_duration_seconds", "HTTP request latency", ("method", "route"))
+HTTP_REQUEST_SIZE = Histogram("queee_http_request_size_bytes", "HTTP request body size", ("route",), SIZE_BUCKETS)
+HTTP_RESPONSE_SIZE = Histogram("queee_http_response_size_bytes", "HTTP response body size", ("route",), SIZE_BUCKETS)
+HTTP_IN_FLIGHT = Gauge("queee_http_requests_in_flight", "HTTP requests currently being served")
+TASKS_QUEUED = Gauge("queee_tasks_queued", "Tasks submitted but not yet started", ("type",))
+TASKS_RUNNING = Gauge("queee_tasks_running", "Tasks currently being processed", ("type",))
+TASK_WAIT = Histogram("queee_task_wait_seconds", "Time from task submission to start", ("type",))
+TASK_RUN = Histogram("queee_task_run_seconds", "Task processing time", ("type", "status"))
+GEMINI_CALLS = Counter("queee_gemini_requests_total", "Gemini generate_content calls", ("model", "outcome"))
+GEMINI_DURATION = Histogram("queee_gemini_request_duration_seconds", "Gemini generate_content latency", ("model",))
+CACHE_REQUESTS = Counter("queee_cache_requests_total", "Cache lookups by cache and result", ("cache", "result"))
+IMAGE_BYTES = Counter("queee_image_bytes_produced_total", "Image bytes produced", ("source",))
+
+def record_cache(cache: str, hit: bool):
+    CACHE_REQUESTS.inc(cache=cache, result="hit" if hit else "miss")
+
+def render_metrics() -> str:
+    for collect in metrics_collectors:
+        try:
+            collect()
+        except Exception as e:
+            logger.warning(f"⚠️ 指标采集失败: {e}")
+    return "\n".join(metric.render() for metric in metrics_registry) + "\n"
+
+class MetricsMiddleware:
+    """纯ASGI中间件：按路由模板（而非原始路径）记录请求数、耗时和请求/响应体大小"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status = 500
+        request_bytes = 0
+        response_bytes = 0
+
+        async def counting_receive():
+            nonlocal request_bytes
+            message = await receive()
+            if message["type"] == "http.request":
+                request_bytes += len(message.get("body", b""))
+            return message
+
+        async def counting_send(message):
+            nonlocal status, response_bytes
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                response_bytes += len(message.get("body", b""))
+            await send(message)
+
+        HTTP_IN_FLIGHT.inc()
+        try:
+            await self.app(scope, counting_receive, counting_send)
+        finally:
+            HTTP_IN_FLIGHT.dec()
+            route = scope.get("route")
+            route_path = getattr(route, "path", None) or "unmatched"
+            method = scope.get("method", "")
+            HTTP_REQUESTS.inc(method=method, route=route_path, status=str(status))
+            HTTP_REQUEST_DURATION.observe(time.perf_counter() - started, method=method, route=route_path)
+            HTTP_REQUEST_SIZE.observe(request_bytes, route=route_path)
+            HTTP_RESPONSE_SIZE.observe(response_bytes, route=route_path)
+
+app.add_middleware(MetricsMiddleware)
+
+class MeteredModel:
+    """模型客户端的包装：generate_content 记录调用次数、耗时和失败，其余属性透传"""
+
+    def __init__(self, client, model_name: str):
+        self._client = client
+        self.model_name = model_name
+
+    def generate_content(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            response = self._client.generate_content(*args, **kwargs)
+        except Exception:
+            GEMINI_CALLS.inc(model=self.model_name, outcome="error")
+            raise
+        finally:
+            GEMINI_DURATION.observe(time.perf_counter() - started, model=self.model_name)
+        GEMINI_CALLS.inc(model=self.model_name, outcome="ok")
+        return response
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+# 多语言支持 - 启动时只加载英文，其他语言首次用到时再加载
+I18N = {}  # 已加载的语言 -> {"a.b.c": CompiledTemplate}，已按键合并英文兜底
+I18N_SOURCES = {}  # 可用语言 -> JSON文件路径
 I18N_DIR = os.path.join(os.path.dirname(__file__), 'i18n')
+I18N_DEFAULT_LANGUAGE = 'en'
+# 构建时由 generate_i18n.py --snapshot 生成，包含全部语言展平后的文本
+I18N_SNAPSHOT_PATH = os.path.join(I18N_DIR, 'catalog.pickle')
+I18N_SNAPSHOT_VERSION = 1
+_i18n_snapshot = None  # 有效快照中的 {语言: 单独pickle的 {"a.b.c": 文本}}，用到时才反序列化
+_i18n_lock = threading.Lock()
+I18N_PLACEHOLDER_PATTERN = re.compile(r"\{(\w+)\}")
+
+class _KeepMissingParams(dict):
+    """未传入的参数保留原样的 {name} 占位符"""
+    def __missing__(self, key):
+        return f"{{{key}}}"
+
+class CompiledTemplate:
+    """预编译的翻译文本：{name} 以外的花括号转义后存为格式串，渲染时一次 format_map"""
+    __slots__ = ("text", "_format")
+
+    def __init__(self, text: str):
+        self.text = text
+        self._format = None
+        if "{" in text:
+            # 切分结果偶数下标为字面文本，奇数下标为参数名
+            parts = I18N_PLACEHOLDER_PATTERN.split(text)
+            self._format = "".join(
+                part.replace("{", "{{").replace("}", "}}") if i % 2 == 0 else f"{{{part}}}"
+                for i, part in enumerate(parts)
+            )
+
+    def render(self, params: Dict[str, Any]) -> str:
+        if self._format is None or not params:
+            return self.text
+        return self._format.format_map(_KeepMissingParams(params))
+
+def flatten_i18n(value: dict, prefix: str = "", texts: Optional[dict] = None) -> dict:
+    """把嵌套的翻译字典展平为 {"a.b.c": 文本}，只保留字符串叶子"""
+    texts = {} if texts is None else texts
+    for key, item in value.items():
+        dotted_key = f"{prefix}{key}"
+        if isinstance(item, dict):
+            flatten_i18n(item, f"{dotted_key}.", texts)
+        elif isinstance(item, str):
+            texts[dotted_key] = item
+    return texts
+
+def i18n_source_stats(sources: Dict[str, str]) -> Dict[str, list]:
+    """各语言文件的 [mtime_ns, 字节数]，用于判断快照是否过期"""
+    stats = {}
+    for lang, path in sources.items():
+        stat = os.stat(path)
+        stats[lang] = [stat.st_mtime_ns, stat.st_size]
+    return stats
+
+def read_i18n_snapshot(sources: Dict[str, str]) -> Optional[dict]:
+    """读取构建时生成的快照；不存在、版本不符或任一语言文件有改动时返回None"""
+    try:
+        with open(I18N_SNAPSHOT_PATH, 'rb') as f:
+            snapshot = pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        return None
+    if not isinstance(snapshot, dict) or snapshot.get("version") != I18N_SNAPSHOT_VERSION:
+        return None
+    if snapshot.get("sources") != i18n_source_stats(sources):
+        logger.warning("⚠️ 多语言快照已过期，改为读取JSON文件")
+        return None
+    return snapshot["catalogs"]
+
+def get_i18n_catalog(lang: str) -> dict:
+    """返回语言的编译后目录，首次使用时从快照或JSON文件加载"""
+    catalog = I18N.get(lang)
+    if catalog is not None:
+        return catalog
+    with _i18n_lock:
+        catalog = I18N.get(lang)
+        if catalog is not None:
+            return catalog
+        try:
+            if _i18n_snapshot is not None:
+                texts = pickle.loads(_i18n_snapshot[lang]) if lang in _i18n_snapshot else {}
+            else:
+                with open(I18N_SOURCES[lang], encoding='utf-8') as f:
+                    texts = flatten_i18n(json.load(f))
+        except (OSError, KeyError, ValueError, pickle.UnpicklingError) as e:
+            logger.warning(f"⚠️ 加载语言 {lang} 失败，使用英文: {e}")
+            texts = {}
+        catalog = {sys.intern(key): CompiledTemplate(text) for key, text in texts.items()}
+        if lang != I18N_DEFAULT_LANGUAGE:
+            catalog = {**I18N.get(I18N_DEFAULT_LANGUAGE, {}), **catalog}
+        I18N[lang] = catalog
+        return catalog
 
 def load_i18n():
-    """加载多语言文件"""
-    global I18N
-    for fname in os.listdir(I18N_DIR):
-        if fname.endswith('.json'):
-            lang = fname.split('.')[0]
-            with open(os.path.join(I18N_DIR, fname), encoding='utf-8') as f:
-                I18N[lang] = json.load(f)
-    print(f"✅ 已加载 {len(I18N)} 种语言")
+    """扫描可用语言并预加载英文；其他语言在首次请求时加载"""
+    global I18N, I18N_SOURCES, _i18n_snapshot
+    I18N_SOURCES = {
+        fname.split('.')[0]: os.path.join(I18N_DIR, fname)
+        for fname in os.listdir(I18N_DIR) if fname.endswith('.json')
+    }
+    _i18n_snapshot = read_i18n_snapshot(I18N_SOURCES)
+    I18N = {}
+    negotiate_language.cache_clear()
+    get_i18n_catalog(I18N_DEFAULT_LANGUAGE)
+    logger.info(f"✅ 已发现 {len(I18N_SOURCES)} 种语言，已预加载英文{'（快照）' if _i18n_snapshot is not None else ''}")
+
+@lru_cache(maxsize=256)
+def negotiate_language(accept_language: str) -> str:
+    """按 q 值从 Accept-Language 中选出第一个有翻译的语言，结果按请求头原文缓存"""
+    candidates = []
+    for position, item in enumerate(accept_language.split(',')):
+        tag, _, params = item.strip().partition(';')
+        quality = 1.0
+        match = re.search(r"q\s*=\s*([0-9.]+)", params)
+        if match:
+            try:
+                quality = float(match.group(1))
+            except ValueError:
+                continue
+        lang = tag.strip().split('-')[0].lower()
+        if lang and lang != '*' and quality > 0:
+            candidates.append((-quality, position, lang))
+    for _, _, lang in sorted(candidates):
+        if lang in I18N_SOURCES:
+            return lang
+    return I18N_DEFAULT_LANGUAGE
 
 def get_locale(request: Request) -> str:
     """获取语言设置"""
-    accept = request.headers.get('accept-language', 'en')
-    lang = accept.split(',')[0].split('-')[0]
-    return lang if lang in I18N else 'en'
+    return negotiate_language(request.headers.get('accept-language', I18N_DEFAULT_LANGUAGE))
 
 def t(request: Request, key_path: str, **kwargs) -> str:
-    """获取翻译文本"""
-    lang = get_locale(request)
-    keys = key_path.split('.')
-    value = I18N.get(lang, I18N.get('en', {}))
-    
-    for key in keys:
-        if isinstance(value, dict) and key in value:
-            value = value[key]
-        else:
-            # 如果找不到翻译，返回英文或key
-            value = I18N.get('en', {}).get(key_path, key_path)
-            break
-    
-    if isinstance(value, str):
-        # 替换参数
-        for k, v in kwargs.items():
-            value = value.replace(f"{{{k}}}", str(v))
-        return value
-    
-    return key_path
+    """获取翻译文本，找不到时依次回退到英文和key本身"""
+    template = get_i18n_catalog(get_locale(request)).get(key_path)
+    if template is None:
+        return key_path
+    return template.render(kwargs)
 
 # 加载多语言文件
 load_i18n()
@@ -90,7 +575,7 @@ tasks_lock = threading.Lock()
 # 🔧 新增：任务模型
 class Task(BaseModel):
     id: str
-    type: str  # customize, generate-image, generate-pattern, generate-app-background, generate-text-image, generate-display-background
+    type: str  # customize, generate-image, generate-pattern, generate-app-background, generate-text-image, generate-display-background, generate-keypad-patterns, generate-glyph-set
     status: TaskStatus
     request_data: Dict[str, Any]
     result: Optional[Dict[str, Any]] = None
@@ -116,6 +601,13 @@ class TaskStatusResponse(BaseModel):
 # 全局变量
 _genai_initialized = False
 current_model_key = "flash"
+_model_clients = {}  # 模型名 -> GenerativeModel
+_model_clients_lock = threading.Lock()
+
+def get_genai():
+    """按需导入 google.generativeai，所有模型实例都经由这里创建"""
+    import google.generativeai as genai
+    return genai
 
 def initialize_genai():
     """初始化Google AI"""
@@ -127,18 +619,26 @@ def initialize_genai():
     if not api_key:
         raise ValueError("未找到 GEMINI_API_KEY 环境变量")
     
-    genai.configure(api_key=api_key)
+    get_genai().configure(api_key=api_key)
     _genai_initialized = True
-    print("✅ Google AI 初始化完成")
+    logger.info("✅ Google AI 初始化完成")
+
+def get_model_client(model_name: str):
+    """返回缓存的模型客户端，同名模型只构造一次，后续请求复用其连接"""
+    client = _model_clients.get(model_name)
+    record_cache("model_client", client is not None)
+    if client is None:
+        initialize_genai()
+        with _model_clients_lock:
+            client = _model_clients.get(model_name)
+            if client is None:
+                client = MeteredModel(get_genai().GenerativeModel(model_name), model_name)
+                _model_clients[model_name] = client
+    return client
 
 def get_current_model():
     """获取当前AI模型实例"""
-    global _genai_initialized
-    if not _genai_initialized:
-        initialize_genai()
-    
-    model_name = AVAILABLE_MODELS[current_model_key]["name"]
-    return genai.GenerativeModel(model_name)
+    return get_model_client(AVAILABLE_MODELS[current_model_key]["name"])
 
 # 🔧 新增：任务管理函数
 def create_task(task_type: str, request_data: Dict[str, Any]) -> str:
@@ -165,6 +665,7 @@ def create_task(task_type: str, request_data: Dict[str, Any]) -> str:
             task_dict['updated_at'] = task_dict['updated_at'].isoformat()
             json.dump(task_dict, f, ensure_ascii=False, indent=2)
     
+    TASKS_QUEUED.inc(type=task_type)
     return task_id
 
 def get_task(task_id: str) -> Optional[Task]:
@@ -183,14 +684,14 @@ def get_task(task_id: str) -> Optional[Task]:
                 task_dict['updated_at'] = datetime.fromisoformat(task_dict['updated_at'])
                 return Task(**task_dict)
     except Exception as e:
-        print(f"❌ 读取任务文件失败 {task_id}: {e}")
+        logger.error(f"❌ 读取任务文件失败 {task_id}: {e}")
         return None
 
 def update_task_status(task_id: str, status: TaskStatus, result: Optional[Dict[str, Any]] = None, error: Optional[str] = None, progress: Optional[float] = None):
     """更新任务状态"""
     task = get_task(task_id)
     if task is None:
-        print(f"❌ 任务不存在: {task_id}")
+        logger.error(f"❌ 任务不存在: {task_id}")
         return
     
     # 更新任务状态
@@ -214,7 +715,7 @@ def update_task_status(task_id: str, status: TaskStatus, result: Optional[Dict[s
                 task_dict['updated_at'] = task_dict['updated_at'].isoformat()
                 json.dump(task_dict, f, ensure_ascii=False, indent=2)
     except Exception as e:
-        print(f"❌ 保存任务状态失败 {task_id}: {e}")
+        logger.error(f"❌ 保存任务状态失败 {task_id}: {e}")
 
 def cleanup_old_tasks():
     """清理超过24小时的旧任务"""
@@ -236,7 +737,7 @@ def cleanup_old_tasks():
                     if (now - created_at).total_seconds() > 24 * 3600:  # 24小时
                         to_remove.append(task_file)
             except Exception as e:
-                print(f"❌ 读取任务文件时出错 {filename}: {e}")
+                logger.error(f"❌ 读取任务文件时出错 {filename}: {e}")
                 to_remove.append(task_file)  # 损坏的文件也删除
         
         # 删除过期任务文件
@@ -245,47 +746,687 @@ def cleanup_old_tasks():
                 try:
                     os.remove(task_file)
                 except Exception as e:
-                    print(f"❌ 删除任务文件失败 {task_file}: {e}")
+                    logger.error(f"❌ 删除任务文件失败 {task_file}: {e}")
                     
         if to_remove:
-            print(f"🧹 清理了 {len(to_remove)} 个过期任务")
+            logger.info(f"🧹 清理了 {len(to_remove)} 个过期任务")
     except Exception as e:
-        print(f"❌ 清理任务时出错: {e}")
+        logger.error(f"❌ 清理任务时出错: {e}")
 
 # 🔧 新增：后台任务处理函数
 def process_task_in_background(task_id: str):
-    """在后台处理任务"""
+    """在后台处理任务，期间的日志都带上任务ID"""
+    with log_context(task_id=task_id):
+        run_task(task_id)
+
+def run_task(task_id: str):
     task = get_task(task_id)
     if not task:
         return
     
+    TASKS_QUEUED.dec(type=task.type)
+    TASK_WAIT.observe(max(0.0, (datetime.now() - task.created_at).total_seconds()), type=task.type)
+    TASKS_RUNNING.inc(type=task.type)
+    started = time.perf_counter()
+    status = "failed"
     try:
-        # 更新任务状态为处理中
-        update_task_status(task_id, TaskStatus.PROCESSING, progress=0.1)
-        
-        # 根据任务类型分发处理
-        if task.type == "customize":
-            result = process_customize_task(task_id, task.request_data)
-        elif task.type == "generate-image":
-            result = process_generate_image_task(task_id, task.request_data)
-        elif task.type == "generate-pattern":
-            result = process_generate_pattern_task(task_id, task.request_data)
-        elif task.type == "generate-app-background":
-            result = process_generate_app_background_task(task_id, task.request_data)
-        elif task.type == "generate-text-image":
-            result = process_generate_text_image_task(task_id, task.request_data)
-        elif task.type == "generate-display-background":
-            result = process_generate_display_background_task(task_id, task.request_data)
-        else:
-            raise ValueError(f"未知任务类型: {task.type}")
+        with start_trace() as trace:
+            result = dispatch_task(task_id, task)
         
-        # 任务完成
+        # 任务完成，附上各阶段耗时
+        if isinstance(result, dict):
+            result["timing"] = trace.breakdown()
         update_task_status(task_id, TaskStatus.COMPLETED, result=result, progress=1.0)
-        print(f"✅ 任务 {task_id} ({task.type}) 完成")
+        status = "completed"
+        logger.info(f"✅ 任务 {task_id} ({task.type}) 完成")
         
     except Exception as e:
-        print(f"❌ 任务 {task_id} ({task.type}) 失败: {str(e)}")
+        logger.error(f"❌ 任务 {task_id} ({task.type}) 失败: {str(e)}")
         update_task_status(task_id, TaskStatus.FAILED, error=str(e))
+    finally:
+        TASKS_RUNNING.dec(type=task.type)
+        TASK_RUN.observe(time.perf_counter() - started, type=task.type, status=status)
+
+def dispatch_task(task_id: str, task: Task) -> Dict[str, Any]:
+    """按任务类型分发到对应的处理函数"""
+    # 更新任务状态为处理中
+    update_task_status(task_id, TaskStatus.PROCESSING, progress=0.1)
+    
+    # 根据任务类型分发处理
+    if task.type == "customize":
+        return process_customize_task(task_id, task.request_data)
+    elif task.type == "generate-image":
+        return process_generate_image_task(task_id, task.request_data)
+    elif task.type == "generate-pattern":
+        return process_generate_pattern_task(task_id, task.request_data)
+    elif task.type == "generate-app-background":
+        return process_generate_app_background_task(task_id, task.request_data)
+    elif task.type == "generate-text-image":
+        return process_generate_text_image_task(task_id, task.request_data)
+    elif task.type == "generate-display-background":
+        return process_generate_display_background_task(task_id, task.request_data)
+    elif task.type == "generate-keypad-patterns":
+        return process_generate_keypad_patterns_task(task_id, task.request_data)
+    elif task.type == "generate-glyph-set":
+        return process_generate_glyph_set_task(task_id, task.request_data)
+    else:
+        raise ValueError(f"未知任务类型: {task.type}")
+
+# 🔧 新增：内容寻址图像存储 - 按SHA-256去重落盘，配置中用 img:<hash> 引用代替内联base64
+IMAGES_DIR = "/tmp/images"
+os.makedirs(IMAGES_DIR, exist_ok=True)
+IMAGE_REF_PREFIX = "img:"
+IMAGE_FIELDS = ("backgroundImage", "backgroundImageUrl", "displayBackgroundImage", "image_url")
+DATA_URL_PATTERN = re.compile(r"^data:(image/[\w.+-]+);base64,(.*)$", re.DOTALL)
+IMAGE_HASH_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+# 只接收栅格图像：SVG等可携带脚本的类型不入库，避免经 /images 从API同源返回
+IMAGE_STORE_MIME_TYPES = {"image/png", "image/jpeg", "image/webp", "image/gif"}
+IMAGE_MIME_ALIASES = {"image/jpg": "image/jpeg", "image/pjpeg": "image/jpeg"}
+IMAGE_STORE_MB = float(os.getenv("IMAGE_STORE_MB", "1024"))  # 原图总大小上限，超出时按最近访问淘汰
+
+def normalize_image_mime_type(mime_type: str) -> Optional[str]:
+    """返回允许入库的规范MIME类型，不在允许列表中时返回None"""
+    mime_type = (mime_type or "").lower()
+    mime_type = IMAGE_MIME_ALIASES.get(mime_type, mime_type)
+    return mime_type if mime_type in IMAGE_STORE_MIME_TYPES else None
+
+class ImageStore:
+    """
+    <hash>.bin 保存原始字节，<hash>.json 记录MIME类型和大小；相同内容只存一份
+    原图总大小不超过 budget_bytes，超出时按最近访问顺序淘汰（连同衍生图指针）
+    """
+
+    def __init__(self, directory: str, budget_bytes: int):
+        self.directory = directory
+        self.budget_bytes = budget_bytes
+        self._mime_types = {}  # hash -> MIME类型
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # hash -> 字节数，最近访问的在末尾
+        self._total_bytes = 0
+        files = []
+        for filename in os.listdir(directory):
+            image_hash, _, suffix = filename.partition(".")
+            if suffix != "bin" or not IMAGE_HASH_PATTERN.match(image_hash):
+                continue
+            stat = os.stat(os.path.join(directory, filename))
+            files.append((stat.st_mtime, image_hash, stat.st_size))
+        for _, image_hash, size in sorted(files):
+            self._entries[image_hash] = size
+            self._total_bytes += size
+
+    def _evict(self, keep: str):
+        """超出预算时淘汰最久未访问的原图，keep 为刚写入的图像（调用方持有锁）"""
+        while self._total_bytes > self.budget_bytes and len(self._entries) > 1:
+            evicted, size = next(iter(self._entries.items()))
+            if evicted == keep:
+                break
+            del self._entries[evicted]
+            self._total_bytes -= size
+            self._mime_types.pop(evicted, None)
+            for filename in os.listdir(self.directory):
+                if filename.startswith(evicted + "."):
+                    try:
+                        os.remove(os.path.join(self.directory, filename))
+                    except OSError:
+                        pass
+            logger.info(f"🧹 图像库超出 {IMAGE_STORE_MB:.0f}MB，淘汰原图: {evicted}")
+
+    def touch(self, image_hash: str):
+        """标记为最近使用"""
+        with self._lock:
+            if image_hash in self._entries:
+                self._entries.move_to_end(image_hash)
+
+    def _path(self, image_hash: str, suffix: str) -> str:
+        return os.path.join(self.directory, f"{image_hash}.{suffix}")
+
+    def put(self, data: bytes, mime_type: str) -> str:
+        """保存图像字节，返回内容哈希；MIME类型不在允许列表中时抛出ValueError"""
+        allowed_mime_type = normalize_image_mime_type(mime_type)
+        if allowed_mime_type is None:
+            raise ValueError(f"不支持的图像类型: {mime_type}")
+        mime_type = allowed_mime_type
+        image_hash = hashlib.sha256(data).hexdigest()
+        with self._lock:
+            if image_hash in self._entries or os.path.exists(self._path(image_hash, "bin")):
+                self._mime_types.setdefault(image_hash, mime_type)
+                if image_hash not in self._entries:
+                    self._entries[image_hash] = len(data)
+                    self._total_bytes += len(data)
+                self._entries.move_to_end(image_hash)
+                record_cache("image_store", True)
+                return image_hash
+            record_cache("image_store", False)
+            with open(self._path(image_hash, "json"), 'w', encoding='utf-8') as f:
+                json.dump({"mime_type": mime_type, "size": len(data), "created_at": datetime.now().isoformat()}, f)
+            # 先写临时文件再改名，读取方不会看到写了一半的图像
+            temp_path = self._path(image_hash, f"{uuid.uuid4().hex}.tmp")
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, self._path(image_hash, "bin"))
+            self._mime_types[image_hash] = mime_type
+            self._entries[image_hash] = len(data)
+            self._total_bytes += len(data)
+            self._evict(keep=image_hash)
+        return image_hash
+
+    def derivative(self, image_hash: str, key: str) -> Optional[str]:
+        """返回已缓存的衍生图（缩放/转码结果）的哈希"""
+        try:
+            with open(self._path(image_hash, f"{key}.derivative"), 'r', encoding='utf-8') as f:
+                derivative_hash = f.read().strip()
+        except OSError:
+            return None
+        return derivative_hash if self.path(derivative_hash) else None
+
+    def set_derivative(self, image_hash: str, key: str, derivative_hash: str):
+        with open(self._path(image_hash, f"{key}.derivative"), 'w', encoding='utf-8') as f:
+            f.write(derivative_hash)
+
+    def path(self, image_hash: str) -> Optional[str]:
+        """返回图像文件路径，不存在或哈希非法时返回None"""
+        if not IMAGE_HASH_PATTERN.match(image_hash):
+            return None
+        image_path = self._path(image_hash, "bin")
+        return image_path if os.path.exists(image_path) else None
+
+    def mime_type(self, image_hash: str) -> str:
+        """记录的MIME类型；允许列表之前入库的其他类型（如SVG）一律按 application/octet-stream 返回"""
+        mime_type = self._mime_types.get(image_hash)
+        if mime_type is None:
+            try:
+                with open(self._path(image_hash, "json"), 'r', encoding='utf-8') as f:
+                    mime_type = json.load(f).get("mime_type", "image/png")
+            except (OSError, ValueError):
+                mime_type = "image/png"
+            mime_type = normalize_image_mime_type(mime_type) or "application/octet-stream"
+            self._mime_types[image_hash] = mime_type
+        return mime_type
+
+    def get(self, image_hash: str) -> Optional[tuple]:
+        """返回 (bytes, mime_type)，不存在（或刚被淘汰）时返回None"""
+        image_path = self.path(image_hash)
+        if image_path is None:
+            return None
+        try:
+            with open(image_path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        self.touch(image_hash)
+        return data, self.mime_type(image_hash)
+
+    def put_data_url(self, data_url: str) -> Optional[str]:
+        """把 data:image/...;base64, 字符串存入图像库，返回 img:<hash> 引用；无法解析时返回None"""
+        match = DATA_URL_PATTERN.match(data_url)
+        if not match or normalize_image_mime_type(match.group(1)) is None:
+            return None
+        try:
+            data = base64.b64decode(match.group(2))
+        except ValueError:
+            return None
+        return IMAGE_REF_PREFIX + self.put(data, match.group(1))
+
+    def to_data_url(self, image_ref: str) -> Optional[str]:
+        """把 img:<hash> 引用还原为data URL，图像不存在时返回None"""
+        image = self.get(image_ref[len(IMAGE_REF_PREFIX):])
+        if image is None:
+            return None
+        data, mime_type = image
+        return f"data:{mime_type};base64,{base64.b64encode(data).decode('utf-8')}"
+
+image_store = ImageStore(IMAGES_DIR, int(IMAGE_STORE_MB * 1024 * 1024))
+
+def _map_image_fields(obj, convert):
+    """对 IMAGE_FIELDS 中的字符串字段做转换，只重建发生变化的字典/列表，其余部分与原对象共享"""
+    if isinstance(obj, dict):
+        replaced = None
+        for key, value in obj.items():
+            if isinstance(value, str):
+                if key not in IMAGE_FIELDS:
+                    continue
+                new_value = convert(value)
+            elif isinstance(value, (dict, list)):
+                new_value = _map_image_fields(value, convert)
+            else:
+                continue
+            if new_value is not value:
+                if replaced is None:
+                    replaced = dict(obj)
+                replaced[key] = new_value
+        return obj if replaced is None else replaced
+    if isinstance(obj, list):
+        items = [_map_image_fields(item, convert) for item in obj]
+        if any(new is not old for new, old in zip(items, obj)):
+            return items
+    return obj
+
+def externalize_images(config):
+    """把配置中的内联base64图像存入图像库并替换为 img:<hash> 引用"""
+    def convert(value):
+        if not value.startswith("data:image/"):
+            return value
+        return image_store.put_data_url(value) or value
+    return _map_image_fields(config, convert)
+
+def expand_image_refs(config):
+    """把配置中的 img:<hash> 引用还原为data URL，兼容只认识内联图像的客户端"""
+    def convert(value):
+        if not value.startswith(IMAGE_REF_PREFIX):
+            return value
+        return image_store.to_data_url(value) or value
+    return _map_image_fields(config, convert)
+
+def extract_generated_image(response) -> Optional[tuple]:
+    """取出Gemini图像生成响应中的第一张图像，返回 (bytes, mime_type)，没有图像时返回None"""
+    for part in getattr(response, 'parts', None) or []:
+        inline_data = getattr(part, 'inline_data', None)
+        if inline_data:
+            data = inline_data.data
+            if not isinstance(data, bytes):
+                # 字符串形式的数据已经是base64
+                data = base64.b64decode(str(data))
+            return data, inline_data.mime_type
+    return None
+
+# 🔧 新增：生成图像后处理 - 缩放到请求尺寸并转码为WebP/优化PNG，在进程池中执行
+IMAGE_OUTPUT_FORMAT = os.getenv("IMAGE_OUTPUT_FORMAT", "webp").lower()  # webp 或 png
+IMAGE_OUTPUT_QUALITY = int(os.getenv("IMAGE_OUTPUT_QUALITY", "80"))  # WebP质量 1-100
+IMAGE_PROCESS_WORKERS = int(os.getenv("IMAGE_PROCESS_WORKERS", "2"))
+IMAGE_OUTPUT_MIME_TYPES = {"webp": "image/webp", "png": "image/png"}
+_image_process_pool = None
+_image_process_pool_lock = threading.Lock()
+
+def parse_image_size(size: Optional[str]) -> Optional[tuple]:
+    """解析 "1080x1920" 形式的尺寸，无效时返回None"""
+    match = re.fullmatch(r"\s*(\d+)\s*[xX×]\s*(\d+)\s*", size or "")
+    if not match:
+        return None
+    width, height = int(match.group(1)), int(match.group(2))
+    if not (0 < width <= 4096 and 0 < height <= 4096):
+        return None
+    return width, height
+
+def transcode_image(data: bytes, width: int, height: int, image_format: str, quality: int) -> bytes:
+    """
+    按目标宽高比居中裁剪并缩放，再编码为指定格式（在子进程中执行）
+    原图小于目标尺寸时只裁剪到目标宽高比，不放大
+    """
+    from PIL import Image, ImageOps
+    with Image.open(BytesIO(data)) as image:
+        image = ImageOps.exif_transpose(image)
+        scale = max(width / image.width, height / image.height)
+        if scale > 1:
+            width, height = max(1, round(width / scale)), max(1, round(height / scale))
+        has_alpha = image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info)
+        image = image.convert("RGBA" if has_alpha else "RGB")
+        image = ImageOps.fit(image, (width, height), method=Image.LANCZOS)
+        
+        output = BytesIO()
+        if image_format == "webp":
+            image.save(output, format="WEBP", quality=quality, method=6)
+        else:
+            image.save(output, format="PNG", optimize=True)
+        return output.getvalue()
+
+def get_image_process_pool() -> ProcessPoolExecutor:
+    global _image_process_pool
+    with _image_process_pool_lock:
+        if _image_process_pool is None:
+            _image_process_pool = ProcessPoolExecutor(max_workers=IMAGE_PROCESS_WORKERS)
+        return _image_process_pool
+
+def run_in_image_process(fn, *args):
+    """
+    在图像进程池中执行 fn 并阻塞等待结果，只能在工作线程（后台任务、asyncio.to_thread）中调用
+    在事件循环线程上调用会卡住所有请求，直接抛出RuntimeError；异步代码请 await run_in_image_process_async
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return get_image_process_pool().submit(fn, *args).result()
+    raise RuntimeError(f"{fn.__name__} 不能在事件循环中同步等待，请使用 run_in_image_process_async")
+
+async def run_in_image_process_async(fn, *args):
+    """在图像进程池中执行 fn，等待期间不占用事件循环"""
+    return await asyncio.wrap_future(get_image_process_pool().submit(fn, *args))
+
+def optimize_generated_image(data: bytes, mime_type: str, size: Optional[str]) -> tuple:
+    """
+    把生成的原图缩放/转码到请求尺寸，返回 (bytes, mime_type)
+    原图和衍生图都存入图像库，相同原图+参数直接命中缓存；处理失败时返回原图
+    """
+    target = parse_image_size(size)
+    image_format = IMAGE_OUTPUT_FORMAT if IMAGE_OUTPUT_FORMAT in IMAGE_OUTPUT_MIME_TYPES else "webp"
+    if target is None:
+        return data, mime_type
+    
+    try:
+        # 模型返回图像库不接受的类型时 put 抛出 ValueError，同样按处理失败返回原图
+        original_hash = image_store.put(data, mime_type)
+        key = f"{target[0]}x{target[1]}.{image_format}.q{IMAGE_OUTPUT_QUALITY}"
+        derivative_hash = image_store.derivative(original_hash, key)
+        cached = image_store.get(derivative_hash) if derivative_hash else None
+        record_cache("image_derivative", cached is not None)
+        if cached:
+            return cached
+        output = run_in_image_process(transcode_image, data, target[0], target[1], image_format, IMAGE_OUTPUT_QUALITY)
+    except Exception as e:
+        logger.warning(f"⚠️ 图像后处理失败，返回原图: {e}")
+        return data, mime_type
+    
+    output_mime_type = IMAGE_OUTPUT_MIME_TYPES[image_format]
+    IMAGE_BYTES.inc(len(output), source="optimized")
+    image_store.set_derivative(original_hash, key, image_store.put(output, output_mime_type))
+    logger.info(f"🗜️ 图像后处理完成: {len(data)} -> {len(output)} 字节 ({key})")
+    return output, output_mime_type
+
+# 🔧 新增：响应式图像变体 - 按设备宽度惰性生成，磁盘上按LRU控制总大小
+IMAGE_VARIANTS_DIR = os.path.join(IMAGES_DIR, "variants")
+os.makedirs(IMAGE_VARIANTS_DIR, exist_ok=True)
+IMAGE_VARIANT_CACHE_MB = float(os.getenv("IMAGE_VARIANT_CACHE_MB", "256"))
+# 宽度向上取整到常见设备宽度，避免每个像素值都生成一份变体
+IMAGE_VARIANT_WIDTHS = (160, 320, 480, 640, 750, 828, 1080, 1242, 1440, 1668, 2048)
+
+class ImageVariantCache:
+    """变体文件 <hash>-<key>，按最近访问顺序淘汰，总大小不超过 budget_bytes"""
+
+    def __init__(self, directory: str, budget_bytes: int):
+        self.directory = directory
+        self.budget_bytes = budget_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # 文件名 -> 字节数，最近访问的在末尾
+        self._total_bytes = 0
+        files = []
+        for filename in os.listdir(directory):
+            if filename.endswith(".tmp"):
+                continue
+            stat = os.stat(os.path.join(directory, filename))
+            files.append((stat.st_mtime, filename, stat.st_size))
+        for _, filename, size in sorted(files):
+            self._entries[filename] = size
+            self._total_bytes += size
+
+    @staticmethod
+    def filename(image_hash: str, width: int, image_format: str) -> str:
+        return f"{image_hash}-w{width}.q{IMAGE_OUTPUT_QUALITY}.{image_format}"
+
+    def get(self, filename: str) -> Optional[bytes]:
+        """命中时返回变体字节并标记为最近使用；在锁内读取，读出后即使被其他请求淘汰也不影响本次响应"""
+        path = os.path.join(self.directory, filename)
+        data = None
+        with self._lock:
+            if filename in self._entries:
+                try:
+                    with open(path, 'rb') as f:
+                        data = f.read()
+                    os.utime(path)  # 重启后按mtime恢复LRU顺序
+                    self._entries.move_to_end(filename)
+                except OSError:
+                    # 文件已不在（被外部清理），按未命中处理并重新生成
+                    self._total_bytes -= self._entries.pop(filename)
+                    data = None
+        record_cache("image_variant", data is not None)
+        return data
+
+    def put(self, filename: str, data: bytes) -> str:
+        IMAGE_BYTES.inc(len(data), source="variant")
+        path = os.path.join(self.directory, filename)
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+        with self._lock:
+            self._total_bytes += len(data) - self._entries.pop(filename, 0)
+            self._entries[filename] = len(data)
+            while self._total_bytes > self.budget_bytes and len(self._entries) > 1:
+                evicted, size = self._entries.popitem(last=False)
+                self._total_bytes -= size
+                try:
+                    os.remove(os.path.join(self.directory, evicted))
+                except OSError:
+                    pass
+        return path
+
+image_variant_cache = ImageVariantCache(IMAGE_VARIANTS_DIR, int(IMAGE_VARIANT_CACHE_MB * 1024 * 1024))
+
+def resize_image_to_width(data: bytes, width: int, image_format: str, quality: int) -> bytes:
+    """按宽度等比缩放并转码（在子进程中执行）"""
+    from PIL import Image
+    with Image.open(BytesIO(data)) as image:
+        height = max(1, round(image.height * width / image.width))
+    return transcode_image(data, width, height, image_format, quality)
+
+# 🔧 新增：按键背景图精灵图集 - 一个配置的全部按键图打包成一张纹理，客户端只需下载和解码一次
+SPRITE_ATLAS_DIR = os.path.join(IMAGES_DIR, "atlases")
+os.makedirs(SPRITE_ATLAS_DIR, exist_ok=True)
+SPRITE_ATLAS_MAX_SIZE = 4096
+SPRITE_ATLAS_MIN_SPRITE_SIZE = 8
+
+class SpriteAtlasTooLargeError(ValueError):
+    """按键图数量过多，缩到最小边长也放不进图集尺寸上限"""
+
+def sprite_size_limit(count: int, max_sprite_size: int, padding: int) -> int:
+    """
+    按图像数量收紧单图边长：图集按 ceil(sqrt(n)) × ceil(sqrt(n)) 的网格也能放下全部按键图
+    （12×10 的满布局在 max_sprite_size=1024 时缩到 370）
+    """
+    cells = math.ceil(math.sqrt(count))
+    limit = min(max_sprite_size, SPRITE_ATLAS_MAX_SIZE // cells - padding)
+    if limit < SPRITE_ATLAS_MIN_SPRITE_SIZE:
+        raise SpriteAtlasTooLargeError(f"{count} 张按键图无法放入 {SPRITE_ATLAS_MAX_SIZE} 图集")
+    return limit
+
+def pack_sprite_atlas(images: list, max_sprite_size: int, padding: int, image_format: str, quality: int) -> tuple:
+    """
+    货架式装箱（在子进程中执行）：按高度降序逐行摆放，宽度取能容纳全部面积的最小2的幂，放不下时加宽
+    images 为 [(hash, bytes)]，返回 (图集字节, {hash: (x, y, w, h)}, (宽, 高))
+    """
+    from PIL import Image
+    max_sprite_size = sprite_size_limit(len(images), max_sprite_size, padding)
+    sprites = []
+    for image_hash, data in images:
+        with Image.open(BytesIO(data)) as image:
+            sprite = image.convert("RGBA")
+        if max(sprite.size) > max_sprite_size:
+            sprite.thumbnail((max_sprite_size, max_sprite_size), Image.LANCZOS)
+        sprites.append((image_hash, sprite))
+    sprites.sort(key=lambda item: (-item[1].height, -item[1].width))
+    
+    area = sum((sprite.width + padding) * (sprite.height + padding) for _, sprite in sprites)
+    widest = max(sprite.width for _, sprite in sprites) + padding
+    atlas_width = 1
+    while atlas_width < max(widest, math.isqrt(area)):
+        atlas_width *= 2
+    
+    # 单图边长已按数量收紧，宽度加到上限时必然放得下
+    while True:
+        frames = {}
+        x = y = shelf_height = 0
+        for image_hash, sprite in sprites:
+            if x + sprite.width + padding > atlas_width:
+                x, y, shelf_height = 0, y + shelf_height, 0
+            frames[image_hash] = (x, y, sprite.width, sprite.height)
+            x += sprite.width + padding
+            shelf_height = max(shelf_height, sprite.height + padding)
+        atlas_height = y + shelf_height
+        if atlas_height <= SPRITE_ATLAS_MAX_SIZE or atlas_width >= SPRITE_ATLAS_MAX_SIZE:
+            break
+        atlas_width *= 2
+    if atlas_width > SPRITE_ATLAS_MAX_SIZE or atlas_height > SPRITE_ATLAS_MAX_SIZE:
+        raise SpriteAtlasTooLargeError(f"图集尺寸 {atlas_width}x{atlas_height} 超过上限 {SPRITE_ATLAS_MAX_SIZE}")
+    
+    atlas = Image.new("RGBA", (atlas_width, atlas_height), (0, 0, 0, 0))
+    for image_hash, sprite in sprites:
+        frame_x, frame_y, _, _ = frames[image_hash]
+        atlas.paste(sprite, (frame_x, frame_y))
+    
+    output = BytesIO()
+    if image_format == "webp":
+        atlas.save(output, format="WEBP", quality=quality, method=6)
+    else:
+        atlas.save(output, format="PNG", optimize=True)
+    return output.getvalue(), frames, (atlas_width, atlas_height)
+
+def build_sprite_atlas(config: dict, max_sprite_size: int = 256, padding: int = 2) -> dict:
+    """
+    收集配置中所有按键背景图（data URL 或 img:<hash> 引用）打包成图集
+    结果按 (图像哈希集合, 参数) 缓存，相同按键图集合直接返回
+    """
+    buttons = ((config or {}).get("layout") or {}).get("buttons") or []
+    button_hashes = {}
+    skipped = []
+    for button in externalize_images(buttons):
+        image = button.get("backgroundImage")
+        if not image:
+            continue
+        image_hash = image[len(IMAGE_REF_PREFIX):] if image.startswith(IMAGE_REF_PREFIX) else None
+        if image_hash and image_store.path(image_hash):
+            button_hashes[button.get("id", "")] = image_hash
+        else:
+            skipped.append(button.get("id", ""))
+    
+    if not button_hashes:
+        raise ValueError("配置中没有可打包的按键背景图")
+    
+    image_format = IMAGE_OUTPUT_FORMAT if IMAGE_OUTPUT_FORMAT in IMAGE_OUTPUT_MIME_TYPES else "webp"
+    unique_hashes = sorted(set(button_hashes.values()))
+    cache_key = hashlib.sha256(
+        json.dumps([unique_hashes, max_sprite_size, padding, image_format, IMAGE_OUTPUT_QUALITY]).encode('utf-8')
+    ).hexdigest()
+    cache_path = os.path.join(SPRITE_ATLAS_DIR, f"{cache_key}.json")
+    
+    cached = False
+    atlas = None
+    try:
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            atlas = json.load(f)
+        cached = image_store.path(atlas["atlas_id"]) is not None
+    except (OSError, ValueError, KeyError):
+        pass
+    
+    if not cached:
+        images = []
+        for image_hash in unique_hashes:
+            # 外部化之后可能已被图像库淘汰，缺失的按键图跳过
+            stored = image_store.get(image_hash)
+            if stored is not None:
+                images.append((image_hash, stored[0]))
+        if len(images) < len(unique_hashes):
+            present = {image_hash for image_hash, _ in images}
+            for button_id, image_hash in list(button_hashes.items()):
+                if image_hash not in present:
+                    del button_hashes[button_id]
+                    skipped.append(button_id)
+            if not images:
+                raise ValueError("配置中没有可打包的按键背景图")
+            cache_path = None
+        atlas_bytes, frames, (width, height) = run_in_image_process(
+            pack_sprite_atlas, images, max_sprite_size, padding, image_format, IMAGE_OUTPUT_QUALITY
+        )
+        atlas_id = image_store.put(atlas_bytes, IMAGE_OUTPUT_MIME_TYPES[image_format])
+        atlas = {"atlas_id": atlas_id, "width": width, "height": height, "frames": frames}
+        # 缺图时结果与缓存键对应的哈希集合不符，不写缓存
+        if cache_path:
+            with open(cache_path, 'w', encoding='utf-8') as f:
+                json.dump(atlas, f)
+        logger.info(f"🧩 精灵图集打包完成: {len(unique_hashes)} 张 -> {width}x{height}, {len(atlas_bytes)} 字节")
+    
+    width, height = atlas["width"], atlas["height"]
+    rects = {}
+    for button_id, image_hash in button_hashes.items():
+        x, y, w, h = atlas["frames"][image_hash]
+        rects[button_id] = {
+            "x": x, "y": y, "width": w, "height": h,
+            # 归一化UV坐标，左上角为原点
+            "u0": x / width, "v0": y / height, "u1": (x + w) / width, "v1": (y + h) / height,
+        }
+    
+    return {
+        "atlas_id": atlas["atlas_id"],
+        "atlas_ref": IMAGE_REF_PREFIX + atlas["atlas_id"],
+        "atlas_url": f"/images/{atlas['atlas_id']}",
+        "mime_type": image_store.mime_type(atlas["atlas_id"]),
+        "width": width,
+        "height": height,
+        "frames": rects,
+        "skipped": skipped,
+        "cached": cached,
+    }
+
+def image_payload(data: bytes, mime_type: str, url_field: str, return_image_id: bool = False,
+                  include_data: bool = True, size: Optional[str] = None) -> dict:
+    """
+    生成接口返回的图像字段，size 为请求尺寸时先缩放/转码
+    默认返回data URL（以及 image_data 中的base64）；return_image_id 时图像存入图像库，
+    只返回 image_id、可写入配置的 img:<hash> 引用和 /images/{hash} 下载地址
+    """
+    data, mime_type = optimize_generated_image(data, mime_type, size)
+    if return_image_id:
+        image_hash = image_store.put(data, mime_type)
+        return {
+            url_field: f"/images/{image_hash}",
+            "image_id": image_hash,
+            "image_ref": IMAGE_REF_PREFIX + image_hash,
+            "mime_type": mime_type,
+        }
+    
+    image_base64_data = base64.b64encode(data).decode('utf-8')
+    payload = {url_field: f"data:{mime_type};base64,{image_base64_data}"}
+    if include_data:
+        payload["image_data"] = image_base64_data
+    payload["mime_type"] = mime_type
+    return payload
+
+# 🔧 新增：上游图像生成并发限制 - 后台任务和批量任务共用，避免同时打满Gemini配额
+IMAGE_GENERATION_CONCURRENCY = int(os.getenv("IMAGE_GENERATION_CONCURRENCY", "4"))
+image_generation_limiter = threading.BoundedSemaphore(IMAGE_GENERATION_CONCURRENCY)
+
+@contextmanager
+def timed_stage(timings: Optional[dict], name: str, on_stage=None):
+    """记录一个流水线阶段的耗时（毫秒）到 timings[name] 和当前Trace，on_stage(name) 在阶段开始时调用"""
+    if on_stage:
+        on_stage(name)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = (time.perf_counter() - start) * 1000
+        if timings is not None:
+            timings[name] = round(elapsed, 2)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.add(name, elapsed)
+
+def generate_image_content(prompt: str, timings: Optional[dict] = None, on_stage=None) -> Optional[tuple]:
+    """
+    在并发限制下调用图像生成模型，返回 (bytes, mime_type)，没有图像时返回None
+    即图像流水线的 limit / call / extract 三个阶段，timings 传入时记录各阶段耗时
+    """
+    image_model = get_model_client(AVAILABLE_MODELS["flash-image"]["name"])
+    with timed_stage(timings, "limit", on_stage):
+        image_generation_limiter.acquire()
+    try:
+        with timed_stage(timings, "call", on_stage):
+            response = image_model.generate_content(
+                contents=[prompt],
+                generation_config={"response_modalities": ["TEXT", "IMAGE"]}
+            )
+    finally:
+        image_generation_limiter.release()
+    
+    with timed_stage(timings, "extract", on_stage):
+        generated_image = extract_generated_image(response)
+    if generated_image:
+        IMAGE_BYTES.inc(len(generated_image[0]), source="generated")
+    else:
+        # 没有图像时模型通常会返回一段文字说明
+        try:
+            if response.text:
+                logger.debug(f"🤖 AI响应: {response.text}")
+        except (AttributeError, ValueError):
+            pass
+    return generated_image
 
 # 可用模型配置
 AVAILABLE_MODELS = {
@@ -446,6 +1587,8 @@ class CustomizationRequest(BaseModel):
     workshop_protected_fields: Optional[List[str]] = Field(default=[], description="受图像生成工坊保护的字段列表")
     # 🔧 新增：简化的背景图保护标识
     preserve_background_images: Optional[bool] = Field(default=False, description="是否保护所有背景图片")
+    # 🔧 新增：返回 img:<hash> 图像引用而不是内联base64（图像通过 GET /images/{hash} 获取）
+    use_image_refs: Optional[bool] = Field(default=False, description="返回配置中的图像是否使用img:<hash>引用")
 
 # 修复后的AI系统提示 - 继承式功能设计
 SYSTEM_PROMPT = """你是专业的计算器功能设计大师。你的职责是在现有配置基础上进行精确的增删改，绝不全盘推翻。
@@ -885,6 +2028,73 @@ VALIDATION_PROMPT = """你是配置修复专家。检查并修复生成的计算
 
 返回修复后的完整JSON配置。"""
 
+# 🔧 新增：启动预热 - 初始化SDK、构造已注册的模型客户端并预热各类缓存，
+# 完成前 /ready 返回503，负载均衡不会把流量导到冷实例；/health 仅表示进程存活
+STARTUP_WARMUP = os.getenv("STARTUP_WARMUP", "true").lower() in ("1", "true", "yes")
+# 预热结束前向当前模型发一个极小的请求，提前建立连接（会产生一次调用）
+STARTUP_WARMUP_PROBE = os.getenv("STARTUP_WARMUP_PROBE", "false").lower() in ("1", "true", "yes")
+warmup_state = {"status": "pending", "started_at": None, "finished_at": None, "steps": {}, "errors": {}}
+
+def _warm_model_clients():
+    for model in AVAILABLE_MODELS.values():
+        get_model_client(model["name"])
+
+def _warm_i18n():
+    for lang in I18N_SOURCES:
+        get_i18n_catalog(lang)
+
+def _warm_background_presets():
+    for preset in BACKGROUND_PRESETS:
+        background_preset_assets.get(preset)
+
+def _warm_expressions():
+    # 导入numpy并构造表达式求值名字空间
+    expression_namespace()
+
+def _warm_image_processing():
+    from PIL import Image, ImageOps  # noqa: F401
+    # 进程池的工作进程在首次提交任务时才启动
+    run_in_image_process(os.getpid)
+
+def _probe_model():
+    get_current_model().generate_content("ping", generation_config={"max_output_tokens": 1})
+
+WARMUP_STEPS = (
+    ("genai", initialize_genai),
+    ("model_clients", _warm_model_clients),
+    ("i18n", _warm_i18n),
+    ("background_presets", _warm_background_presets),
+    ("expressions", _warm_expressions),
+    ("image_processing", _warm_image_processing),
+)
+
+def run_startup_warmup():
+    """依次执行预热步骤并记录耗时；单个步骤失败只记录错误，不阻止实例就绪"""
+    warmup_state.update(status="running", started_at=datetime.now().isoformat())
+    steps = WARMUP_STEPS + ((("probe", _probe_model),) if STARTUP_WARMUP_PROBE else ())
+    for name, step in steps:
+        try:
+            with timed_stage(warmup_state["steps"], name):
+                step()
+        except Exception as e:
+            warmup_state["errors"][name] = str(e)
+            logger.warning(f"⚠️ 预热步骤失败: {name} - {e}")
+    warmup_state.update(status="ready", finished_at=datetime.now().isoformat())
+    logger.info(f"🔥 启动预热完成，各步骤耗时(ms): {warmup_state['steps']}")
+
+@app.on_event("startup")
+async def start_warmup():
+    if STARTUP_WARMUP:
+        threading.Thread(target=run_startup_warmup, name="startup-warmup", daemon=True).start()
+    else:
+        warmup_state["status"] = "ready"
+
+@app.get("/ready")
+async def readiness_check():
+    """就绪检查：启动预热完成后返回200，之前返回503"""
+    ready = warmup_state["status"] == "ready"
+    return JSONResponse(status_code=200 if ready else 503, content={"ready": ready, **warmup_state})
+
 @app.get("/health")
 async def health_check(request: Request):
     return {
@@ -892,9 +2102,208 @@ async def health_check(request: Request):
         "version": t(request, "api.version"),
         "current_model": AVAILABLE_MODELS[current_model_key]["display_name"],
         "model_key": current_model_key,
+        "ready": warmup_state["status"] == "ready",
         "message": t(request, "api.health.message")
     }
 
+def collect_lru_cache_metrics():
+    """把进程内 lru_cache 的累计命中/未命中同步到缓存指标"""
+    for cache, function in (("i18n_language", negotiate_language), ("expression", compile_button_expression)):
+        info = function.cache_info()
+        CACHE_REQUESTS.set_total(info.hits, cache=cache, result="hit")
+        CACHE_REQUESTS.set_total(info.misses, cache=cache, result="miss")
+
+metrics_collectors.append(collect_lru_cache_metrics)
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus文本格式的指标"""
+    return Response(content=render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+# 🔧 新增：采样分析器 - 后台线程定时读取 sys._current_frames()，按线程聚合调用栈，不插桩、开销与采样频率成正比
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")  # 未设置时管理接口全部禁用
+PROFILE_MAX_SECONDS = 60
+PROFILE_DEFAULT_INTERVAL_MS = 10
+PROFILE_MAX_DEPTH = 128
+PROFILE_KEEP = 16  # 保留最近几次 /customize?profile=true 的结果
+# 叶子帧落在这些函数里的线程处于空闲等待（锁、队列、select），默认不计入
+PROFILE_IDLE_FRAMES = {
+    ("threading.py", "wait"),
+    ("threading.py", "_wait_for_tstate_lock"),
+    ("selectors.py", "select"),
+    ("thread.py", "_worker"),
+    ("handlers.py", "dequeue"),
+}
+
+def require_admin(token: Optional[str]):
+    """校验 X-Admin-Token，ADMIN_TOKEN 未配置时一律拒绝"""
+    if not ADMIN_TOKEN or not token or not hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="需要有效的管理令牌")
+
+class SamplingProfiler:
+    """
+    以 interval_ms 的间隔采样各线程的Python调用栈，相同(线程, 调用栈)合并为 [次数, 累计毫秒]
+    thread_ids 指定时只采样这些线程；输出 collapsed（flamegraph.pl / speedscope 均可导入）或 speedscope JSON
+    """
+
+    def __init__(self, interval_ms: float = PROFILE_DEFAULT_INTERVAL_MS, thread_ids: Optional[set] = None,
+                 include_idle: bool = False):
+        self.interval = max(1.0, interval_ms) / 1000
+        self.thread_ids = thread_ids
+        self.include_idle = include_idle
+        self.stacks = {}  # (线程名, (帧, ...)) -> [次数, 毫秒]，帧从根到叶
+        self.samples = 0
+        self.duration_ms = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+        self._started = 0.0
+
+    @staticmethod
+    def _frame_key(code) -> tuple:
+        parts = code.co_filename.replace("\\", "/").rsplit("/", 2)
+        return code.co_name, "/".join(parts[-2:]), code.co_firstlineno
+
+    def _is_idle(self, frame) -> bool:
+        code = frame.f_code
+        return (os.path.basename(code.co_filename), code.co_name) in PROFILE_IDLE_FRAMES
+
+    def _sample(self, weight_ms: float):
+        own_id = threading.get_ident()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_id or (self.thread_ids is not None and thread_id not in self.thread_ids):
+                continue
+            if not self.include_idle and self._is_idle(frame):
+                continue
+            stack = []
+            while frame is not None and len(stack) < PROFILE_MAX_DEPTH:
+                stack.append(self._frame_key(frame.f_code))
+                frame = frame.f_back
+            key = (names.get(thread_id, str(thread_id)), tuple(reversed(stack)))
+            entry = self.stacks.get(key)
+            if entry is None:
+                self.stacks[key] = [1, weight_ms]
+            else:
+                entry[0] += 1
+                entry[1] += weight_ms
+        self.samples += 1
+
+    def _run(self):
+        previous = time.perf_counter()
+        while not self._stop.wait(self.interval):
+            now = time.perf_counter()
+            self._sample((now - previous) * 1000)
+            previous = now
+
+    def start(self):
+        self._started = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.duration_ms = round((time.perf_counter() - self._started) * 1000, 2)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def collapsed(self) -> str:
+        """每行 "线程;根帧;...;叶帧 次数"，按次数降序"""
+        lines = []
+        for (thread_name, stack), (count, _) in sorted(self.stacks.items(), key=lambda item: -item[1][0]):
+            frames = [thread_name] + [f"{name} ({path}:{line})" for name, path, line in stack]
+            lines.append(f"{';'.join(frame.replace(';', ':') for frame in frames)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def speedscope(self, name: str = "queee-backend") -> dict:
+        """speedscope 文件格式：每个线程一个 sampled profile，相同调用栈合并为一个样本，权重为累计毫秒"""
+        frames, frame_index, profiles = [], {}, {}
+        for (thread_name, stack), (_, weight_ms) in self.stacks.items():
+            indices = []
+            for frame in stack:
+                index = frame_index.get(frame)
+                if index is None:
+                    index = frame_index[frame] = len(frames)
+                    frames.append({"name": frame[0], "file": frame[1], "line": frame[2]})
+                indices.append(index)
+            profile = profiles.setdefault(thread_name, {"samples": [], "weights": []})
+            profile["samples"].append(indices)
+            profile["weights"].append(round(weight_ms, 3))
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "name": name,
+            "exporter": "queee-backend",
+            "activeProfileIndex": 0,
+            "shared": {"frames": frames},
+            "profiles": [
+                {
+                    "type": "sampled",
+                    "name": thread_name,
+                    "unit": "milliseconds",
+                    "startValue": 0,
+                    "endValue": round(sum(profile["weights"]), 3),
+                    **profile,
+                }
+                for thread_name, profile in sorted(profiles.items())
+            ],
+        }
+
+    def render(self, output_format: str, name: str = "queee-backend") -> Response:
+        if output_format == "speedscope":
+            return JSONResponse(content=self.speedscope(name))
+        return Response(content=self.collapsed(), media_type="text/plain; charset=utf-8")
+
+_profile_lock = threading.Lock()  # 同一时间只跑一个全进程采样
+recent_profiles = OrderedDict()  # profile_id -> SamplingProfiler
+
+def remember_profile(profile_id: str, profiler: SamplingProfiler):
+    recent_profiles[profile_id] = profiler
+    while len(recent_profiles) > PROFILE_KEEP:
+        recent_profiles.popitem(last=False)
+
+@app.get("/admin/profile")
+async def profile_process(
+    seconds: float = Query(10, gt=0, le=PROFILE_MAX_SECONDS),
+    interval_ms: float = Query(PROFILE_DEFAULT_INTERVAL_MS, ge=1, le=1000),
+    output_format: str = Query("collapsed", alias="format", pattern="^(collapsed|speedscope)$"),
+    idle: bool = Query(False, description="是否包含空闲等待中的线程"),
+    x_admin_token: Optional[str] = Header(None),
+):
+    """对整个进程（事件循环和所有工作线程）采样 seconds 秒，返回 collapsed 或 speedscope 格式"""
+    require_admin(x_admin_token)
+    if not _profile_lock.acquire(blocking=False):
+        raise HTTPException(status_code=409, detail="已有采样正在进行")
+    try:
+        profiler = SamplingProfiler(interval_ms, include_idle=idle)
+        profiler.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            await asyncio.to_thread(profiler.stop)
+    finally:
+        _profile_lock.release()
+    logger.info(f"🔬 采样完成: {seconds}秒，{profiler.samples} 次采样，{len(profiler.stacks)} 个不同调用栈")
+    return profiler.render(output_format)
+
+@app.get("/admin/profiles/{profile_id}")
+async def get_request_profile(
+    profile_id: str,
+    output_format: str = Query("speedscope", alias="format", pattern="^(collapsed|speedscope)$"),
+    x_admin_token: Optional[str] = Header(None),
+):
+    """获取 /customize?profile=true 单次请求的采样结果（响应头 X-Profile-Id）"""
+    require_admin(x_admin_token)
+    profiler = recent_profiles.get(profile_id)
+    if profiler is None:
+        raise HTTPException(status_code=404, detail="采样结果不存在或已过期")
+    return profiler.render(output_format, name=f"customize {profile_id}")
+
 @app.get("/models")
 async def get_available_models():
     """获取所有可用的AI模型"""
@@ -929,8 +2338,32 @@ async def switch_model(model_key: str, request: Request):
         raise HTTPException(status_code=500, detail=t(request, "api.error.model_switch_failed"))
 
 @app.post("/customize")
-async def customize_calculator(request: CustomizationRequest) -> CalculatorConfig:
+async def customize_calculator(
+    request: CustomizationRequest,
+    response: Response,
+    profile: bool = Query(False, description="对本次请求采样分析（需管理令牌），结果通过 X-Profile-Id 获取"),
+    x_admin_token: Optional[str] = Header(None),
+) -> CalculatorConfig:
+    if not profile:
+        return await build_customized_config(request)
+    
+    require_admin(x_admin_token)
+    # 定制流程在事件循环线程上同步执行，只采样当前线程
+    with SamplingProfiler(thread_ids={threading.get_ident()}) as profiler:
+        config = await build_customized_config(request)
+    profile_id = uuid.uuid4().hex[:16]
+    remember_profile(profile_id, profiler)
+    response.headers["X-Profile-Id"] = profile_id
+    return config
+
+async def build_customized_config(request: CustomizationRequest) -> CalculatorConfig:
     try:
+        # 🖼️ 内联图像转存到图像库，提示词和合并过程只携带 img:<hash> 引用
+        with span("images"):
+            request.current_config = externalize_images(request.current_config)
+        
+        prompt_started = time.perf_counter()
+        
         # 🛡️ 图像生成工坊保护检查
         protected_fields = []
         workshop_protection_info = ""
@@ -940,7 +2373,7 @@ async def customize_calculator(request: CustomizationRequest) -> CalculatorConfi
             # 优先使用用户明确指定的保护字段
             if request.workshop_protected_fields:
                 protected_fields = request.workshop_protected_fields.copy()
-                print(f"🛡️ 使用用户指定的保护字段: {protected_fields}")
+                logger.debug(f"🛡️ 使用用户指定的保护字段: {protected_fields}")
             else:
                 # 自动检测图像生成工坊生成的内容
                 theme = request.current_config.get('theme', {})
@@ -970,7 +2403,7 @@ async def customize_calculator(request: CustomizationRequest) -> CalculatorConfi
                 if button.get('backgroundImage'):
                     protected_fields.append(f'button.{button.get("id", "unknown")}.backgroundImage')
                 
-                print(f"🛡️ 自动检测的保护字段: {protected_fields}")
+                logger.debug(f"🛡️ 自动检测的保护字段: {protected_fields}")
             
             if protected_fields:
                 workshop_protection_info = f"""
@@ -982,6 +2415,8 @@ async def customize_calculator(request: CustomizationRequest) -> CalculatorConfi
 AI设计师只能修改按钮功能逻辑，不能覆盖工坊生成的图像内容。
 """
         
+        protection = ProtectionPolicy(protected_fields)
+        
         # 分析对话历史和当前配置，确定设计继承策略
         conversation_context = ""
         current_config_info = ""
@@ -1054,18 +2489,21 @@ AI设计师只能修改按钮功能逻辑，不能覆盖工坊生成的图像内
 
 请严格按照用户需求生成配置JSON，不得超出要求范围。
 """
+        add_span("prompt", prompt_started)
 
         # 调用AI生成配置
-        model = get_current_model()
-        response = model.generate_content([
-            {"role": "user", "parts": [SYSTEM_PROMPT + "\n\n" + enhanced_user_prompt]}
-        ])
+        with span("gemini"):
+            model = get_current_model()
+            response = model.generate_content([
+                {"role": "user", "parts": [SYSTEM_PROMPT + "\n\n" + enhanced_user_prompt]}
+            ])
         
         # 解析AI响应
         response_text = response.text.strip()
-        print(f"📝 AI响应长度: {len(response_text)} 字符")
+        logger.debug(f"📝 AI响应长度: {len(response_text)} 字符")
         
         # 提取JSON配置
+        extract_started = time.perf_counter()
         if "```json" in response_text:
             json_start = response_text.find("```json") + 7
             json_end = response_text.find("```", json_start)
@@ -1079,160 +2517,44 @@ AI设计师只能修改按钮功能逻辑，不能覆盖工坊生成的图像内
             else:
                 config_json = response_text
         
-        print(f"🔍 提取的JSON长度: {len(config_json)} 字符")
-        print(f"🔍 JSON前100字符: {config_json[:100]}")
+        logger.debug(f"🔍 提取的JSON长度: {len(config_json)} 字符")
+        logger.debug(f"🔍 JSON前100字符: {config_json[:100]}")
         
         try:
             # AI现在应该返回完整的配置JSON
-            ai_generated_config = json.loads(config_json)
+            try:
+                ai_generated_config = json.loads(config_json)
+            finally:
+                add_span("extract", extract_started)
             if not isinstance(ai_generated_config, dict):
                 raise HTTPException(status_code=500, detail="AI未能生成有效的配置JSON")
             
             # 🧹 清理AI生成的格式问题（如渐变色格式）
-            ai_generated_config = clean_gradient_format(ai_generated_config)
+            with span("clean_gradient"):
+                ai_generated_config = clean_gradient_format(ai_generated_config)
             
-            # 🛡️ 图像生成工坊保护：优先保护字段，然后清理
-            if request.current_config and protected_fields:
-                final_config = copy.deepcopy(ai_generated_config)
-                current_theme = request.current_config.get('theme', {})
-                current_layout = request.current_config.get('layout', {})
-                current_app_background = request.current_config.get('appBackground', {})
-                
-                # 🎨 保护APP背景配置（优先级最高）- 字段级别保护
-                app_bg_fields = ['appBackground.backgroundImageUrl', 'appBackground.backgroundType', 
-                                'appBackground.backgroundColor', 'appBackground.backgroundGradient', 
-                                'appBackground.backgroundOpacity', 'appBackground.buttonOpacity',
-                                'appBackground.displayOpacity']
-                
-                # 检查是否有APP背景字段需要保护
-                protected_app_bg_fields = [field for field in app_bg_fields if field in protected_fields]
-                if protected_app_bg_fields:
-                    # 🔧 字段级别保护 - 确保AI生成的配置中有完整的appBackground
-                    if 'appBackground' not in final_config:
-                        final_config['appBackground'] = {}
-                    
-                    # 逐个保护字段
-                    for field in protected_app_bg_fields:
-                        field_name = field.split('.')[1]  # 去掉appBackground.前缀
-                        if field_name in current_app_background:
-                            final_config['appBackground'][field_name] = current_app_background[field_name]
-                            print(f"🛡️ 保护APP背景字段: {field} = {current_app_background[field_name]}")
-                
-                # 保护主题中的图像字段
-                if 'theme.backgroundImage' in protected_fields:
-                    final_config.setdefault('theme', {})['backgroundImage'] = current_theme.get('backgroundImage')
-                if 'theme.backgroundColor' in protected_fields:
-                    final_config.setdefault('theme', {})['backgroundColor'] = current_theme.get('backgroundColor')
-                if 'theme.backgroundGradient' in protected_fields:
-                    final_config.setdefault('theme', {})['backgroundGradient'] = current_theme.get('backgroundGradient')
-                if 'theme.backgroundPattern' in protected_fields:
-                    final_config.setdefault('theme', {})['backgroundPattern'] = current_theme.get('backgroundPattern')
-                    final_config.setdefault('theme', {})['patternColor'] = current_theme.get('patternColor')
-                    final_config.setdefault('theme', {})['patternOpacity'] = current_theme.get('patternOpacity')
-                
-                # 保护按钮中的背景图
-                current_buttons = {btn.get('id'): btn for btn in current_layout.get('buttons', [])}
-                final_buttons = final_config.get('layout', {}).get('buttons', [])
-                for button in final_buttons:
-                    button_id = button.get('id')
-                    if f'button.{button_id}.backgroundImage' in protected_fields:
-                        current_button = current_buttons.get(button_id, {})
-                        if current_button.get('backgroundImage'):
-                            button['backgroundImage'] = current_button['backgroundImage']
+            # 📇 当前配置的按键索引只构建一次，继承合并和保护恢复共用
+            with span("merge"):
+                current_index = ConfigIndex.from_config(request.current_config)
+            
+            if not request.current_config or protection:
+                # 没有当前配置时直接使用AI生成的配置；有受保护字段时在清理后统一恢复
+                final_config = ai_generated_config
             else:
-                # 如果没有当前配置，直接使用AI生成的配置
-                if not request.current_config:
-                    final_config = ai_generated_config
-                else:
-                    # 🔧 新的继承式合并策略：严格基于现有配置进行增量修改
-                    print("🔧 开始继承式配置合并...")
-                    final_config = copy.deepcopy(request.current_config)
-                    
-                    # 🔧 更新基本信息（如果AI修改了的话）
-                    if 'name' in ai_generated_config and ai_generated_config['name']:
-                        final_config['name'] = ai_generated_config['name']
-                    if 'description' in ai_generated_config and ai_generated_config['description']:
-                        final_config['description'] = ai_generated_config['description']
-                    
-                    # 🔧 智能合并主题更改（只合并AI实际修改的非空字段）
-                    if 'theme' in ai_generated_config and ai_generated_config['theme']:
-                        current_theme = final_config.setdefault('theme', {})
-                        ai_theme = ai_generated_config['theme']
-                        
-                        # 只更新AI实际输出的非空字段
-                        for key, value in ai_theme.items():
-                            if value is not None and value != "" and value != "无":
-                                current_theme[key] = value
-                                print(f"🔧 更新主题属性: {key} = {value}")
-                    
-                    # 🔧 智能合并布局更改（最关键的部分）
-                    if 'layout' in ai_generated_config and ai_generated_config['layout']:
-                        current_layout = final_config.setdefault('layout', {})
-                        ai_layout = ai_generated_config['layout']
-                        
-                        # 🔧 更新布局基本信息
-                        if 'rows' in ai_layout and ai_layout['rows']:
-                            current_layout['rows'] = ai_layout['rows']
-                        if 'columns' in ai_layout and ai_layout['columns']:
-                            current_layout['columns'] = ai_layout['columns']
-                        
-                        # 🔧 按键合并策略：保持现有按键ID，智能合并新按键
-                        if 'buttons' in ai_layout and ai_layout['buttons']:
-                            current_buttons = {btn['id']: btn for btn in current_layout.get('buttons', [])}
-                            ai_buttons = {btn['id']: btn for btn in ai_layout['buttons']}
-                            
-                            # 🔧 合并按键：现有按键保持不变，新按键添加进来
-                            merged_buttons = []
-                            
-                            # 1. 保持所有现有按键（可能被AI修改了某些属性）
-                            for btn_id, current_btn in current_buttons.items():
-                                if btn_id in ai_buttons:
-                                    # AI修改了该按键，合并修改
-                                    ai_btn = ai_buttons[btn_id]
-                                    merged_btn = copy.deepcopy(current_btn)
-                                    
-                                    # 只更新AI实际修改的字段
-                                    for key, value in ai_btn.items():
-                                        if key == 'id':
-                                            continue  # ID绝对不能改
-                                        if value is not None and value != "":
-                                            merged_btn[key] = value
-                                            print(f"🔧 更新按键{btn_id}属性: {key} = {value}")
-                                    
-                                    merged_buttons.append(merged_btn)
-                                else:
-                                    # AI没有修改该按键，保持原样
-                                    merged_buttons.append(current_btn)
-                            
-                            # 2. 添加AI新增的按键
-                            for btn_id, ai_btn in ai_buttons.items():
-                                if btn_id not in current_buttons:
-                                    merged_buttons.append(ai_btn)
-                                    print(f"🔧 添加新按键: {btn_id} - {ai_btn.get('label', '未知')}")
-                            
-                            current_layout['buttons'] = merged_buttons
-                            print(f"🔧 按键合并完成: {len(current_buttons)} 个现有 + {len(ai_buttons) - len(current_buttons)} 个新增 = {len(merged_buttons)} 个总计")
-                        
-                        # 其他布局字段只在非空时更新
-                        for key, value in ai_layout.items():
-                            if key not in ['buttons', 'rows', 'columns'] and value is not None and value != "":
-                                current_layout[key] = value
-                    
-                    # 🔧 合并APP背景配置（如果AI修改了的话）
-                    if 'appBackground' in ai_generated_config and ai_generated_config['appBackground']:
-                        current_app_bg = final_config.setdefault('appBackground', {})
-                        ai_app_bg = ai_generated_config['appBackground']
-                        
-                        # 只更新AI实际修改的非空字段
-                        for key, value in ai_app_bg.items():
-                            if value is not None and value != "":
-                                current_app_bg[key] = value
-                                print(f"🔧 更新APP背景属性: {key} = {value}")
-                    
-                    print("🔧 继承式配置合并完成")
+                # 🔧 继承式合并策略：严格基于现有配置进行增量修改
+                logger.debug("🔧 开始继承式配置合并...")
+                with span("merge"):
+                    final_config = merge_config(request.current_config, ai_generated_config, MERGE_PROFILES["inherit"],
+                                                current_index=current_index)
+                logger.debug("🔧 继承式配置合并完成")
             
             # 🧹 首先清理无效按键
-            final_config = clean_invalid_buttons(final_config)
+            with span("clean_buttons"):
+                final_config = clean_invalid_buttons(final_config)
+            
+            # 🔬 对表达式按键做冒烟测试（同步接口只记录异常）
+            with span("verify"):
+                verify_expression_buttons(final_config)
             
             # 🚀 优化：去掉二次核验环节以提升生成速度
             # fixed_config = await fix_calculator_config(
@@ -1241,97 +2563,156 @@ AI设计师只能修改按钮功能逻辑，不能覆盖工坊生成的图像内
             #     final_config # 传入清理并合并后的配置进行修复
             # )
             fixed_config = final_config  # 直接使用清理后的配置
-            print("🚀 已跳过二次核验环节，直接使用AI生成结果以提升速度")
+            logger.debug("🚀 已跳过二次核验环节，直接使用AI生成结果以提升速度")
             
-            # 🛡️ 重新应用保护逻辑（防止fix_calculator_config覆盖保护字段）
-            if request.current_config and protected_fields:
-                print(f"🛡️ 修复后重新应用保护逻辑: {protected_fields}")
-                current_theme = request.current_config.get('theme', {})
-                current_layout = request.current_config.get('layout', {})
-                current_app_background = request.current_config.get('appBackground', {})
-                
-                # 重新保护APP背景字段
-                app_bg_fields = ['appBackground.backgroundImageUrl', 'appBackground.backgroundType', 
-                                'appBackground.backgroundColor', 'appBackground.backgroundGradient', 
-                                'appBackground.backgroundOpacity', 'appBackground.buttonOpacity',
-                                'appBackground.displayOpacity']
-                
-                protected_app_bg_fields = [field for field in app_bg_fields if field in protected_fields]
-                if protected_app_bg_fields:
-                    if 'appBackground' not in fixed_config:
-                        fixed_config['appBackground'] = {}
-                    
-                    for field in protected_app_bg_fields:
-                        field_name = field.split('.')[1]
-                        if field_name in current_app_background:
-                            fixed_config['appBackground'][field_name] = current_app_background[field_name]
-                            print(f"🛡️ 重新保护APP背景字段: {field} = {current_app_background[field_name]}")
-                
-                # 重新保护主题字段
-                if 'theme.backgroundImage' in protected_fields:
-                    fixed_config.setdefault('theme', {})['backgroundImage'] = current_theme.get('backgroundImage')
-                if 'theme.backgroundColor' in protected_fields:
-                    fixed_config.setdefault('theme', {})['backgroundColor'] = current_theme.get('backgroundColor')
-                if 'theme.backgroundGradient' in protected_fields:
-                    fixed_config.setdefault('theme', {})['backgroundGradient'] = current_theme.get('backgroundGradient')
-                
-                # 重新保护按钮背景图
-                current_buttons = {btn.get('id'): btn for btn in current_layout.get('buttons', [])}
-                fixed_buttons = fixed_config.get('layout', {}).get('buttons', [])
-                for button in fixed_buttons:
-                    button_id = button.get('id')
-                    if f'button.{button_id}.backgroundImage' in protected_fields:
-                        current_button = current_buttons.get(button_id, {})
-                        if current_button.get('backgroundImage'):
-                            button['backgroundImage'] = current_button['backgroundImage']
-                            print(f"🛡️ 重新保护按钮背景图: button.{button_id}.backgroundImage")
-                
-                print("🛡️ 重新应用保护逻辑完成")
+            # 🛡️ 图像生成工坊保护：清理完成后一次性恢复受保护字段
+            if request.current_config and protection:
+                logger.debug(f"🛡️ 应用保护逻辑: {protection.fields}")
+                with span("merge"):
+                    fixed_config = merge_config(request.current_config, fixed_config, MERGE_PROFILES["protect"], protection,
+                                                current_index=current_index)
+                logger.debug("🛡️ 保护逻辑应用完成")
             
         except json.JSONDecodeError as e:
-            print(f"❌ JSON解析失败: {str(e)}")
-            print(f"📄 原始响应: {response_text[:500]}")
+            logger.error(f"❌ JSON解析失败: {str(e)}")
+            logger.debug(f"📄 原始响应: {response_text[:500]}")
             raise HTTPException(status_code=500, detail=f"AI生成的JSON格式无效: {str(e)}")
         
-        print("✅ AI响应处理和样式保护完成")
+        logger.debug("✅ AI响应处理和样式保护完成")
+        
+        if not request.use_image_refs:
+            with span("images"):
+                fixed_config = expand_image_refs(fixed_config)
         
         # 创建完整的配置对象
-        app_background_data = fixed_config.get('appBackground')
-        app_background = AppBackground(**app_background_data) if app_background_data else None
-        
-        config = CalculatorConfig(
-            id=f"calc_{int(time.time())}",
-            name=fixed_config.get('name', '自定义计算器'),
-            description=fixed_config.get('description', '由AI修复的计算器配置'),
-            theme=CalculatorTheme(**fixed_config.get('theme', {})),
-            layout=CalculatorLayout(**fixed_config.get('layout', {})),
-            version="1.0.0",
-            createdAt=datetime.now().isoformat(),
-            authorPrompt=request.user_input,
-            thinkingProcess=response_text if "思考过程" in response_text else None,
-            aiResponse=f"✅ 成功修复计算器配置",
-            appBackground=app_background
-        )
+        with span("validate"):
+            app_background_data = fixed_config.get('appBackground')
+            app_background = AppBackground(**app_background_data) if app_background_data else None
+            
+            config = CalculatorConfig(
+                id=f"calc_{int(time.time())}",
+                name=fixed_config.get('name', '自定义计算器'),
+                description=fixed_config.get('description', '由AI修复的计算器配置'),
+                theme=CalculatorTheme(**fixed_config.get('theme', {})),
+                layout=CalculatorLayout(**fixed_config.get('layout', {})),
+                version="1.0.0",
+                createdAt=datetime.now().isoformat(),
+                authorPrompt=request.user_input,
+                thinkingProcess=response_text if "思考过程" in response_text else None,
+                aiResponse=f"✅ 成功修复计算器配置",
+                appBackground=app_background
+            )
         
         return config
         
     except HTTPException:
         raise
     except Exception as e:
-        print(f"修复计算器配置时出错: {str(e)}")
+        logger.error(f"修复计算器配置时出错: {str(e)}")
         raise HTTPException(status_code=500, detail=f"修复计算器配置失败: {str(e)}")
 
-def remove_protected_fields_from_ai_output(config_dict: dict, protected_fields: list) -> dict:
+# 🔧 新增：写时复制配置 - 未修改的子树和字符串（含base64图像）与原配置共享，只复制被修改的路径
+class CopyOnWriteConfig:
+    """
+    读取直接访问原配置；写入前通过 writable(...) 取得可写节点，
+    沿途的字典/列表各只浅拷贝一次，原配置始终不被修改
+    """
+
+    def __init__(self, config: dict):
+        self.config = config
+        self._owned = {}  # id -> 已复制的节点（持有引用，避免id被复用）
+
+    def _own(self, node):
+        if id(node) in self._owned:
+            return node
+        copied = dict(node) if isinstance(node, dict) else list(node)
+        self._owned[id(copied)] = copied
+        return copied
+
+    def writable(self, *path):
+        """返回路径上的可写节点，例如 writable('layout', 'buttons', 3)"""
+        self.config = self._own(self.config)
+        node = self.config
+        for key in path:
+            child = node[key]
+            owned = self._own(child)
+            if owned is not child:
+                node[key] = owned
+            node = owned
+        return node
+
+    @property
+    def modified(self) -> bool:
+        return bool(self._owned)
+
+# 🔧 新增：受保护字段策略 - 编译为哈希集合，O(1) 判断字段是否受保护
+class ProtectionPolicy:
+    """
+    将 'theme.backgroundImage'、'button.{id}.backgroundImage'、'layout.buttons[{id}].backgroundImage'
+    等字符串路径编译为统一的元组集合，支持 'theme.*'、'button.*.field'、'button.{id}.*' 通配符
+    """
+    _BRACKET_BUTTON_PATH = re.compile(r'^layout\.buttons\[(.*)\]\.([^.\[\]]+)$')
+
+    def __init__(self, protected_fields: Optional[List[str]] = None):
+        self.fields = list(protected_fields or [])
+        self._paths = {self.normalize(field) for field in self.fields}
+
+    @classmethod
+    def normalize(cls, path: str) -> tuple:
+        """将两种按键路径写法统一为 ('button', id, field)，其余路径为 (section, field)"""
+        match = cls._BRACKET_BUTTON_PATH.match(path)
+        if match:
+            return ('button', match.group(1), match.group(2))
+        if path.startswith('button.'):
+            button_path = path[len('button.'):]
+            if '.' in button_path:
+                button_id, field = button_path.rsplit('.', 1)
+                return ('button', button_id, field)
+            return ('button', button_path, '*')
+        section, _, field = path.partition('.')
+        return (section, field or '*')
+
+    def is_protected(self, section: str, field: str) -> bool:
+        """判断 theme/appBackground 等区块中的字段是否受保护"""
+        paths = self._paths
+        return (section, field) in paths or (section, '*') in paths
+
+    def is_button_field_protected(self, button_id: str, field: str) -> bool:
+        """判断某个按键的字段是否受保护"""
+        paths = self._paths
+        return (
+            ('button', button_id, field) in paths
+            or ('button', '*', field) in paths
+            or ('button', button_id, '*') in paths
+            or ('button', '*', '*') in paths
+        )
+
+    def __contains__(self, path: str) -> bool:
+        normalized = self.normalize(path)
+        if normalized[0] == 'button':
+            return self.is_button_field_protected(normalized[1], normalized[2])
+        return self.is_protected(normalized[0], normalized[1])
+
+    def __bool__(self) -> bool:
+        return bool(self._paths)
+
+    def __len__(self) -> int:
+        return len(self.fields)
+
+def remove_protected_fields_from_ai_output(config_dict: dict, protected_fields) -> dict:
     """
     直接从AI输出中移除受保护的字段，确保AI设计师无法影响图像生成工坊的内容
+    protected_fields 可以是字段路径列表或已编译的 ProtectionPolicy
     """
     if not protected_fields:
         return config_dict
     
-    # 深拷贝配置以避免修改原始数据
-    cleaned_config = copy.deepcopy(config_dict)
+    protection = protected_fields if isinstance(protected_fields, ProtectionPolicy) else ProtectionPolicy(protected_fields)
+    
+    # 写时复制：只复制实际删除了字段的区块和按键，其余部分（包括图像数据）与原配置共享
+    writer = CopyOnWriteConfig(config_dict)
     
-    print(f"🛡️ 开始清理AI输出中的受保护字段: {protected_fields}")
+    logger.debug(f"🛡️ 开始清理AI输出中的受保护字段: {protection.fields}")
     
     # 🎨 清理APP背景中的受保护字段
     app_bg_protected_fields = [
@@ -1340,12 +2721,12 @@ def remove_protected_fields_from_ai_output(config_dict: dict, protected_fields:
         'parallaxEffect', 'parallaxIntensity', 'buttonOpacity', 'displayOpacity'
     ]
     
-    if 'appBackground' in cleaned_config:
+    if 'appBackground' in config_dict:
         for field in app_bg_protected_fields:
-            if f'appBackground.{field}' in protected_fields or 'appBackground.*' in protected_fields:
-                if field in cleaned_config['appBackground']:
-                    print(f"🧹 移除AI输出中的APP背景字段: appBackground.{field}")
-                    del cleaned_config['appBackground'][field]
+            if protection.is_protected('appBackground', field):
+                if field in config_dict['appBackground']:
+                    logger.debug(f"🧹 移除AI输出中的APP背景字段: appBackground.{field}")
+                    del writer.writable('appBackground')[field]
     
     # 清理主题中的受保护字段
     theme_protected_fields = [
@@ -1359,12 +2740,12 @@ def remove_protected_fields_from_ai_output(config_dict: dict, protected_fields:
         'buttonElevation', 'buttonShadowColors'
     ]
     
-    if 'theme' in cleaned_config:
+    if 'theme' in config_dict:
         for field in theme_protected_fields:
-            if f'theme.{field}' in protected_fields or 'theme.*' in protected_fields:
-                if field in cleaned_config['theme']:
-                    print(f"🧹 移除AI输出中的主题字段: theme.{field}")
-                    del cleaned_config['theme'][field]
+            if protection.is_protected('theme', field):
+                if field in config_dict['theme']:
+                    logger.debug(f"🧹 移除AI输出中的主题字段: theme.{field}")
+                    del writer.writable('theme')[field]
     
     # 清理按钮中的受保护字段
     button_protected_fields = [
@@ -1373,18 +2754,16 @@ def remove_protected_fields_from_ai_output(config_dict: dict, protected_fields:
         'gradientColors', 'backgroundPattern', 'patternColor'
     ]
     
-    if 'layout' in cleaned_config and 'buttons' in cleaned_config['layout']:
-        for button in cleaned_config['layout']['buttons']:
+    if 'layout' in config_dict and 'buttons' in config_dict['layout']:
+        for index, button in enumerate(config_dict['layout']['buttons']):
             button_id = button.get('id', 'unknown')
             for field in button_protected_fields:
-                field_path = f'button.{button_id}.{field}'
-                if field_path in protected_fields or f'button.*.{field}' in protected_fields:
-                    if field in button:
-                        print(f"🧹 移除AI输出中的按钮字段: {field_path}")
-                        del button[field]
+                if field in button and protection.is_button_field_protected(button_id, field):
+                    logger.debug(f"🧹 移除AI输出中的按钮字段: button.{button_id}.{field}")
+                    del writer.writable('layout', 'buttons', index)[field]
     
-    print(f"🛡️ 完成清理受保护字段")
-    return cleaned_config
+    logger.debug(f"🛡️ 完成清理受保护字段")
+    return writer.config
 
 def clean_gradient_format(config_dict: dict) -> dict:
     """清理AI生成的渐变色格式，将对象格式转换为数组格式"""
@@ -1431,191 +2810,465 @@ def clean_gradient_format(config_dict: dict) -> dict:
     
     return config_dict
 
-def merge_background_data(current_config: dict, generated_config: dict, protected_fields: list) -> dict:
-    """
-    强制合并现有配置中的背景图像数据到新生成的配置中，确保AI不会清空背景
-    """
-    if not current_config:
-        return generated_config
+# 🔧 新增：单次遍历的配置合并引擎 - 由声明式字段策略表驱动
+MERGE_INHERIT = "inherit"                    # 当前配置中存在该字段时，强制保留当前值
+MERGE_OVERRIDE = "override-if-non-empty"     # AI输出的值非空时覆盖当前值
+MERGE_PROTECT = "protect"                    # 字段受保护且当前配置中存在时，恢复当前值
+MERGE_FALLBACK = "fallback"                  # 优先使用AI输出的值，缺失时回退到当前值或默认值
+MERGE_KEEP = "keep"                          # 始终保留基础配置中的值（如按键ID、单独合并的按键列表）
+
+class FieldRule(NamedTuple):
+    policy: str
+    empty: tuple = (None, "")      # MERGE_OVERRIDE 视为空的取值
+    default: Any = None            # MERGE_FALLBACK 两边都缺失时的默认值
+    guard: Optional[str] = None    # MERGE_PROTECT 判断是否受保护所依据的字段，默认为字段本身
+    restore: str = "present"       # MERGE_PROTECT 何时恢复当前值：present 当前配置含该字段 / always 总是 / non-empty 当前值非空
+
+_FALSY = (None, "", 0, False)
+
+APP_BACKGROUND_FIELDS = [
+    'backgroundImageUrl', 'backgroundType', 'backgroundColor',
+    'backgroundGradient', 'backgroundOpacity', 'backgroundBlendMode',
+    'parallaxEffect', 'parallaxIntensity', 'buttonOpacity', 'displayOpacity'
+]
+
+THEME_BACKGROUND_FIELDS = [
+    'backgroundImage', 'backgroundColor', 'backgroundGradient',
+    'backgroundPattern', 'patternColor', 'patternOpacity'
+]
+
+# 有背景图的按键在任务接口中按此字段表重建，backgroundImage 始终取当前配置
+BUTTON_REBUILD_RULES = {
+    'id': FieldRule(MERGE_FALLBACK),
+    'label': FieldRule(MERGE_FALLBACK),
+    'action': FieldRule(MERGE_FALLBACK),
+    'gridPosition': FieldRule(MERGE_FALLBACK),
+    'type': FieldRule(MERGE_FALLBACK),
+    'customColor': FieldRule(MERGE_FALLBACK),
+    'isWide': FieldRule(MERGE_FALLBACK, default=False),
+    'widthMultiplier': FieldRule(MERGE_FALLBACK, default=1.0),
+    'heightMultiplier': FieldRule(MERGE_FALLBACK, default=1.0),
+    **{field: FieldRule(MERGE_FALLBACK) for field in [
+        'gradientColors', 'fontSize', 'borderRadius', 'elevation', 'width', 'height',
+        'backgroundColor', 'textColor', 'borderColor', 'borderWidth', 'shadowColor',
+        'shadowOffset', 'shadowRadius', 'opacity', 'rotation', 'scale',
+        'backgroundPattern', 'patternColor', 'patternOpacity', 'animation',
+        'animationDuration', 'customIcon', 'iconSize', 'iconColor',
+    ]},
+    'backgroundImage': FieldRule(MERGE_INHERIT),
+}
+
+# 合并方案：base 决定以哪份配置为基础；sections 中 '' 表示顶层字段，'*' 匹配区块内所有字段
+MERGE_PROFILES = {
+    # 同步接口存在受保护字段：以AI输出为基础，只恢复受保护的图像字段
+    "protect": {
+        "base": "generated",
+        "sections": {
+            "appBackground": {field: FieldRule(MERGE_PROTECT) for field in [
+                'backgroundImageUrl', 'backgroundType', 'backgroundColor', 'backgroundGradient',
+                'backgroundOpacity', 'buttonOpacity', 'displayOpacity'
+            ]},
+            "theme": {
+                'backgroundImage': FieldRule(MERGE_PROTECT, restore="always"),
+                'backgroundColor': FieldRule(MERGE_PROTECT, restore="always"),
+                'backgroundGradient': FieldRule(MERGE_PROTECT, restore="always"),
+                'backgroundPattern': FieldRule(MERGE_PROTECT, restore="always"),
+                'patternColor': FieldRule(MERGE_PROTECT, guard='backgroundPattern', restore="always"),
+                'patternOpacity': FieldRule(MERGE_PROTECT, guard='backgroundPattern', restore="always"),
+            },
+        },
+        "buttons": {'backgroundImage': FieldRule(MERGE_PROTECT, restore="non-empty")},
+    },
+    # 同步接口无受保护字段：以当前配置为基础，只合并AI实际输出的非空字段
+    "inherit": {
+        "base": "current",
+        "sections": {
+            "": {
+                'name': FieldRule(MERGE_OVERRIDE, empty=_FALSY),
+                'description': FieldRule(MERGE_OVERRIDE, empty=_FALSY),
+            },
+            "theme": {'*': FieldRule(MERGE_OVERRIDE, empty=(None, "", "无"))},
+            "layout": {
+                'rows': FieldRule(MERGE_OVERRIDE, empty=_FALSY),
+                'columns': FieldRule(MERGE_OVERRIDE, empty=_FALSY),
+                'buttons': FieldRule(MERGE_KEEP),
+                '*': FieldRule(MERGE_OVERRIDE),
+            },
+            "appBackground": {'*': FieldRule(MERGE_OVERRIDE)},
+        },
+        "buttons": {'id': FieldRule(MERGE_KEEP), '*': FieldRule(MERGE_OVERRIDE)},
+    },
+    # 任务接口：强制继承当前配置中的背景数据和按键背景图
+    "background": {
+        "base": "generated",
+        "ensure": ["theme", "appBackground", "layout"],
+        "sections": {
+            "appBackground": {field: FieldRule(MERGE_INHERIT) for field in APP_BACKGROUND_FIELDS},
+            "theme": {field: FieldRule(MERGE_INHERIT) for field in THEME_BACKGROUND_FIELDS},
+        },
+        "buttons": BUTTON_REBUILD_RULES,
+        "rebuild_image_buttons": True,
+    },
+}
+
+def _merge_fields(section: str, base: dict, current: dict, generated: dict, rules: dict,
+                  protection: Optional[ProtectionPolicy], button_id: Optional[str] = None) -> dict:
+    """按字段策略表合并一个区块，只复制被修改的字典"""
+    merged = base
     
-    print(f"🔧 开始强制合并背景数据，保护字段: {len(protected_fields)}")
-    
-    # 确保生成的配置有正确的结构
-    if 'theme' not in generated_config:
-        generated_config['theme'] = {}
-    if 'appBackground' not in generated_config:
-        generated_config['appBackground'] = {}
-    if 'layout' not in generated_config:
-        generated_config['layout'] = {}
-    if 'buttons' not in generated_config['layout']:
-        generated_config['layout']['buttons'] = []
-    
-    # 🔧 强制合并APP背景数据
-    current_app_bg = current_config.get('appBackground', {})
-    if current_app_bg:
-        generated_app_bg = generated_config['appBackground']
-        
-        # 强制保留所有背景相关字段
-        background_fields = [
-            'backgroundImageUrl', 'backgroundType', 'backgroundColor', 
-            'backgroundGradient', 'backgroundOpacity', 'backgroundBlendMode',
-            'parallaxEffect', 'parallaxIntensity', 'buttonOpacity', 'displayOpacity'
-        ]
-        
-        for field in background_fields:
-            if field in current_app_bg:
-                generated_app_bg[field] = current_app_bg[field]
-                print(f"🔧 强制保留APP背景字段: appBackground.{field}")
+    def assign(key, value):
+        nonlocal merged
+        if merged is base:
+            merged = dict(base)
+        merged[key] = value
     
-    # 🔧 强制合并主题背景数据
-    current_theme = current_config.get('theme', {})
-    if current_theme:
-        generated_theme = generated_config['theme']
-        
-        # 强制保留主题背景相关字段
-        theme_background_fields = [
-            'backgroundImage', 'backgroundColor', 'backgroundGradient',
-            'backgroundPattern', 'patternColor', 'patternOpacity'
-        ]
-        
-        for field in theme_background_fields:
-            if field in current_theme:
-                generated_theme[field] = current_theme[field]
-                print(f"🔧 强制保留主题背景字段: theme.{field}")
+    wildcard = rules.get('*')
+    if wildcard is not None and wildcard.policy == MERGE_OVERRIDE:
+        for key, value in generated.items():
+            if key not in rules and value not in wildcard.empty:
+                assign(key, value)
     
-    # 🔧 强制重新应用按键背景图 - 参考图像生成工坊逻辑
-    generated_config = force_reapply_button_background_images(current_config, generated_config)
+    for field, rule in rules.items():
+        if field == '*':
+            continue
+        if rule.policy == MERGE_OVERRIDE:
+            value = generated.get(field)
+            if value not in rule.empty:
+                assign(field, value)
+        elif rule.policy == MERGE_INHERIT:
+            if field in current:
+                assign(field, current[field])
+        elif rule.policy == MERGE_PROTECT:
+            guard = rule.guard or field
+            if button_id is not None:
+                is_protected = protection.is_button_field_protected(button_id, guard)
+            else:
+                is_protected = protection.is_protected(section, guard)
+            if not is_protected:
+                continue
+            if rule.restore == "always":
+                assign(field, current.get(field))
+            elif rule.restore == "non-empty":
+                if current.get(field):
+                    assign(field, current[field])
+            elif field in current:
+                assign(field, current[field])
     
-    print(f"✅ 背景数据强制合并完成")
-    return generated_config
-
-def force_reapply_button_background_images(current_config: dict, generated_config: dict) -> dict:
+    return merged
+
+def _rebuild_button(current_button: dict, generated_button: dict, rules: dict) -> dict:
+    """按字段表重建按键：AI输出优先，缺失时回退到当前按键，背景图强制继承"""
+    rebuilt = {}
+    for field, rule in rules.items():
+        if rule.policy == MERGE_INHERIT:
+            value = current_button.get(field)
+        else:
+            value = generated_button.get(field, current_button.get(field, rule.default))
+        if value is not None:
+            rebuilt[field] = value
+    return rebuilt
+
+def merge_config(current_config: dict, generated_config: dict, profile: dict,
+                 protection: Optional[ProtectionPolicy] = None,
+                 current_index: Optional["ConfigIndex"] = None) -> dict:
     """
-    强制重新应用按键背景图，参考图像生成工坊的实现逻辑
-    确保现有按键背景图在AI生成后100%保留
+    单次遍历合并当前配置和AI生成配置，取代原先的继承式合并、保护重应用和背景强制合并三轮处理
+    未修改的子树直接引用输入配置，不做深拷贝；current_index 为当前配置的按键索引，同一请求内可复用
     """
-    print(f"🔧 开始强制重新应用按键背景图")
+    if not current_config:
+        return generated_config
     
-    current_buttons = current_config.get('layout', {}).get('buttons', [])
-    generated_buttons = generated_config['layout']['buttons']
+    protection = protection or ProtectionPolicy()
+    current_index = current_index or ConfigIndex.from_config(current_config)
+    base_is_current = profile["base"] == "current"
+    base_config = current_config if base_is_current else generated_config
+    merged = dict(base_config)
     
-    # 创建现有按键的字典以便快速查找
-    current_buttons_dict = {btn.get('id', ''): btn for btn in current_buttons}
+    for key in profile.get("ensure", []):
+        if key not in merged:
+            merged[key] = {}
     
-    # 统计有背景图的按键
-    buttons_with_background = []
-    for btn in current_buttons:
-        btn_id = btn.get('id', '')
-        if btn.get('backgroundImage'):
-            buttons_with_background.append(btn_id)
+    for section, rules in profile["sections"].items():
+        if section == "":
+            merged = _merge_fields(section, merged, current_config, generated_config, rules, protection)
+            continue
+        
+        generated_section = generated_config.get(section) or {}
+        # 继承式合并只在AI实际输出该区块时进行
+        if base_is_current and not generated_section:
+            continue
+        current_section = current_config.get(section) or {}
+        base_section = merged.get(section)
+        if base_section is None:
+            base_section = {}
+        
+        merged_section = _merge_fields(section, base_section, current_section, generated_section, rules, protection)
+        if merged_section is not base_section or section not in merged:
+            merged[section] = merged_section
     
-    if not buttons_with_background:
-        print("🔧 没有发现需要保护的按键背景图")
-        return generated_config
+    merged_buttons = _merge_buttons(current_index, generated_config, merged, profile, protection)
+    if merged_buttons is not None:
+        layout = merged.get("layout")
+        merged["layout"] = dict(layout) if layout else {}
+        merged["layout"]["buttons"] = merged_buttons
     
-    print(f"🔧 发现 {len(buttons_with_background)} 个按键有背景图需要保护: {buttons_with_background}")
+    return merged
+
+def _merge_buttons(current_index: "ConfigIndex", generated_config: dict, merged: dict, profile: dict,
+                   protection: ProtectionPolicy) -> Optional[list]:
+    """按ID合并按键列表，返回None表示按键列表无需修改"""
+    rules = profile["buttons"]
+    generated_buttons = (generated_config.get("layout") or {}).get("buttons") or []
+    current_by_id = current_index.by_id
     
-    # 对每个生成的按键强制重新应用背景图
-    for i, generated_button in enumerate(generated_buttons):
-        button_id = generated_button.get('id', '')
-        
-        if button_id in current_buttons_dict:
-            current_button = current_buttons_dict[button_id]
-            
-            # 🔧 参考图像生成工坊 _updateButtonPattern 的逻辑
-            # 如果当前按键有背景图，强制重新应用
-            if current_button.get('backgroundImage'):
-                print(f"🔧 强制重新应用按键背景图: {button_id}")
-                
-                # 🔧 创建新的按键对象，确保所有属性都被正确保留
-                updated_button = {
-                    'id': generated_button.get('id', current_button.get('id')),
-                    'label': generated_button.get('label', current_button.get('label')),
-                    'action': generated_button.get('action', current_button.get('action')),
-                    'gridPosition': generated_button.get('gridPosition', current_button.get('gridPosition')),
-                    'type': generated_button.get('type', current_button.get('type')),
-                    'customColor': generated_button.get('customColor', current_button.get('customColor')),
-                    'isWide': generated_button.get('isWide', current_button.get('isWide', False)),
-                    'widthMultiplier': generated_button.get('widthMultiplier', current_button.get('widthMultiplier', 1.0)),
-                    'heightMultiplier': generated_button.get('heightMultiplier', current_button.get('heightMultiplier', 1.0)),
-                    'gradientColors': generated_button.get('gradientColors', current_button.get('gradientColors')),
-                    'fontSize': generated_button.get('fontSize', current_button.get('fontSize')),
-                    'borderRadius': generated_button.get('borderRadius', current_button.get('borderRadius')),
-                    'elevation': generated_button.get('elevation', current_button.get('elevation')),
-                    'width': generated_button.get('width', current_button.get('width')),
-                    'height': generated_button.get('height', current_button.get('height')),
-                    'backgroundColor': generated_button.get('backgroundColor', current_button.get('backgroundColor')),
-                    'textColor': generated_button.get('textColor', current_button.get('textColor')),
-                    'borderColor': generated_button.get('borderColor', current_button.get('borderColor')),
-                    'borderWidth': generated_button.get('borderWidth', current_button.get('borderWidth')),
-                    'shadowColor': generated_button.get('shadowColor', current_button.get('shadowColor')),
-                    'shadowOffset': generated_button.get('shadowOffset', current_button.get('shadowOffset')),
-                    'shadowRadius': generated_button.get('shadowRadius', current_button.get('shadowRadius')),
-                    'opacity': generated_button.get('opacity', current_button.get('opacity')),
-                    'rotation': generated_button.get('rotation', current_button.get('rotation')),
-                    'scale': generated_button.get('scale', current_button.get('scale')),
-                    'backgroundPattern': generated_button.get('backgroundPattern', current_button.get('backgroundPattern')),
-                    'patternColor': generated_button.get('patternColor', current_button.get('patternColor')),
-                    'patternOpacity': generated_button.get('patternOpacity', current_button.get('patternOpacity')),
-                    'animation': generated_button.get('animation', current_button.get('animation')),
-                    'animationDuration': generated_button.get('animationDuration', current_button.get('animationDuration')),
-                    'customIcon': generated_button.get('customIcon', current_button.get('customIcon')),
-                    'iconSize': generated_button.get('iconSize', current_button.get('iconSize')),
-                    'iconColor': generated_button.get('iconColor', current_button.get('iconColor')),
-                    # 🔧 最关键：强制保留背景图
-                    'backgroundImage': current_button.get('backgroundImage'),
-                }
-                
-                # 🔧 移除None值，保持配置清洁
-                updated_button = {k: v for k, v in updated_button.items() if v is not None}
-                
-                # 🔧 替换生成的按键
-                generated_buttons[i] = updated_button
-                
-                print(f"✅ 成功重新应用按键背景图: {button_id} -> {current_button.get('backgroundImage')[:50]}...")
+    if profile["base"] == "current":
+        # 现有按键保持原有顺序，AI修改的字段合并进来，新增按键追加到末尾
+        if not (generated_config.get("layout") and generated_buttons):
+            return None
+        generated_by_id = {btn.get('id', ''): btn for btn in generated_buttons}
+        merged_buttons = []
+        for btn_id, current_btn in current_by_id.items():
+            generated_btn = generated_by_id.get(btn_id)
+            if generated_btn is None:
+                merged_buttons.append(current_btn)
+            else:
+                merged_buttons.append(_merge_fields("button", current_btn, current_btn, generated_btn, rules, protection, btn_id))
+        for btn_id, generated_btn in generated_by_id.items():
+            if btn_id not in current_by_id:
+                merged_buttons.append(generated_btn)
+                logger.debug(f"🔧 添加新按键: {btn_id} - {generated_btn.get('label', '未知')}")
+        logger.debug(f"🔧 按键合并完成: {len(current_by_id)} 个现有 + {len(generated_by_id) - len(current_by_id)} 个新增 = {len(merged_buttons)} 个总计")
+        return merged_buttons
     
-    print(f"✅ 按键背景图强制重新应用完成")
-    return generated_config
+    if profile.get("rebuild_image_buttons"):
+        if not current_index.image_ids:
+            if "buttons" not in merged.get("layout", {}):
+                return []
+            return None
+        merged_buttons = []
+        for generated_btn in generated_buttons:
+            btn_id = generated_btn.get('id', '')
+            if btn_id in current_index.image_ids:
+                merged_buttons.append(_rebuild_button(current_by_id[btn_id], generated_btn, rules))
+                logger.debug(f"🔧 强制重新应用按键背景图: {btn_id}")
+            else:
+                merged_buttons.append(generated_btn)
+        return merged_buttons
+    
+    merged_buttons = []
+    changed = False
+    for generated_btn in generated_buttons:
+        btn_id = generated_btn.get('id')
+        merged_btn = _merge_fields("button", generated_btn, current_by_id.get(btn_id) or {}, generated_btn, rules, protection, btn_id)
+        changed = changed or merged_btn is not generated_btn
+        merged_buttons.append(merged_btn)
+    return merged_buttons if changed else None
+
+# 🔧 新增：按键网格占用索引 - 12行×10列，每行一个整数位掩码
+GRID_MAX_ROWS = 12
+GRID_MAX_COLUMNS = 10
+
+def _grid_int(value, default: int) -> int:
+    """AI或客户端给出的网格值可能是 2.0、"2" 等，统一转为整数，无法转换时使用默认值"""
+    try:
+        return int(value)
+    except (TypeError, ValueError, OverflowError):
+        return default
+
+def get_grid_cell(button: dict) -> tuple:
+    """读取按键的 (row, column, columnSpan)，缺失或无效时使用默认值"""
+    grid_pos = button.get("gridPosition")
+    if not isinstance(grid_pos, dict):
+        grid_pos = {}
+    span = max(_grid_int(grid_pos.get("columnSpan") or 1, 1), 1)
+    return _grid_int(grid_pos.get("row", 1), 1), _grid_int(grid_pos.get("column", 0), 0), span
+
+class GridOccupancy:
+    """按键网格占用位图，重叠、跨列检测和占位都是O(1)的位运算"""
+
+    def __init__(self):
+        # row 从1开始，下标0不使用
+        self._rows = [0] * (GRID_MAX_ROWS + 1)
+
+    @staticmethod
+    def in_bounds(row: int, column: int, span: int = 1) -> bool:
+        return 1 <= row <= GRID_MAX_ROWS and 0 <= column and span >= 1 and column + span <= GRID_MAX_COLUMNS
+
+    @staticmethod
+    def _mask(column: int, span: int) -> int:
+        return ((1 << span) - 1) << column
+
+    def is_free(self, row: int, column: int, span: int = 1) -> bool:
+        if not self.in_bounds(row, column, span):
+            return False
+        return not (self._rows[row] & self._mask(column, span))
+
+    def occupy(self, row: int, column: int, span: int = 1):
+        if self.in_bounds(row, column, span):
+            self._rows[row] |= self._mask(column, span)
+
+    def release(self, row: int, column: int, span: int = 1):
+        if self.in_bounds(row, column, span):
+            self._rows[row] &= ~self._mask(column, span)
+
+    def first_free(self, span: int = 1, start_row: int = 1, max_columns: int = GRID_MAX_COLUMNS) -> Optional[tuple]:
+        """从 start_row 开始按行优先查找第一个能容纳 span 列的空位，只在前 max_columns 列内查找，现有行满时落到新的一行"""
+        columns = min(max(max_columns, span), GRID_MAX_COLUMNS)
+        for row in range(max(start_row, 1), GRID_MAX_ROWS + 1):
+            occupied = self._rows[row]
+            for column in range(0, columns - span + 1):
+                if not occupied & self._mask(column, span):
+                    return row, column
+        return None
+
+# 🔧 新增：配置索引 - 每个请求构建一次，供保护、合并和清理阶段共享，按键增删时增量更新
+class ConfigIndex:
+    """按ID/网格位置索引按键，同时维护带背景图的按键、动作类型计数、label计数和布局边界"""
+
+    def __init__(self, buttons: Optional[list] = None):
+        self.by_id = {}           # id -> 按键（ID重复时后者覆盖前者）
+        self.by_cell = {}         # (row, column) -> 按键，跨列按键占用多个格子
+        self.image_ids = set()    # by_id 中带 backgroundImage 的按键ID
+        self.action_counts = {}   # action.type -> 数量
+        self.label_counts = {}    # label -> 数量
+        self.occupancy = GridOccupancy()
+        self._row_counts = {}
+        self._column_counts = {}
+        self._cell_counts = {}
+        for button in buttons or []:
+            self.add(button)
+
+    @classmethod
+    def from_config(cls, config: Optional[dict]) -> "ConfigIndex":
+        buttons = ((config or {}).get("layout") or {}).get("buttons") or []
+        return cls([button for button in buttons if isinstance(button, dict)])
+
+    @staticmethod
+    def _bump(counts: dict, key, delta: int):
+        value = counts.get(key, 0) + delta
+        if value > 0:
+            counts[key] = value
+        else:
+            counts.pop(key, None)
+
+    @staticmethod
+    def _action_type(button: dict):
+        action = button.get("action")
+        return action.get("type") if isinstance(action, dict) else None
+
+    def _track(self, button: dict, delta: int):
+        row, column, span = get_grid_cell(button)
+        self._bump(self.action_counts, self._action_type(button), delta)
+        self._bump(self.label_counts, button.get("label"), delta)
+        self._bump(self._row_counts, row, delta)
+        self._bump(self._column_counts, column, delta)
+        if not self.occupancy.in_bounds(row, column, span):
+            return
+        for cell_column in range(column, column + span):
+            cell = (row, cell_column)
+            self._bump(self._cell_counts, cell, delta)
+            if delta > 0:
+                self.by_cell[cell] = button
+                self.occupancy.occupy(row, cell_column)
+            else:
+                if self.by_cell.get(cell) is button:
+                    del self.by_cell[cell]
+                # 重叠的按键都移除后才释放格子
+                if cell not in self._cell_counts:
+                    self.occupancy.release(row, cell_column)
+
+    def add(self, button: dict):
+        button_id = button.get("id", "")
+        self.by_id[button_id] = button
+        if button.get("backgroundImage"):
+            self.image_ids.add(button_id)
+        else:
+            self.image_ids.discard(button_id)
+        self._track(button, 1)
+
+    def remove(self, button: dict):
+        button_id = button.get("id", "")
+        if self.by_id.get(button_id) is button:
+            del self.by_id[button_id]
+            self.image_ids.discard(button_id)
+        self._track(button, -1)
+
+    def has_action(self, action_type: str) -> bool:
+        return action_type in self.action_counts
+
+    def has_label(self, label) -> bool:
+        return label in self.label_counts
+
+    @property
+    def bounds(self) -> tuple:
+        """返回 (max_row, max_column)，没有按键时为 (1, 0)"""
+        return max([1, *self._row_counts]), max([0, *self._column_counts])
 
 def clean_invalid_buttons(config_dict: dict, preserve_button_ids: list = None) -> dict:
-    """清理无效按键，确保所有按键都有实际功能，同时保护现有按键"""
+    """
+    清理无效按键，确保所有按键都有实际功能，同时保护现有按键
+    不修改传入的配置：返回新的配置/布局，只有被修复或移动的按键会被复制，其余按键与原配置共享
+    """
     if "layout" not in config_dict or "buttons" not in config_dict["layout"]:
         return config_dict
     
     original_buttons = config_dict["layout"]["buttons"]
+    layout = dict(config_dict["layout"])
+    config_dict = {**config_dict, "layout": layout}
     valid_buttons = []
-    preserve_button_ids = preserve_button_ids or []
+    fixed_buttons = {}  # 原列表下标 -> 修复后的按键副本
+    preserve_button_ids = set(preserve_button_ids or [])
+    index = ConfigIndex()  # 只登记有效按键：位置占用、label、动作类型和布局边界
+    
+    logger.debug(f"🔍 开始清理无效按键，原始按键数量: {len(original_buttons)}")
+    logger.debug(f"🛡️ 需要保护的按键ID: {list(preserve_button_ids)}")
     
-    print(f"🔍 开始清理无效按键，原始按键数量: {len(original_buttons)}")
-    print(f"🛡️ 需要保护的按键ID: {preserve_button_ids}")
+    # 🛡️ 先登记现有按键的位置和label，新增按键不能抢占它们
+    for position, button in enumerate(original_buttons):
+        button_id = button.get("id", "")
+        if button_id not in preserve_button_ids:
+            continue
+        
+        logger.debug(f"🛡️ 保护现有按键: {button.get('label', '未知')} ({button_id})")
+        has_grid_position = isinstance(button.get("gridPosition"), dict) and button["gridPosition"]
+        if not button.get("label") or not button.get("action") or not has_grid_position:
+            button = fixed_buttons[position] = dict(button)
+        
+        # 对现有按键只做最基础的验证，尽量保留
+        if not button.get("label") or not button.get("action"):
+            # 尝试修复而不是删除
+            if not button.get("label"):
+                button["label"] = button_id.replace("btn_", "").upper()
+                logger.debug(f"🔧 修复按键label: {button_id} -> {button['label']}")
+            if not button.get("action"):
+                button["action"] = {"type": "input", "value": "0"}
+                logger.debug(f"🔧 修复按键action: {button_id}")
+        
+        # 确保现有按键有gridPosition
+        if not has_grid_position:
+            button["gridPosition"] = {"row": 1, "column": 0}
+            logger.debug(f"🔧 修复按键位置: {button_id}")
+        
+        index.add(button)
+    
+    # 📐 冲突按键只在布局现有列宽内重新安置，整行占满时向下新增一行而不是把键盘加宽
+    declared_columns = layout.get("columns")
+    if isinstance(declared_columns, int) and 1 <= declared_columns <= GRID_MAX_COLUMNS:
+        grid_columns = max(declared_columns, index.bounds[1] + 1)
+    elif index.by_cell:
+        grid_columns = index.bounds[1] + 1
+    else:
+        grid_columns = GRID_MAX_COLUMNS
     
-    for button in original_buttons:
+    for position, button in enumerate(original_buttons):
         # 检查按键是否有效
         is_valid = True
         invalid_reasons = []
         button_id = button.get("id", "")
         
-        # 🛡️ 特殊保护：如果是现有按键，只做基础验证
-        is_existing_button = button_id in preserve_button_ids
-        
-        if is_existing_button:
-            print(f"🛡️ 保护现有按键: {button.get('label', '未知')} ({button_id})")
-            # 对现有按键只做最基础的验证，尽量保留
-            if not button.get("label") or not button.get("action"):
-                # 尝试修复而不是删除
-                if not button.get("label"):
-                    button["label"] = button_id.replace("btn_", "").upper()
-                    print(f"🔧 修复按键label: {button_id} -> {button['label']}")
-                if not button.get("action"):
-                    button["action"] = {"type": "input", "value": "0"}
-                    print(f"🔧 修复按键action: {button_id}")
-            
-            # 确保现有按键有gridPosition
-            if not button.get("gridPosition"):
-                button["gridPosition"] = {"row": 1, "column": 0}
-                print(f"🔧 修复按键位置: {button_id}")
-            
-            valid_buttons.append(button)
+        # 🛡️ 特殊保护：现有按键已在上面完成基础验证
+        if button_id in preserve_button_ids:
+            valid_buttons.append(fixed_buttons.get(position, button))
             continue
         
         # 🔍 对新增按键进行严格验证
@@ -1636,102 +3289,251 @@ def clean_invalid_buttons(config_dict: dict, preserve_button_ids: list = None) -
             is_valid = False
             invalid_reasons.append("gridPosition无效")
         else:
-            row = grid_pos.get("row", 0)
-            col = grid_pos.get("column", 0)
+            row = _grid_int(grid_pos.get("row", 0), 0)
+            col = _grid_int(grid_pos.get("column", 0), 0)
             # 限制在合理范围内：最多12行×10列
-            if row < 1 or row > 12 or col < 0 or col > 9:
+            if row < 1 or row > GRID_MAX_ROWS or col < 0 or col >= GRID_MAX_COLUMNS:
                 is_valid = False
                 invalid_reasons.append(f"位置超出范围(row={row}, col={col})")
         
         # 检查是否重复
+        if is_valid and index.has_label(button.get("label")):
+            is_valid = False
+            invalid_reasons.append("重复按键")
+        
+        # 检查位置冲突（含跨列），冲突时自动移到第一个空位
         if is_valid:
-            # 检查是否已存在相同label的按键
-            existing_labels = [btn.get("label") for btn in valid_buttons]
-            if button.get("label") in existing_labels:
-                is_valid = False
-                invalid_reasons.append("重复按键")
+            row, col, span = get_grid_cell(button)
+            # 非整数的网格值（如 2.0、"2"）写回为整数
+            normalized = {**grid_pos, "row": row, "column": col}
+            if "columnSpan" in grid_pos:
+                normalized["columnSpan"] = span
+            if any(type(grid_pos.get(key)) is not int for key in normalized):
+                grid_pos = normalized
+                button = {**button, "gridPosition": grid_pos}
+            if not index.occupancy.is_free(row, col, span):
+                free_cell = index.occupancy.first_free(span, max_columns=grid_columns)
+                if free_cell is None:
+                    is_valid = False
+                    invalid_reasons.append("网格已满")
+                else:
+                    button = {**button, "gridPosition": {**grid_pos, "row": free_cell[0], "column": free_cell[1]}}
+                    logger.debug(f"🔧 按键位置冲突，移动 {button.get('label')} ({row},{col}) -> {free_cell}")
         
         if is_valid:
             valid_buttons.append(button)
+            index.add(button)
         else:
-            print(f"❌ 移除无效新增按键: {button.get('label', '未知')} - {', '.join(invalid_reasons)}")
+            logger.debug(f"❌ 移除无效新增按键: {button.get('label', '未知')} - {', '.join(invalid_reasons)}")
     
-    # 更新按键列表
-    config_dict["layout"]["buttons"] = valid_buttons
+    # 布局边界和动作类型已由索引增量维护
+    max_row, max_col = index.bounds
     
     # 更新rows和columns以适应实际按键
     if valid_buttons:
-        max_row = max(btn.get("gridPosition", {}).get("row", 1) for btn in valid_buttons)
-        max_col = max(btn.get("gridPosition", {}).get("column", 0) for btn in valid_buttons)
-        config_dict["layout"]["rows"] = max_row
-        config_dict["layout"]["columns"] = max_col + 1  # column是0-based
+        layout["rows"] = max_row
+        layout["columns"] = max_col + 1  # column是0-based
     
-    print(f"✅ 按键清理完成，有效按键数量: {len(valid_buttons)}")
+    logger.debug(f"✅ 按键清理完成，有效按键数量: {len(valid_buttons)}")
     
     # 🚨 多参数函数必需按键检测与自动添加
-    has_multi_param_functions = any(
-        btn.get("action", {}).get("type") == "multiParamFunction" 
-        for btn in valid_buttons
-    )
-    
-    if has_multi_param_functions:
-        print("🔍 检测到多参数函数，检查是否需要添加逗号和执行按键")
-        
-        # 检查是否已存在逗号分隔符和执行按键
-        has_comma = any(
-            btn.get("action", {}).get("type") == "parameterSeparator"
-            for btn in valid_buttons
-        )
-        has_execute = any(
-            btn.get("action", {}).get("type") == "functionExecute"
-            for btn in valid_buttons
-        )
+    if index.has_action("multiParamFunction"):
+        logger.debug("🔍 检测到多参数函数，检查是否需要添加逗号和执行按键")
         
-        # 计算下一个可用位置
-        if valid_buttons:
-            max_row = max(btn.get("gridPosition", {}).get("row", 1) for btn in valid_buttons)
-            max_col = max(btn.get("gridPosition", {}).get("column", 0) for btn in valid_buttons)
-        else:
-            max_row = 5
-            max_col = 3
-        
-        # 自动添加缺失的按键
-        if not has_comma:
-            comma_button = {
+        auto_buttons = []
+        if not index.has_action("parameterSeparator"):
+            auto_buttons.append({
                 "id": "btn_comma_auto",
                 "label": ",",
                 "action": {"type": "parameterSeparator"},
-                "gridPosition": {"row": max_row + 1, "column": max_col},
                 "type": "secondary"
-            }
-            valid_buttons.append(comma_button)
-            print("✅ 自动添加逗号分隔符按键")
-            max_col += 1
-        
-        if not has_execute:
-            execute_button = {
+            })
+        if not index.has_action("functionExecute"):
+            auto_buttons.append({
                 "id": "btn_execute_auto", 
                 "label": "执行",
                 "action": {"type": "functionExecute"},
-                "gridPosition": {"row": max_row + 1, "column": max_col},
                 "type": "operator"
-            }
-            valid_buttons.append(execute_button)
-            print("✅ 自动添加执行按键")
+            })
+        
+        # 优先使用最后一行的空位，最后一行已满时扩展到新行，不加宽布局
+        auto_columns = max(grid_columns, max_col + 1)
+        for auto_button in auto_buttons:
+            free_cell = index.occupancy.first_free(start_row=max_row, max_columns=auto_columns)
+            if free_cell is None:
+                logger.warning(f"⚠️ 网格已满，无法自动添加按键: {auto_button['id']}")
+                continue
+            auto_button["gridPosition"] = {"row": free_cell[0], "column": free_cell[1]}
+            valid_buttons.append(auto_button)
+            index.add(auto_button)
+            max_row, max_col = index.bounds
+            logger.debug(f"✅ 自动添加按键 {auto_button['id']} 到位置 {free_cell}")
         
         # 更新布局尺寸
-        if valid_buttons:
-            max_row = max(btn.get("gridPosition", {}).get("row", 1) for btn in valid_buttons)
-            max_col = max(btn.get("gridPosition", {}).get("column", 0) for btn in valid_buttons)
-            config_dict["layout"]["rows"] = max_row
-            config_dict["layout"]["columns"] = max_col + 1
-            print(f"📐 更新布局尺寸: {max_row}行 × {max_col + 1}列")
+        if auto_buttons:
+            layout["rows"] = max_row
+            layout["columns"] = max_col + 1
+            logger.debug(f"📐 更新布局尺寸: {max_row}行 × {max_col + 1}列")
     
     # 更新最终按键列表
-    config_dict["layout"]["buttons"] = valid_buttons
-    
+    layout["buttons"] = valid_buttons
+
     return config_dict
 
+# 🔧 新增：表达式按键冒烟测试 - 在固定采样网格上一次性向量化求值
+EXPRESSION_SAMPLE_POINTS = (-1000.0, -100.0, -10.0, -2.5, -1.0, -0.5, 0.0, 0.5, 1.0, 2.0, 2.5, 10.0, 45.0, 100.0, 1000.0)
+
+# 表达式函数名 -> numpy函数名（factorial 单独实现）
+EXPRESSION_FUNCTIONS = {
+    "sin": "sin", "cos": "cos", "tan": "tan",
+    "asin": "arcsin", "acos": "arccos", "atan": "arctan",
+    "sinh": "sinh", "cosh": "cosh", "tanh": "tanh",
+    "log": "log", "ln": "log", "log10": "log10", "log2": "log2",
+    "exp": "exp", "sqrt": "sqrt", "cbrt": "cbrt", "abs": "abs",
+    "pow": "power", "floor": "floor", "ceil": "ceil", "round": "round",
+    "factorial": None,
+}
+
+EXPRESSION_CONSTANTS = {"pi": math.pi, "e": math.e}
+
+def _np_factorial(values):
+    """向量化阶乘，负数和超大输入返回NaN/inf"""
+    import numpy as np
+    return np.array([math.gamma(v + 1) if -1 < v < 171 else (math.inf if v >= 171 else math.nan) for v in values])
+
+@lru_cache(maxsize=None)
+def expression_namespace() -> dict:
+    """表达式求值用的名字空间（采样网格 x、numpy函数和常量），首次冒烟测试时才导入numpy"""
+    import numpy as np
+    functions = {
+        name: getattr(np, numpy_name) if numpy_name else _np_factorial
+        for name, numpy_name in EXPRESSION_FUNCTIONS.items()
+    }
+    return {"x": np.array(EXPRESSION_SAMPLE_POINTS), **functions, **EXPRESSION_CONSTANTS}
+
+# 进制转换类表达式在客户端以字符串形式显示，不参与数值检测
+NON_NUMERIC_EXPRESSION_FUNCTIONS = {
+    "dec2bin", "dec2oct", "dec2hex", "bin2dec", "oct2dec", "hex2dec",
+    "dectobin", "dectooct", "dectohex", "bintodec", "octtodec", "hextodec",
+}
+
+_ALLOWED_EXPRESSION_NODES = (
+    ast.Expression, ast.BinOp, ast.UnaryOp, ast.Call, ast.Name, ast.Load, ast.Constant,
+    ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Pow, ast.Mod, ast.USub, ast.UAdd,
+)
+
+@lru_cache(maxsize=512)
+def compile_button_expression(expression: str):
+    """将按键表达式编译为可在numpy数组上求值的代码对象，不支持的语法抛出ValueError"""
+    source = expression.strip().replace("^", "**").replace("×", "*").replace("÷", "/")
+    # x! → factorial(x)
+    source = re.sub(r"(\w+|\([^()]*\))!", r"factorial(\1)", source)
+
+    tree = ast.parse(source, mode="eval")
+    for node in ast.walk(tree):
+        if not isinstance(node, _ALLOWED_EXPRESSION_NODES):
+            raise ValueError(f"不支持的语法: {type(node).__name__}")
+        if isinstance(node, ast.Call):
+            if not isinstance(node.func, ast.Name) or node.keywords:
+                raise ValueError("不支持的函数调用")
+            if node.func.id not in EXPRESSION_FUNCTIONS:
+                raise ValueError(f"未知函数: {node.func.id}")
+        elif isinstance(node, ast.Name) and node.id not in EXPRESSION_FUNCTIONS \
+                and node.id not in EXPRESSION_CONSTANTS and node.id != "x":
+            raise ValueError(f"未知变量: {node.id}")
+        elif isinstance(node, ast.Constant):
+            if not isinstance(node.value, (int, float)):
+                raise ValueError("表达式只允许数值常量")
+            # 整数常量转为浮点，避免 9**9**9 之类的大整数运算阻塞
+            node.value = float(node.value)
+
+    return compile(tree, "<expression>", "eval")
+
+def verify_expression_buttons(config_dict: dict) -> dict:
+    """
+    对配置中的expression按键进行冒烟测试：在固定采样网格上批量求值，
+    标记全部为NaN/inf或输出恒定的按键，返回逐按键健康报告
+    """
+    import numpy as np
+    start_time = time.perf_counter()
+    buttons = config_dict.get("layout", {}).get("buttons", [])
+    namespace = expression_namespace()
+    sample_shape = namespace["x"].shape
+
+    report = []
+    evaluated_rows = []
+    evaluated_entries = []
+
+    with np.errstate(all="ignore"):
+        for button in buttons:
+            action = button.get("action") or {}
+            if action.get("type") != "expression":
+                continue
+
+            expression = str(action.get("expression") or action.get("value") or "")
+            entry = {
+                "id": button.get("id", ""),
+                "label": button.get("label", ""),
+                "expression": expression,
+                "status": "ok",
+                "finite_ratio": None,
+                "message": "",
+            }
+            report.append(entry)
+
+            if not expression:
+                entry["status"] = "error"
+                entry["message"] = "表达式为空"
+                continue
+            if any(name in expression for name in NON_NUMERIC_EXPRESSION_FUNCTIONS):
+                entry["status"] = "skipped"
+                entry["message"] = "进制转换表达式不做数值检测"
+                continue
+
+            try:
+                code = compile_button_expression(expression)
+                values = eval(code, {"__builtins__": {}}, dict(namespace))
+                values = np.broadcast_to(np.asarray(values, dtype=float), sample_shape)
+            except Exception as e:
+                entry["status"] = "error"
+                entry["message"] = f"表达式无法求值: {e}"
+                continue
+
+            evaluated_rows.append(values)
+            evaluated_entries.append(entry)
+
+        # 一次性对所有表达式的采样结果做向量化检查
+        if evaluated_rows:
+            matrix = np.vstack(evaluated_rows)
+            finite = np.isfinite(matrix)
+            finite_ratio = finite.mean(axis=1)
+            masked = np.where(finite, matrix, np.nan)
+            has_finite = finite.any(axis=1)
+            spread = np.zeros(len(evaluated_rows))
+            spread[has_finite] = np.nanmax(masked[has_finite], axis=1) - np.nanmin(masked[has_finite], axis=1)
+
+            for i, entry in enumerate(evaluated_entries):
+                entry["finite_ratio"] = round(float(finite_ratio[i]), 3)
+                if not has_finite[i]:
+                    entry["status"] = "nan"
+                    entry["message"] = "所有采样点结果均为NaN或无穷大"
+                elif spread[i] == 0:
+                    entry["status"] = "constant"
+                    entry["message"] = "所有采样点输出相同，表达式可能与输入无关"
+
+    flagged = [entry for entry in report if entry["status"] in ("nan", "constant", "error")]
+    duration_ms = (time.perf_counter() - start_time) * 1000
+
+    if flagged:
+        logger.warning(f"⚠️ 表达式按键冒烟测试发现 {len(flagged)} 个异常按键: {[entry['id'] for entry in flagged]}")
+
+    return {
+        "checked": len(report),
+        "flagged": len(flagged),
+        "duration_ms": round(duration_ms, 3),
+        "buttons": report,
+    }
+
 async def fix_calculator_config(user_input: str, current_config: dict, generated_config: dict) -> dict:
     """AI二次校验和修复生成的计算器配置"""
     try:
@@ -1741,12 +3543,11 @@ async def fix_calculator_config(user_input: str, current_config: dict, generated
             if not config:
                 return config
                 
-            cleaned = json.loads(json.dumps(config))  # 深拷贝
-            
-            # 移除base64图像数据
+            # 移除base64图像数据：只重建包含图像的字典/列表，其余子树直接共享，无需整体深拷贝
             def remove_base64_images(obj):
                 if isinstance(obj, dict):
-                    for key, value in list(obj.items()):
+                    replaced = None
+                    for key, value in obj.items():
                         if isinstance(value, str) and (
                             key.endswith('Image') or 
                             key.endswith('ImageUrl') or 
@@ -1756,16 +3557,23 @@ async def fix_calculator_config(user_input: str, current_config: dict, generated
                             value.startswith('data:image/') or 
                             len(value) > 1000  # 超过1000字符的可能是base64
                         ):
-                            obj[key] = f"[图像数据已省略-长度:{len(value)}字符]"
+                            new_value = f"[图像数据已省略-长度:{len(value)}字符]"
                         elif isinstance(value, (dict, list)):
-                            remove_base64_images(value)
-                elif isinstance(obj, list):
-                    for item in obj:
-                        if isinstance(item, (dict, list)):
-                            remove_base64_images(item)
+                            new_value = remove_base64_images(value)
+                        else:
+                            continue
+                        if new_value is not value:
+                            if replaced is None:
+                                replaced = dict(obj)
+                            replaced[key] = new_value
+                    return obj if replaced is None else replaced
+                if isinstance(obj, list):
+                    items = [remove_base64_images(item) for item in obj]
+                    if any(new is not old for new, old in zip(items, obj)):
+                        return items
+                return obj
             
-            remove_base64_images(cleaned)
-            return cleaned
+            return remove_base64_images(config)
         
         # 清理配置数据
         clean_current = clean_config_for_ai(current_config) if current_config else None
@@ -1794,7 +3602,7 @@ async def fix_calculator_config(user_input: str, current_config: dict, generated
 直接返回修正后的完整JSON配置。
 """
 
-        print(f"🔧 修复上下文长度: {len(fix_context)} 字符")
+        logger.debug(f"🔧 修复上下文长度: {len(fix_context)} 字符")
 
         # 调用AI进行修复
         model = get_current_model()
@@ -1804,7 +3612,7 @@ async def fix_calculator_config(user_input: str, current_config: dict, generated
         
         # 解析修复后的配置
         fix_text = response.text.strip()
-        print(f"🔧 AI修复响应长度: {len(fix_text)} 字符")
+        logger.debug(f"🔧 AI修复响应长度: {len(fix_text)} 字符")
         
         # 提取JSON
         if "```json" in fix_text:
@@ -1819,7 +3627,7 @@ async def fix_calculator_config(user_input: str, current_config: dict, generated
                 fixed_json = fix_text[json_start:json_end+1]
             else:
                 # 如果找不到JSON，返回原配置
-                print("⚠️ AI修复未返回有效JSON，使用原配置")
+                logger.warning("⚠️ AI修复未返回有效JSON，使用原配置")
                 return generated_config
         
         try:
@@ -1845,7 +3653,7 @@ async def fix_calculator_config(user_input: str, current_config: dict, generated
                             ):
                                 # 恢复原始图像数据
                                 fixed_obj[key] = original_value
-                                print(f"🔧 恢复图像数据字段: {key}")
+                                logger.debug(f"🔧 恢复图像数据字段: {key}")
                             elif isinstance(original_value, dict) and key in fixed_obj:
                                 restore_images(fixed_obj[key], original_value)
                             elif isinstance(original_value, list) and key in fixed_obj and isinstance(fixed_obj[key], list):
@@ -1857,21 +3665,402 @@ async def fix_calculator_config(user_input: str, current_config: dict, generated
             restore_image_data(fixed_config, current_config)
             restore_image_data(fixed_config, generated_config)
             
-            print("✅ AI修复成功，图像数据已恢复")
+            logger.info("✅ AI修复成功，图像数据已恢复")
             return fixed_config
         except json.JSONDecodeError as e:
-            print(f"❌ AI修复的JSON格式无效: {str(e)}")
+            logger.error(f"❌ AI修复的JSON格式无效: {str(e)}")
             return generated_config
         
     except Exception as e:
-        print(f"AI修复过程中出错: {str(e)}")
+        logger.error(f"AI修复过程中出错: {str(e)}")
         return generated_config
 
+# 🔧 新增：背景预设资源 - 每个预设只生成一次，原图、全尺寸背景图和预览图都存入图像库
+BACKGROUND_PRESETS = [
+    {
+        "id": "modern_gradient",
+        "name": "现代渐变",
+        "description": "简洁的渐变背景，适合现代风格",
+        "prompt": "modern gradient background with subtle geometric patterns",
+        "style": "modern",
+        "theme": "calculator",
+        "preview_url": "https://via.placeholder.com/300x500/4A90E2/FFFFFF?text=Modern+Gradient"
+    },
+    {
+        "id": "tech_circuit",
+        "name": "科技电路",
+        "description": "科技感电路板背景，适合数字风格",
+        "prompt": "futuristic circuit board pattern with neon accents",
+        "style": "cyberpunk",
+        "theme": "tech",
+        "preview_url": "https://via.placeholder.com/300x500/0F0F23/00FF88?text=Tech+Circuit"
+    },
+    {
+        "id": "minimal_abstract",
+        "name": "极简抽象",
+        "description": "简约抽象几何图形背景",
+        "prompt": "minimal abstract geometric shapes with soft colors",
+        "style": "minimal",
+        "theme": "abstract",
+        "preview_url": "https://via.placeholder.com/300x500/F5F5F5/333333?text=Minimal+Abstract"
+    },
+    {
+        "id": "nature_calm",
+        "name": "自然宁静",
+        "description": "自然风景背景，营造宁静氛围",
+        "prompt": "calm nature landscape with soft lighting",
+        "style": "realistic",
+        "theme": "nature",
+        "preview_url": "https://via.placeholder.com/300x500/87CEEB/FFFFFF?text=Nature+Calm"
+    },
+    {
+        "id": "dark_professional",
+        "name": "专业深色",
+        "description": "专业的深色背景，适合商务使用",
+        "prompt": "professional dark background with subtle texture",
+        "style": "professional",
+        "theme": "calculator",
+        "preview_url": "https://via.placeholder.com/300x500/1A1A1A/FFFFFF?text=Dark+Professional"
+    }
+]
+BACKGROUND_PRESETS_DIR = os.path.join(IMAGES_DIR, "presets")
+os.makedirs(BACKGROUND_PRESETS_DIR, exist_ok=True)
+BACKGROUND_PRESET_SIZE = "1080x1920"
+BACKGROUND_PRESET_PREVIEW_SIZE = "300x500"
+BACKGROUND_PRESET_WARMUP = os.getenv("BACKGROUND_PRESET_WARMUP", "false").lower() in ("1", "true", "yes")
+BACKGROUND_PRESETS_CACHE_CONTROL = "public, max-age=86400"
+# 生成失败的预设按指数退避重试（配额不足、密钥无效时不会反复打满上游）
+BACKGROUND_PRESET_RETRY_BASE_SECONDS = 60
+BACKGROUND_PRESET_RETRY_MAX_SECONDS = 3600
+
+def _normalize_preset_prompt(prompt: Optional[str]) -> str:
+    return " ".join((prompt or "").split()).lower()
+
+# (提示词, 风格, 主题) -> 预设，generate-app-background 用它识别"选择了某个预设"的请求
+BACKGROUND_PRESET_INDEX = {
+    (_normalize_preset_prompt(preset["prompt"]), preset["style"], preset["theme"]): preset
+    for preset in BACKGROUND_PRESETS
+}
+
+class BackgroundPresetAssets:
+    """每个预设一个 <id>.json 清单：{key, original, full, preview}，预设定义变化后 key 不匹配即视为未生成"""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(preset: dict) -> str:
+        raw = json.dumps([preset["prompt"], preset["style"], preset["theme"], BACKGROUND_PRESET_SIZE,
+                          BACKGROUND_PRESET_PREVIEW_SIZE, IMAGE_OUTPUT_FORMAT, IMAGE_OUTPUT_QUALITY])
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def get(self, preset: dict) -> Optional[dict]:
+        with self._lock:
+            assets = self._entries.get(preset["id"])
+        if assets is None:
+            try:
+                with open(os.path.join(self.directory, f"{preset['id']}.json"), 'r', encoding='utf-8') as f:
+                    assets = json.load(f)
+            except (OSError, ValueError):
+                return None
+        if assets.get("key") != self.key(preset):
+            return None
+        if not all(image_store.path(assets.get(name) or "") for name in ("original", "full", "preview")):
+            return None
+        with self._lock:
+            self._entries[preset["id"]] = assets
+        return assets
+
+    def put(self, preset: dict, assets: dict):
+        assets = {**assets, "key": self.key(preset)}
+        path = os.path.join(self.directory, f"{preset['id']}.json")
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(assets, f)
+        os.replace(temp_path, path)
+        with self._lock:
+            self._entries[preset["id"]] = assets
+
+background_preset_assets = BackgroundPresetAssets(BACKGROUND_PRESETS_DIR)
+_background_preset_warmup_lock = threading.Lock()
+_background_preset_failures = {}  # 预设ID -> {"failures": 连续失败次数, "retry_after": 时间戳, "error": 最近错误}
+
+def background_preset_retry_after(preset: dict) -> Optional[float]:
+    """预设仍在退避期内时返回可重试的时间戳，否则返回None"""
+    failure = _background_preset_failures.get(preset["id"])
+    if failure and failure["retry_after"] > time.time():
+        return failure["retry_after"]
+    return None
+
+def record_background_preset_failure(preset: dict, error: Exception):
+    failures = _background_preset_failures.get(preset["id"], {}).get("failures", 0) + 1
+    delay = min(BACKGROUND_PRESET_RETRY_BASE_SECONDS * 2 ** (failures - 1), BACKGROUND_PRESET_RETRY_MAX_SECONDS)
+    _background_preset_failures[preset["id"]] = {
+        "failures": failures, "retry_after": time.time() + delay, "error": str(error),
+    }
+    return delay
+
+def preset_request_data(preset: dict) -> Dict[str, Any]:
+    return {"prompt": preset["prompt"], "style": preset["style"], "theme": preset["theme"],
+            "size": BACKGROUND_PRESET_SIZE, "quality": "high"}
+
+def render_background_preset(preset: dict) -> dict:
+    """生成一个预设的原图，并预先生成全尺寸背景图和预览图两个衍生图"""
+    prompt, _ = build_app_background_prompt(preset_request_data(preset))
+    generated_image = generate_image_content(prompt)
+    if not generated_image:
+        raise Exception(f"未能生成预设背景图: {preset['id']}")
+    image_bytes, mime_type = generated_image
+    assets = {
+        "original": image_store.put(image_bytes, mime_type),
+        "full": image_store.put(*optimize_generated_image(image_bytes, mime_type, BACKGROUND_PRESET_SIZE)),
+        "preview": image_store.put(*optimize_generated_image(image_bytes, mime_type, BACKGROUND_PRESET_PREVIEW_SIZE)),
+    }
+    background_preset_assets.put(preset, assets)
+    return assets
+
+def warm_background_presets():
+    """依次生成尚未生成且不在退避期内的预设，同一时间只有一个预热任务"""
+    if not _background_preset_warmup_lock.acquire(blocking=False):
+        return
+    try:
+        for preset in BACKGROUND_PRESETS:
+            if background_preset_assets.get(preset) or background_preset_retry_after(preset):
+                continue
+            try:
+                start_time = time.time()
+                render_background_preset(preset)
+                _background_preset_failures.pop(preset["id"], None)
+                logger.info(f"🖼️ 背景预设已生成: {preset['id']}，耗时: {time.time() - start_time:.2f}秒")
+            except Exception as e:
+                delay = record_background_preset_failure(preset, e)
+                logger.warning(f"⚠️ 背景预设生成失败: {preset['id']} - {e}，{delay}秒内不再重试")
+    finally:
+        _background_preset_warmup_lock.release()
+
+def start_background_preset_warmup() -> bool:
+    """在后台线程中补齐预设，已有预热任务在运行时返回False"""
+    if _background_preset_warmup_lock.locked():
+        return False
+    threading.Thread(target=warm_background_presets, name="background-preset-warmup", daemon=True).start()
+    return True
+
+def find_background_preset(request_data: Dict[str, Any]) -> Optional[tuple]:
+    """请求与某个已生成的预设一致时返回 ((bytes, mime_type), 附加字段)，否则返回None"""
+    preset = BACKGROUND_PRESET_INDEX.get((
+        _normalize_preset_prompt(request_data.get("prompt")), request_data.get("style"), request_data.get("theme")
+    ))
+    assets = background_preset_assets.get(preset) if preset else None
+    cached_image = image_store.get(assets["original"]) if assets else None
+    record_cache("background_preset", cached_image is not None)
+    if not cached_image:
+        return None
+    return cached_image, {"preset_id": preset["id"], "cached": True}
+
+@app.on_event("startup")
+async def warm_background_presets_on_startup():
+    if BACKGROUND_PRESET_WARMUP:
+        start_background_preset_warmup()
+
+# 🔧 新增：统一图像生成流水线 - 各类图像只提供提示词构建器和结果字段，
+# 限流、调用、提取、后处理、存储阶段共用，并逐阶段计时
+IMAGE_PIPELINE_STAGES = ("prompt", "lookup", "limit", "call", "extract", "post_process", "store")
+
+class ImageKind(NamedTuple):
+    label: str          # 日志和错误信息中的名称
+    url_field: str      # 结果中图像地址的字段名
+    build: Any          # build(request_data) -> (提示词, 附加到结果的字段)
+    include_data: bool = True  # 是否额外返回 image_data
+    lookup: Any = None  # lookup(request_data) -> ((bytes, mime_type), 附加字段)，命中时跳过上游生成
+
+def build_image_prompt(request_data: Dict[str, Any]) -> tuple:
+    """通用图像：强调明亮鲜艳的颜色"""
+    prompt = f"""
+        Generate a high-quality image for calculator theme:
+        {request_data.get("prompt")}
+        
+        Style: {request_data.get("style")}
+        Requirements:
+        - High resolution and professional quality
+        - Bright, vibrant, and colorful design (avoid dark or muted colors)
+        - Use vivid and cheerful colors that stand out
+        - Suitable for calculator app background or button design
+        - Clean, modern aesthetic with excellent visual appeal
+        - Good contrast for readability with energetic color palette
+        - Emphasize brightness and visual impact
+        """
+    return prompt, {
+        "style": request_data.get("style"),
+        "size": request_data.get("size"),
+        "quality": request_data.get("quality"),
+        "message": "图像生成成功",
+    }
+
+def build_pattern_prompt(prompt: str, style: str) -> str:
+    """按键背景图提示词：单一大主体，避免重复元素，确保明亮效果"""
+    return f"""
+        Create a clean background pattern for calculator buttons based on this concept:
+        {prompt}
+        
+        Requirements:
+        - {style} style with ONE single large main subject/element (not repeated patterns)
+        - If it's an animal/character, show only ONE instance filling most of the space
+        - If it's geometric, use ONE large shape or form, not repeated small elements
+        - Clear, simple design without text or numbers
+        - Bright, vibrant, and colorful design with vivid and cheerful colors
+        - Use light backgrounds or colorful themes (avoid dark/black backgrounds)
+        - Well-lit appearance with high brightness and saturation
+        - Optimized for small button size (128x128 pixels)
+        - Focus on a single dominant visual element, not repetitive patterns
+        - High contrast and readability-friendly with excellent visibility
+        """
+
+def build_pattern_request_prompt(request_data: Dict[str, Any]) -> tuple:
+    return build_pattern_prompt(request_data.get("prompt"), request_data.get("style")), {
+        "style": request_data.get("style"),
+        "is_seamless": True,
+        "message": "图案生成成功",
+    }
+
+def build_app_background_prompt(request_data: Dict[str, Any]) -> tuple:
+    """APP整体背景：竖屏，确保明亮效果"""
+    prompt = f"""
+        Generate a beautiful background image for a calculator mobile app:
+        {request_data.get("prompt")}
+        
+        Requirements:
+        - Mobile app background (portrait orientation {request_data.get("size")})
+        - Style: {request_data.get("style")} with {request_data.get("theme")} theme
+        - Subtle and elegant, won't interfere with UI elements
+        - Good contrast for calculator buttons and display
+        - Professional and modern aesthetic with bright, vibrant colors
+        - High quality and resolution with excellent brightness and saturation
+        - Use light backgrounds or colorful themes (avoid dark/black backgrounds)
+        - Well-lit appearance with vivid and cheerful colors
+        - Colors should complement calculator interface while maintaining high visibility
+        - Avoid too busy patterns that distract from functionality
+        
+        Theme context: {request_data.get("theme")}
+        Quality: {request_data.get("quality")}
+        """
+    return prompt, {
+        "style": request_data.get("style"),
+        "theme": request_data.get("theme"),
+        "size": request_data.get("size"),
+        "quality": request_data.get("quality"),
+        "message": "APP背景图生成成功",
+        "usage_tips": "此背景图已优化用于计算器应用，确保UI元素的可读性",
+    }
+
+def build_display_background_prompt(request_data: Dict[str, Any]) -> tuple:
+    """显示区背景：横向，偏暗以突出白色数字"""
+    prompt = f"""
+        Generate a beautiful background image for calculator display area:
+        {request_data.get("prompt")}
+        
+        Requirements:
+        - Calculator display area background (landscape orientation {request_data.get("size")})
+        - Style: {request_data.get("style")} with {request_data.get("theme")} theme
+        - Must ensure excellent readability for white text and numbers
+        - Subtle and elegant, won't interfere with calculation results
+        - Good contrast for digital display content
+        - Professional and clean aesthetic
+        - High quality and resolution
+        - Colors should be darker or muted to highlight white text
+        - Avoid bright colors that reduce text readability
+        - Perfect for digital calculator display background
+        """
+    return prompt, {
+        "style": request_data.get("style"),
+        "size": request_data.get("size"),
+        "quality": request_data.get("quality"),
+        "theme": request_data.get("theme"),
+        "message": "显示区背景生成成功",
+    }
+
+def build_text_image_request_prompt(request_data: Dict[str, Any]) -> tuple:
+    """创意字符：先清理用户输入，再用指定元素构造字符形状"""
+    text = request_data.get("text")
+    cleaned_prompt = clean_user_prompt(request_data.get("prompt") or "")
+    logger.debug(f"清理后创意描述: {cleaned_prompt}")
+    prompt = build_text_image_prompt(text, cleaned_prompt, request_data.get("style"), request_data.get("background"))
+    return prompt, {
+        "text": text,
+        "style": request_data.get("style"),
+        "size": request_data.get("size"),
+        "background": request_data.get("background"),
+        "effects": request_data.get("effects") or [],
+        "cleaned_prompt": cleaned_prompt,
+        "message": f"创意字符 '{text}' 生成成功",
+    }
+
+IMAGE_KINDS = {
+    "image": ImageKind("图像", "image_url", build_image_prompt),
+    "pattern": ImageKind("图案", "pattern_url", build_pattern_request_prompt),
+    "app_background": ImageKind("APP背景图", "background_url", build_app_background_prompt, lookup=find_background_preset),
+    "display_background": ImageKind("显示区背景", "display_background_url", build_display_background_prompt),
+    "text_image": ImageKind("创意字符图片", "image_url", build_text_image_request_prompt, include_data=False),
+}
+
+def run_image_pipeline(kind: str, request_data: Dict[str, Any], on_stage=None) -> Dict[str, Any]:
+    """
+    按 IMAGE_PIPELINE_STAGES 顺序生成一张图像，结果附带各阶段耗时 timings（毫秒）
+    on_stage(stage) 在每个阶段开始时调用，后台任务用它更新进度
+    """
+    image_kind = IMAGE_KINDS[kind]
+    timings = {}
+    start_time = time.perf_counter()
+    
+    with timed_stage(timings, "prompt", on_stage):
+        prompt, fields = image_kind.build(request_data)
+    with timed_stage(timings, "lookup", on_stage):
+        cached = image_kind.lookup(request_data) if image_kind.lookup else None
+    
+    if cached:
+        (image_bytes, mime_type), cached_fields = cached
+        fields = {**fields, **cached_fields}
+        logger.info(f"⚡ {image_kind.label}命中预生成资源: {cached_fields}")
+    else:
+        logger.debug(f"🎨 开始生成{image_kind.label}，提示词: {prompt}")
+        generated_image = generate_image_content(prompt, timings, on_stage)
+        if not generated_image:
+            raise Exception(f"未能生成{image_kind.label}，请检查提示词或稍后重试")
+        image_bytes, mime_type = generated_image
+    
+    with timed_stage(timings, "post_process", on_stage):
+        image_bytes, mime_type = optimize_generated_image(image_bytes, mime_type, request_data.get("size"))
+    with timed_stage(timings, "store", on_stage):
+        payload = image_payload(
+            image_bytes, mime_type, image_kind.url_field,
+            bool(request_data.get("return_image_id")), include_data=image_kind.include_data
+        )
+    timings["total"] = round((time.perf_counter() - start_time) * 1000, 2)
+    logger.info(f"✅ {image_kind.label}生成成功，MIME类型: {mime_type}，各阶段耗时(ms): {timings}")
+    
+    return {
+        "success": True,
+        **payload,
+        "original_prompt": request_data.get("prompt"),
+        "enhanced_prompt": prompt,
+        **fields,
+        "timings": timings,
+    }
+
+def image_task_progress(task_id: str):
+    """后台图像任务的 on_stage 回调：按阶段序号更新进度"""
+    def on_stage(stage: str):
+        progress = 0.1 + 0.8 * IMAGE_PIPELINE_STAGES.index(stage) / len(IMAGE_PIPELINE_STAGES)
+        update_task_status(task_id, TaskStatus.PROCESSING, progress=progress)
+    return on_stage
+
 class ImageGenerationRequest(BaseModel):
     prompt: str = Field(..., description="图像生成提示词")
     style: Optional[str] = Field(default="realistic", description="图像风格")
     size: Optional[str] = Field(default="1024x1024", description="图像尺寸")
     quality: Optional[str] = Field(default="standard", description="图像质量")
+    return_image_id: Optional[bool] = Field(default=False, description="只返回图像库ID，图像通过 GET /images/{hash} 获取")
 
 class AppBackgroundRequest(BaseModel):
     prompt: str = Field(..., description="背景图生成提示词")
@@ -1879,6 +4068,7 @@ class AppBackgroundRequest(BaseModel):
     size: Optional[str] = Field(default="1080x1920", description="背景图尺寸，适配手机屏幕")
     quality: Optional[str] = Field(default="high", description="图像质量")
     theme: Optional[str] = Field(default="calculator", description="主题类型：calculator, abstract, nature, tech等")
+    return_image_id: Optional[bool] = Field(default=False, description="只返回图像库ID，图像通过 GET /images/{hash} 获取")
 
 class DisplayBackgroundRequest(BaseModel):
     prompt: str = Field(..., description="显示区背景生成提示词")
@@ -1886,86 +4076,16 @@ class DisplayBackgroundRequest(BaseModel):
     size: Optional[str] = Field(default="800x400", description="显示区尺寸，适配计算器显示区")
     quality: Optional[str] = Field(default="high", description="图像质量")
     theme: Optional[str] = Field(default="calculator", description="主题类型：calculator, digital, tech等")
+    return_image_id: Optional[bool] = Field(default=False, description="只返回图像库ID，图像通过 GET /images/{hash} 获取")
 
 @app.post("/generate-image")
 async def generate_image(request: ImageGenerationRequest):
     """使用Gemini 2.0 Flash原生图像生成功能"""
     try:
-        # 构建优化的图像生成提示词 - 强调明亮鲜艳的颜色
-        enhanced_prompt = f"""
-        Generate a high-quality image for calculator theme:
-        {request.prompt}
-        
-        Style: {request.style}
-        Requirements:
-        - High resolution and professional quality
-        - Bright, vibrant, and colorful design (avoid dark or muted colors)
-        - Use vivid and cheerful colors that stand out
-        - Suitable for calculator app background or button design
-        - Clean, modern aesthetic with excellent visual appeal
-        - Good contrast for readability with energetic color palette
-        - Emphasize brightness and visual impact
-        """
-        
-        print(f"🎨 开始生成图像，提示词: {enhanced_prompt}")
-        
-        # 使用Gemini 2.0 Flash图像生成模型
-        image_model = genai.GenerativeModel("gemini-2.0-flash-preview-image-generation")
-        
-        # 生成图像 - 使用正确的配置
-        generation_config = {
-            "response_modalities": ["TEXT", "IMAGE"]
-        }
-        
-        response = image_model.generate_content(
-            contents=[enhanced_prompt],
-            generation_config=generation_config
-        )
-        
-        # 检查响应中是否包含图像
-        if hasattr(response, 'parts') and response.parts:
-            for part in response.parts:
-                if hasattr(part, 'inline_data') and part.inline_data:
-                    # 获取生成的图像数据
-                    image_data = part.inline_data.data
-                    mime_type = part.inline_data.mime_type
-                    
-                    # 检查数据是否已经是base64格式
-                    if isinstance(image_data, bytes):
-                        # 如果是bytes，需要转换为base64
-                        import base64
-                        image_base64_data = base64.b64encode(image_data).decode('utf-8')
-                    else:
-                        # 如果已经是字符串，直接使用
-                        image_base64_data = str(image_data)
-                    
-                    # 将图像数据转换为base64 URL
-                    image_base64 = f"data:{mime_type};base64,{image_base64_data}"
-                    
-                    print(f"✅ 图像生成成功，MIME类型: {mime_type}")
-                    
-                    return {
-                        "success": True,
-                        "image_url": image_base64,
-                        "image_data": image_base64_data,
-                        "mime_type": mime_type,
-                        "original_prompt": request.prompt,
-                        "enhanced_prompt": enhanced_prompt,
-                        "style": request.style,
-                        "size": request.size,
-                        "quality": request.quality,
-                        "message": "图像生成成功"
-                    }
-        
-        # 如果没有图像数据，检查文本响应
-        if response.text:
-            print(f"🤖 AI响应: {response.text}")
-            
-        # 如果没有生成图像，返回错误
-        raise HTTPException(status_code=500, detail="未能生成图像，请检查提示词或稍后重试")
+        return await asyncio.to_thread(run_image_pipeline, "image", request.dict())
         
     except Exception as e:
-        print(f"图像生成失败: {str(e)}")
+        logger.error(f"图像生成失败: {str(e)}")
         # 返回占位符图像作为备用方案
         placeholder_url = f"https://via.placeholder.com/{request.size.replace('x', 'x')}/4A90E2/FFFFFF?text=AI+Image+Error"
         
@@ -1981,82 +4101,10 @@ async def generate_image(request: ImageGenerationRequest):
 async def generate_pattern(request: ImageGenerationRequest):
     """使用Gemini 2.0 Flash生成按钮背景图案"""
     try:
-        # 🔧 优化按键背景图案生成 - 单一大主体，避免重复元素，确保明亮效果
-        pattern_prompt = f"""
-        Create a clean background pattern for calculator buttons based on this concept:
-        {request.prompt}
-        
-        Requirements:
-        - {request.style} style with ONE single large main subject/element (not repeated patterns)
-        - If it's an animal/character, show only ONE instance filling most of the space
-        - If it's geometric, use ONE large shape or form, not repeated small elements  
-        - Clear, simple design without text or numbers
-        - Bright, vibrant, and colorful design with vivid and cheerful colors
-        - Use light backgrounds or colorful themes (avoid dark/black backgrounds)
-        - Well-lit appearance with high brightness and saturation
-        - Optimized for small button size (128x128 pixels)
-        - Focus on a single dominant visual element, not repetitive patterns
-        - High contrast and readability-friendly with excellent visibility
-        """
-        
-        print(f"🎨 开始生成图案，提示词: {pattern_prompt}")
-        
-        # 使用Gemini 2.0 Flash图像生成模型
-        image_model = genai.GenerativeModel("gemini-2.0-flash-preview-image-generation")
-        
-        # 生成图案 - 使用正确的配置
-        generation_config = {
-            "response_modalities": ["TEXT", "IMAGE"]
-        }
-        
-        response = image_model.generate_content(
-            contents=[pattern_prompt],
-            generation_config=generation_config
-        )
-        
-        # 检查响应中是否包含图像
-        if hasattr(response, 'parts') and response.parts:
-            for part in response.parts:
-                if hasattr(part, 'inline_data') and part.inline_data:
-                    # 获取生成的图像数据
-                    image_data = part.inline_data.data
-                    mime_type = part.inline_data.mime_type
-                    
-                    # 检查数据是否已经是base64格式
-                    if isinstance(image_data, bytes):
-                        # 如果是bytes，需要转换为base64
-                        import base64
-                        pattern_base64_data = base64.b64encode(image_data).decode('utf-8')
-                    else:
-                        # 如果已经是字符串，直接使用
-                        pattern_base64_data = str(image_data)
-                    
-                    # 将图像数据转换为base64 URL
-                    pattern_base64 = f"data:{mime_type};base64,{pattern_base64_data}"
-                    
-                    print(f"✅ 图案生成成功，MIME类型: {mime_type}")
-                    
-                    return {
-                        "success": True,
-                        "pattern_url": pattern_base64,
-                        "image_data": pattern_base64_data,
-                        "mime_type": mime_type,
-                        "original_prompt": request.prompt,
-                        "enhanced_prompt": pattern_prompt,
-                        "style": request.style,
-                        "is_seamless": True,
-                        "message": "图案生成成功"
-                    }
-        
-        # 如果没有图像数据，检查文本响应
-        if response.text:
-            print(f"🤖 AI响应: {response.text}")
-            
-        # 如果没有生成图案，返回错误
-        raise HTTPException(status_code=500, detail="未能生成图案，请检查提示词或稍后重试")
+        return await asyncio.to_thread(run_image_pipeline, "pattern", request.dict())
         
     except Exception as e:
-        print(f"图案生成失败: {str(e)}")
+        logger.error(f"图案生成失败: {str(e)}")
         # 返回占位符图案作为备用方案
         placeholder_url = f"https://via.placeholder.com/256x256/4A90E2/FFFFFF?text=Pattern+Error"
         
@@ -2072,88 +4120,10 @@ async def generate_pattern(request: ImageGenerationRequest):
 async def generate_app_background(request: AppBackgroundRequest):
     """生成APP整体背景图"""
     try:
-        # 构建专门的APP背景图生成提示词 - 确保明亮效果
-        background_prompt = f"""
-        Generate a beautiful background image for a calculator mobile app:
-        {request.prompt}
-        
-        Requirements:
-        - Mobile app background (portrait orientation {request.size})
-        - Style: {request.style} with {request.theme} theme
-        - Subtle and elegant, won't interfere with UI elements
-        - Good contrast for calculator buttons and display
-        - Professional and modern aesthetic with bright, vibrant colors
-        - High quality and resolution with excellent brightness and saturation
-        - Use light backgrounds or colorful themes (avoid dark/black backgrounds)
-        - Well-lit appearance with vivid and cheerful colors
-        - Colors should complement calculator interface while maintaining high visibility
-        - Avoid too busy patterns that distract from functionality
-        
-        Theme context: {request.theme}
-        Quality: {request.quality}
-        """
-        
-        print(f"🎨 开始生成APP背景图，提示词: {background_prompt}")
-        
-        # 使用Gemini 2.0 Flash图像生成模型
-        image_model = genai.GenerativeModel("gemini-2.0-flash-preview-image-generation")
-        
-        # 生成背景图 - 使用正确的配置
-        generation_config = {
-            "response_modalities": ["TEXT", "IMAGE"]
-        }
-        
-        response = image_model.generate_content(
-            contents=[background_prompt],
-            generation_config=generation_config
-        )
-        
-        # 检查响应中是否包含图像
-        if hasattr(response, 'parts') and response.parts:
-            for part in response.parts:
-                if hasattr(part, 'inline_data') and part.inline_data:
-                    # 获取生成的图像数据
-                    image_data = part.inline_data.data
-                    mime_type = part.inline_data.mime_type
-                    
-                    # 检查数据是否已经是base64格式
-                    if isinstance(image_data, bytes):
-                        # 如果是bytes，需要转换为base64
-                        import base64
-                        background_base64_data = base64.b64encode(image_data).decode('utf-8')
-                    else:
-                        # 如果已经是字符串，直接使用
-                        background_base64_data = str(image_data)
-                    
-                    # 将图像数据转换为base64 URL
-                    background_base64 = f"data:{mime_type};base64,{background_base64_data}"
-                    
-                    print(f"✅ APP背景图生成成功，MIME类型: {mime_type}")
-                    
-                    return {
-                        "success": True,
-                        "background_url": background_base64,
-                        "image_data": background_base64_data,
-                        "mime_type": mime_type,
-                        "original_prompt": request.prompt,
-                        "enhanced_prompt": background_prompt,
-                        "style": request.style,
-                        "theme": request.theme,
-                        "size": request.size,
-                        "quality": request.quality,
-                        "message": "APP背景图生成成功",
-                        "usage_tips": "此背景图已优化用于计算器应用，确保UI元素的可读性"
-                    }
-        
-        # 如果没有图像数据，检查文本响应
-        if response.text:
-            print(f"🤖 AI响应: {response.text}")
-            
-        # 如果没有生成背景图，返回错误
-        raise HTTPException(status_code=500, detail="未能生成APP背景图，请检查提示词或稍后重试")
+        return await asyncio.to_thread(run_image_pipeline, "app_background", request.dict())
         
     except Exception as e:
-        print(f"APP背景图生成失败: {str(e)}")
+        logger.error(f"APP背景图生成失败: {str(e)}")
         # 返回占位符背景图作为备用方案
         placeholder_url = f"https://via.placeholder.com/{request.size.replace('x', 'x')}/1E1E1E/FFFFFF?text=Background+Error"
         
@@ -2169,84 +4139,10 @@ async def generate_app_background(request: AppBackgroundRequest):
 async def generate_display_background(request: DisplayBackgroundRequest):
     """生成计算器显示区背景图"""
     try:
-        # 构建专门的显示区背景生成提示词
-        display_prompt = f"""
-        Generate a beautiful background image for calculator display area:
-        {request.prompt}
-        
-        Requirements:
-        - Calculator display area background (landscape orientation {request.size})
-        - Style: {request.style} with {request.theme} theme
-        - Must ensure excellent readability for white text and numbers
-        - Subtle and elegant, won't interfere with calculation results
-        - Good contrast for digital display content
-        - Professional and clean aesthetic
-        - High quality and resolution
-        - Colors should be darker or muted to highlight white text
-        - Avoid bright colors that reduce text readability
-        - Perfect for digital calculator display background
-        """
-        
-        print(f"🎨 开始生成显示区背景，提示词: {display_prompt}")
-        
-        # 使用Gemini 2.0 Flash图像生成模型
-        image_model = genai.GenerativeModel("gemini-2.0-flash-preview-image-generation")
-        
-        # 生成显示区背景 - 使用正确的配置
-        generation_config = {
-            "response_modalities": ["TEXT", "IMAGE"]
-        }
-        
-        response = image_model.generate_content(
-            contents=[display_prompt],
-            generation_config=generation_config
-        )
-        
-        # 检查响应中是否包含图像
-        if hasattr(response, 'parts') and response.parts:
-            for part in response.parts:
-                if hasattr(part, 'inline_data') and part.inline_data:
-                    # 获取生成的图像数据
-                    image_data = part.inline_data.data
-                    mime_type = part.inline_data.mime_type
-                    
-                    # 检查数据是否已经是base64格式
-                    if isinstance(image_data, bytes):
-                        # 如果是bytes，需要转换为base64
-                        import base64
-                        display_base64_data = base64.b64encode(image_data).decode('utf-8')
-                    else:
-                        # 如果已经是字符串，直接使用
-                        display_base64_data = str(image_data)
-                    
-                    # 将图像数据转换为base64 URL
-                    display_base64 = f"data:{mime_type};base64,{display_base64_data}"
-                    
-                    print(f"✅ 显示区背景生成成功，MIME类型: {mime_type}")
-                    
-                    return {
-                        "success": True,
-                        "display_background_url": display_base64,
-                        "image_data": display_base64_data,
-                        "mime_type": mime_type,
-                        "original_prompt": request.prompt,
-                        "enhanced_prompt": display_prompt,
-                        "style": request.style,
-                        "size": request.size,
-                        "quality": request.quality,
-                        "theme": request.theme,
-                        "message": "显示区背景生成成功"
-                    }
-        
-        # 如果没有图像数据，检查文本响应
-        if response.text:
-            print(f"🤖 AI响应: {response.text}")
-            
-        # 如果没有生成图像，返回错误
-        raise Exception("未能生成显示区背景，请检查提示词或稍后重试")
+        return await asyncio.to_thread(run_image_pipeline, "display_background", request.dict())
         
     except Exception as e:
-        print(f"显示区背景生成失败: {str(e)}")
+        logger.error(f"显示区背景生成失败: {str(e)}")
         # 返回占位符图像作为备用方案
         placeholder_url = f"https://via.placeholder.com/{request.size.replace('x', 'x')}/2A2A2A/FFFFFF?text=Display+Background+Error"
         
@@ -2258,58 +4154,235 @@ async def generate_display_background(request: DisplayBackgroundRequest):
             "message": f"显示区背景生成失败，使用占位符: {str(e)}"
         }
 
-@app.get("/background-presets")
-async def get_background_presets():
-    """获取预设的背景图模板"""
+@app.post("/admin/background-presets/warmup")
+async def trigger_background_preset_warmup(
+    force: bool = Query(False, description="清除失败退避，立即重试所有未生成的预设"),
+    x_admin_token: Optional[str] = Header(None),
+):
+    """管理接口：在后台补齐未生成的背景预设，返回各预设的生成和退避状态"""
+    require_admin(x_admin_token)
+    if force:
+        _background_preset_failures.clear()
+    started = start_background_preset_warmup()
     return {
-        "success": True,
+        "started": started,
         "presets": [
             {
-                "id": "modern_gradient",
-                "name": "现代渐变",
-                "description": "简洁的渐变背景，适合现代风格",
-                "prompt": "modern gradient background with subtle geometric patterns",
-                "style": "modern",
-                "theme": "calculator",
-                "preview_url": "https://via.placeholder.com/300x500/4A90E2/FFFFFF?text=Modern+Gradient"
-            },
-            {
-                "id": "tech_circuit",
-                "name": "科技电路",
-                "description": "科技感电路板背景，适合数字风格",
-                "prompt": "futuristic circuit board pattern with neon accents",
-                "style": "cyberpunk",
-                "theme": "tech",
-                "preview_url": "https://via.placeholder.com/300x500/0F0F23/00FF88?text=Tech+Circuit"
-            },
-            {
-                "id": "minimal_abstract",
-                "name": "极简抽象",
-                "description": "简约抽象几何图形背景",
-                "prompt": "minimal abstract geometric shapes with soft colors",
-                "style": "minimal",
-                "theme": "abstract",
-                "preview_url": "https://via.placeholder.com/300x500/F5F5F5/333333?text=Minimal+Abstract"
-            },
-            {
-                "id": "nature_calm",
-                "name": "自然宁静",
-                "description": "自然风景背景，营造宁静氛围",
-                "prompt": "calm nature landscape with soft lighting",
-                "style": "realistic",
-                "theme": "nature",
-                "preview_url": "https://via.placeholder.com/300x500/87CEEB/FFFFFF?text=Nature+Calm"
-            },
-            {
-                "id": "dark_professional",
-                "name": "专业深色",
-                "description": "专业的深色背景，适合商务使用",
-                "prompt": "professional dark background with subtle texture",
-                "style": "professional",
-                "theme": "calculator",
-                "preview_url": "https://via.placeholder.com/300x500/1A1A1A/FFFFFF?text=Dark+Professional"
+                "id": preset["id"],
+                "ready": background_preset_assets.get(preset) is not None,
+                **_background_preset_failures.get(preset["id"], {}),
             }
-        ]
+            for preset in BACKGROUND_PRESETS
+        ],
+    }
+
+@app.get("/background-presets")
+async def get_background_presets(req: Request):
+    """获取预设的背景图模板，已预生成的预设直接返回图像库中的预览图和全尺寸背景图"""
+    presets = []
+    for preset in BACKGROUND_PRESETS:
+        assets = background_preset_assets.get(preset)
+        item = {**preset, "ready": assets is not None}
+        if assets:
+            item.update({
+                "preview_url": f"/images/{assets['preview']}",
+                "background_url": f"/images/{assets['full']}",
+                "image_id": assets["full"],
+                "image_ref": IMAGE_REF_PREFIX + assets["full"],
+            })
+        presets.append(item)
+    
+    # 只读接口不触发上游生成：预设在启动预热（BACKGROUND_PRESET_WARMUP）或管理接口触发时生成
+    all_ready = all(item["ready"] for item in presets)
+    
+    body = json.dumps({"success": True, "presets": presets}, ensure_ascii=False).encode('utf-8')
+    etag = f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+    headers = {
+        "ETag": etag,
+        # 全部生成后内容只随预设定义变化，可以长时间缓存；未完成时要求客户端每次校验
+        "Cache-Control": BACKGROUND_PRESETS_CACHE_CONTROL if all_ready else "no-cache",
+    }
+    if_none_match = req.headers.get("if-none-match")
+    if if_none_match and etag in [tag.strip() for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+# 🧹 清理用户输入，去除描述性文字，只保留创意核心
+# 需要过滤的描述性词汇和短语
+PROMPT_DESCRIPTIVE_PHRASES = [
+    "生成", "图片", "效果", "光影", "文字", "数字", "字符", "符号",
+    "为", "的", "进行", "制作", "创建", "设计", "绘制",
+    "生成光影效果", "光影效果图片", "效果图片", "文字图片", 
+    "数字图片", "字符图片", "背景图", "按键", "按钮",
+    "白底", "透明", "背景", "底色", "不能有其他字出现",
+    "生成光影效果的图片", "为文字.*?生成.*?图片", "光影文字", "特效"
+]
+# 所有短语编译成一个交替式正则：短语连同前面的标点和所在分句的剩余部分一起移除
+# 短语都不含"，。"，逐个短语替换和一次性扫描的结果相同
+PROMPT_PHRASE_PATTERN = re.compile(
+    "[，。、]*(?:" + "|".join(re.escape(phrase) for phrase in sorted(PROMPT_DESCRIPTIVE_PHRASES, key=len, reverse=True)) + ")[^，。]*"
+)
+PROMPT_SEPARATOR_PATTERN = re.compile(r'[，。、；：！？\s]+')
+
+def clean_user_prompt(prompt: str) -> str:
+    """清理用户输入的提示词，去除描述性文字，只保留创意核心"""
+    if not prompt:
+        return ""
+    
+    cleaned = PROMPT_PHRASE_PATTERN.sub("", prompt.strip())
+    # 清理多余的标点符号和空格
+    return PROMPT_SEPARATOR_PATTERN.sub(" ", cleaned).strip()
+
+# 根据风格选择不同的视觉风格描述
+TEXT_IMAGE_STYLE_EFFECTS = {
+    "modern": "in sleek modern style",
+    "neon": "in vibrant neon style with bright colors",
+    "gold": "in luxurious golden metallic style", 
+    "silver": "in polished silver metallic style",
+    "fire": "in fiery red/orange style",
+    "ice": "in crystal clear ice style",
+    "galaxy": "in cosmic space style with stars",
+    "glass": "in transparent glass crystal style"
+}
+
+def build_text_image_prompt(text: str, cleaned_prompt: str, style: str, background: str) -> str:
+    """创意字符构造：极简提示词，避免AI误解指令为显示内容"""
+    if cleaned_prompt and cleaned_prompt.strip():
+        # 极简直接指令，避免任何可能被误解的英文描述
+        return f"""Show number "{text}" made from {cleaned_prompt}. Pure visual art only. No text anywhere. Clean {background} background."""
+    # 标准设计，同样极简；获取对应风格的效果描述，默认为现代风格
+    style_effect = TEXT_IMAGE_STYLE_EFFECTS.get(style, TEXT_IMAGE_STYLE_EFFECTS["modern"])
+    return f"""Show number "{text}" {style_effect}. Pure visual art only. No text anywhere. Clean {background} background."""
+
+# 🔧 新增：字形集缓存 - (字符, 清理后的创意描述, 风格, 背景) -> 原图哈希，同一风格的字形集重复请求直接命中
+GLYPH_CACHE_DIR = os.path.join(IMAGES_DIR, "glyphs")
+os.makedirs(GLYPH_CACHE_DIR, exist_ok=True)
+DEFAULT_GLYPH_SET = ["0", "1", "2", "3", "4", "5", "6", "7", "8", "9", "+", "-", "×", "÷", "=", "."]
+# 每个未缓存字形都是一次计费的图像生成：单次请求最多生成的字符数，同步端点最多现场生成的字形数
+GLYPH_SET_MAX_CHARACTERS = int(os.getenv("GLYPH_SET_MAX_CHARACTERS", "32"))
+GLYPH_SET_SYNC_MAX_UNCACHED = int(os.getenv("GLYPH_SET_SYNC_MAX_UNCACHED", "4"))
+
+class GlyphCache:
+    """每个字形一个小文件，内容为图像库中原图的哈希"""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._entries = {}
+
+    @staticmethod
+    def key(char: str, cleaned_prompt: str, style: str, background: str) -> str:
+        raw = json.dumps([char, cleaned_prompt, style, background], ensure_ascii=False)
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def _lookup(self, key: str) -> Optional[str]:
+        image_hash = self._entries.get(key)
+        if image_hash is None:
+            try:
+                with open(os.path.join(self.directory, key), 'r', encoding='utf-8') as f:
+                    image_hash = f.read().strip()
+            except OSError:
+                return None
+        if not image_store.path(image_hash):
+            return None
+        self._entries[key] = image_hash
+        return image_hash
+
+    def get(self, key: str) -> Optional[str]:
+        image_hash = self._lookup(key)
+        record_cache("glyph", image_hash is not None)
+        return image_hash
+
+    def contains(self, key: str) -> bool:
+        """只检查是否已缓存，不计入命中率"""
+        return self._lookup(key) is not None
+
+    def put(self, key: str, image_hash: str):
+        with open(os.path.join(self.directory, key), 'w', encoding='utf-8') as f:
+            f.write(image_hash)
+        self._entries[key] = image_hash
+
+glyph_cache = GlyphCache(GLYPH_CACHE_DIR)
+
+def generate_glyph(char: str, cleaned_prompt: str, style: str, background: str, size: str) -> dict:
+    """生成（或从缓存取出）单个字形，返回图像引用"""
+    key = GlyphCache.key(char, cleaned_prompt, style, background)
+    image_hash = glyph_cache.get(key)
+    cached = image_hash is not None
+    if cached:
+        image_bytes, mime_type = image_store.get(image_hash)
+    else:
+        generated_image = generate_image_content(build_text_image_prompt(char, cleaned_prompt, style, background))
+        if not generated_image:
+            raise Exception("未找到生成的图像数据")
+        image_bytes, mime_type = generated_image
+        glyph_cache.put(key, image_store.put(image_bytes, mime_type))
+    return {
+        **image_payload(image_bytes, mime_type, "image_url", return_image_id=True, include_data=False, size=size),
+        "cached": cached,
+    }
+
+def glyph_set_params(request_data: Dict[str, Any]) -> tuple:
+    """返回 (去重后的字符列表, 清理后的创意描述, 风格, 背景)"""
+    characters = list(dict.fromkeys(request_data.get("characters") or DEFAULT_GLYPH_SET))
+    style = request_data.get("style", "modern")
+    background = request_data.get("background", "transparent")
+    cleaned_prompt = clean_user_prompt(request_data.get("prompt") or "")
+    return characters, cleaned_prompt, style, background
+
+def count_uncached_glyphs(request_data: Dict[str, Any]) -> int:
+    """字形集中需要现场生成的字形数"""
+    characters, cleaned_prompt, style, background = glyph_set_params(request_data)
+    return sum(
+        1 for char in characters
+        if not glyph_cache.contains(GlyphCache.key(char, cleaned_prompt, style, background))
+    )
+
+def generate_glyph_set(request_data: Dict[str, Any], on_progress=None) -> Dict[str, Any]:
+    """
+    并发生成一整套字形，所有字形共用同一清理后的创意描述、风格和背景
+    on_progress(completed, total, manifest, failed) 在每个字形完成时调用
+    """
+    start_time = time.time()
+    characters, cleaned_prompt, style, background = glyph_set_params(request_data)
+    size = request_data.get("size", "512x512")
+    
+    logger.info(f"🔤 开始生成字形集: {''.join(characters)}，风格: {style}，清理后创意描述: {cleaned_prompt}")
+    
+    manifest = {}
+    failed = {}
+    with ThreadPoolExecutor(max_workers=min(len(characters), IMAGE_GENERATION_CONCURRENCY)) as pool:
+        futures = {
+            pool.submit(contextvars.copy_context().run, generate_glyph, char, cleaned_prompt, style, background, size): char
+            for char in characters
+        }
+        for completed, future in enumerate(as_completed(futures), 1):
+            char = futures[future]
+            try:
+                manifest[char] = future.result()
+            except Exception as e:
+                failed[char] = str(e)
+                logger.error(f"❌ 字形生成失败: '{char}' - {e}")
+            if on_progress:
+                on_progress(completed, len(characters), manifest, failed)
+    
+    cached_count = sum(1 for glyph in manifest.values() if glyph["cached"])
+    duration = time.time() - start_time
+    logger.info(f"✅ 字形集完成: {len(manifest)}/{len(characters)}（缓存命中 {cached_count}），耗时: {duration:.2f}秒")
+    
+    # 按请求的字符顺序返回清单
+    return {
+        "success": bool(manifest),
+        "manifest": {char: manifest[char] for char in characters if char in manifest},
+        "failed": failed,
+        "characters": characters,
+        "style": style,
+        "size": size,
+        "background": background,
+        "original_prompt": request_data.get("prompt"),
+        "cleaned_prompt": cleaned_prompt,
+        "cached": cached_count,
+        "processing_time": duration,
+        "message": f"字形集生成完成: {len(manifest)}/{len(characters)}"
     }
 
 class TextImageRequest(BaseModel):
@@ -2319,141 +4392,30 @@ class TextImageRequest(BaseModel):
     size: Optional[str] = Field(default="512x512", description="图像尺寸")
     background: Optional[str] = Field(default="transparent", description="背景类型：transparent, dark, light, gradient")
     effects: Optional[List[str]] = Field(default=[], description="视觉效果列表")
+    return_image_id: Optional[bool] = Field(default=False, description="只返回图像库ID，图像通过 GET /images/{hash} 获取")
+
+class GlyphSetRequest(BaseModel):
+    prompt: Optional[str] = Field(default="", description="整套字形共用的创意描述")
+    characters: Optional[List[Annotated[str, Field(min_length=1, max_length=1)]]] = Field(
+        default=None, max_length=GLYPH_SET_MAX_CHARACTERS, description="要生成的字符列表（每项一个字符），默认 0-9 和 +-×÷=."
+    )
+    style: Optional[str] = Field(default="modern", description="视觉风格：modern, neon, gold, silver, fire, ice, galaxy等")
+    size: Optional[str] = Field(default="512x512", description="图像尺寸")
+    background: Optional[str] = Field(default="transparent", description="背景类型：transparent, dark, light, gradient")
 
 @app.post("/generate-text-image")
 async def generate_text_image(request: TextImageRequest):
     """生成创意字符图片 - 用指定元素构造字符形状"""
     try:
-        print(f"🎨 正在生成创意字符图片...")
-        print(f"字符内容: {request.text}")
-        print(f"原始创意描述: {request.prompt}")
-        print(f"风格: {request.style}")
-        
-        # 🧹 清理用户输入，去除描述性文字，只保留创意核心
-        def clean_user_prompt(prompt: str) -> str:
-            """清理用户输入的提示词，去除描述性文字，只保留创意核心"""
-            if not prompt:
-                return ""
-            
-            # 需要过滤的描述性词汇和短语
-            descriptive_phrases = [
-                "生成", "图片", "效果", "光影", "文字", "数字", "字符", "符号",
-                "为", "的", "进行", "制作", "创建", "设计", "绘制",
-                "生成光影效果", "光影效果图片", "效果图片", "文字图片", 
-                "数字图片", "字符图片", "背景图", "按键", "按钮",
-                "白底", "透明", "背景", "底色", "不能有其他字出现",
-                "生成光影效果的图片", "为文字.*?生成.*?图片", "光影文字", "特效"
-            ]
-            
-            cleaned = prompt.strip()
-            
-            # 移除描述性短语
-            import re
-            for phrase in descriptive_phrases:
-                # 使用正则表达式匹配包含这些短语的部分
-                pattern = f"[，。、]*{re.escape(phrase)}[^，。]*"
-                cleaned = re.sub(pattern, "", cleaned, flags=re.IGNORECASE)
-                
-                # 移除完整短语
-                cleaned = cleaned.replace(phrase, "")
-            
-            # 清理多余的标点符号和空格
-            cleaned = re.sub(r'[，。、；：！？\s]+', ' ', cleaned)
-            cleaned = re.sub(r'^[，。、；：！？\s]+|[，。、；：！？\s]+$', '', cleaned)
-            cleaned = re.sub(r'\s+', ' ', cleaned).strip()
-            
-            return cleaned
-        
-        # 清理用户输入
-        cleaned_prompt = clean_user_prompt(request.prompt) if request.prompt else ""
-        print(f"清理后创意描述: {cleaned_prompt}")
-        
-        # 🎨 构建创意字符生成提示词，用指定元素构造字符形状
-        # 根据风格选择不同的视觉风格描述
-        style_effects = {
-            "modern": "in sleek modern style",
-            "neon": "in vibrant neon style with bright colors",
-            "gold": "in luxurious golden metallic style", 
-            "silver": "in polished silver metallic style",
-            "fire": "in fiery red/orange style",
-            "ice": "in crystal clear ice style",
-            "galaxy": "in cosmic space style with stars",
-            "glass": "in transparent glass crystal style"
-        }
-        
-        # 获取对应风格的效果描述，默认为现代风格
-        style_effect = style_effects.get(request.style, style_effects["modern"])
-        
-        # 🎨 创意字符构造：极简提示词，避免AI误解指令为显示内容
-        if cleaned_prompt and cleaned_prompt.strip():
-            # 极简直接指令，避免任何可能被误解的英文描述
-            detailed_prompt = f"""Show number "{request.text}" made from {cleaned_prompt}. Pure visual art only. No text anywhere. Clean {request.background} background."""
-        else:
-            # 标准设计，同样极简
-            detailed_prompt = f"""Show number "{request.text}" {style_effect}. Pure visual art only. No text anywhere. Clean {request.background} background."""
-
-        print(f"🚀 使用提示词: {detailed_prompt}")
-
-        # 使用图像生成专用模型
-        image_model = genai.GenerativeModel("gemini-2.0-flash-preview-image-generation")
-        
-        # 生成配置
-        generation_config = {
-            "response_modalities": ["TEXT", "IMAGE"]
-        }
-        
-        # 生成图像
-        response = image_model.generate_content(
-            contents=[detailed_prompt],
-            generation_config=generation_config
-        )
+        logger.debug(f"🎨 正在生成创意字符图片...")
+        logger.debug(f"字符内容: {request.text}")
+        logger.debug(f"原始创意描述: {request.prompt}")
+        logger.debug(f"风格: {request.style}")
         
-        # 检查响应中是否包含图像
-        if hasattr(response, 'parts') and response.parts:
-            for part in response.parts:
-                if hasattr(part, 'inline_data') and part.inline_data:
-                    # 获取生成的图像数据
-                    image_data = part.inline_data.data
-                    mime_type = part.inline_data.mime_type
-                    
-                    # 检查数据是否已经是base64格式
-                    if isinstance(image_data, bytes):
-                        # 如果是bytes，需要转换为base64
-                        import base64
-                        text_image_base64_data = base64.b64encode(image_data).decode('utf-8')
-                    else:
-                        # 如果已经是字符串，直接使用
-                        text_image_base64_data = str(image_data)
-                    
-                    # 将图像数据转换为base64 URL
-                    text_image_base64 = f"data:{mime_type};base64,{text_image_base64_data}"
-                    
-                    print(f"✅ 创意字符图片生成成功: '{request.text}'，MIME类型: {mime_type}")
-                    
-                    return {
-                        "success": True,
-                        "image_url": text_image_base64,
-                        "text": request.text,
-                        "style": request.style,
-                        "size": request.size,
-                        "background": request.background,
-                        "effects": request.effects,
-                        "mime_type": mime_type,
-                        "original_prompt": request.prompt,
-                        "cleaned_prompt": cleaned_prompt,
-                        "enhanced_prompt": detailed_prompt,
-                        "message": f"创意字符 '{request.text}' 生成成功"
-                    }
-        
-        # 检查是否有文本响应
-        if hasattr(response, 'text') and response.text:
-            print(f"🤖 AI响应: {response.text}")
-            
-        # 如果没有生成图像，返回错误
-        raise Exception("未找到生成的图像数据")
+        return await asyncio.to_thread(run_image_pipeline, "text_image", request.dict())
         
     except Exception as e:
-        print(f"❌ 创意字符图片生成失败: {str(e)}")
+        logger.error(f"❌ 创意字符图片生成失败: {str(e)}")
         
         # 返回错误信息
         return {
@@ -2463,6 +4425,44 @@ async def generate_text_image(request: TextImageRequest):
             "message": f"生成创意字符 '{request.text}' 失败: {str(e)}"
     }
 
+@app.post("/generate-glyph-set")
+async def generate_glyph_set_endpoint(request: GlyphSetRequest, req: Request):
+    """生成一整套创意字符（如数字键），已缓存的字形立即返回；未缓存的字形较多时需走任务端点"""
+    if await asyncio.to_thread(count_uncached_glyphs, request.dict()) > GLYPH_SET_SYNC_MAX_UNCACHED:
+        raise HTTPException(status_code=400, detail=t(req, "api.error.glyph_set_use_task"))
+    try:
+        return await asyncio.to_thread(generate_glyph_set, request.dict())
+    except Exception as e:
+        logger.error(f"❌ 字形集生成失败: {str(e)}")
+        return {
+            "success": False,
+            "error": str(e),
+            "message": f"字形集生成失败: {str(e)}"
+        }
+
+class SpriteAtlasRequest(BaseModel):
+    config: Dict[str, Any] = Field(..., description="计算器配置，打包其中所有按键的背景图")
+    max_sprite_size: Optional[int] = Field(default=256, ge=8, le=1024, description="单个按键图的最大边长")
+    padding: Optional[int] = Field(default=2, ge=0, le=32, description="按键图之间的间距，避免纹理采样串色")
+
+@app.post("/sprite-atlas")
+async def create_sprite_atlas(request: SpriteAtlasRequest, req: Request):
+    """把配置中的按键背景图打包成一张精灵图集，返回图集引用和每个按键的UV矩形"""
+    from PIL import Image
+    try:
+        atlas = await asyncio.to_thread(build_sprite_atlas, request.config, request.max_sprite_size, request.padding)
+    except SpriteAtlasTooLargeError as e:
+        logger.warning(f"⚠️ 精灵图集打包失败: {e}")
+        raise HTTPException(status_code=400, detail=t(req, "api.error.sprite_atlas_too_large"))
+    except ValueError:
+        raise HTTPException(status_code=400, detail=t(req, "api.error.sprite_atlas_no_images"))
+    except (OSError, Image.DecompressionBombError) as e:
+        # PIL无法解码的按键图（UnidentifiedImageError 是 OSError 的子类）或像素数超限，属于请求内容问题
+        logger.warning(f"⚠️ 精灵图集打包失败，按键图无法解码: {e}")
+        raise HTTPException(status_code=400, detail=t(req, "api.error.sprite_atlas_invalid_image"))
+    
+    return {"success": True, **atlas}
+
 # 🔧 新增：异步任务端点
 @app.post("/tasks/submit/customize")
 async def submit_customize_task(request: CustomizationRequest, background_tasks: BackgroundTasks, req: Request) -> TaskResponse:
@@ -2471,7 +4471,8 @@ async def submit_customize_task(request: CustomizationRequest, background_tasks:
         # 清理过期任务
         cleanup_old_tasks()
         
-        # 创建任务
+        # 创建任务：内联图像先转存到图像库，任务文件只保存引用
+        request.current_config = externalize_images(request.current_config)
         task_id = create_task("customize", request.dict())
         
         # 启动后台处理
@@ -2517,12 +4518,44 @@ async def submit_generate_pattern_task(request: ImageGenerationRequest, backgrou
     except Exception as e:
         raise HTTPException(status_code=500, detail=t(req, "api.error.task_creation_failed", error=str(e)))
 
-@app.post("/tasks/submit/generate-app-background")
-async def submit_generate_app_background_task(request: AppBackgroundRequest, background_tasks: BackgroundTasks, req: Request) -> TaskResponse:
-    """提交APP背景图生成任务"""
+@app.post("/tasks/submit/generate-app-background")
+async def submit_generate_app_background_task(request: AppBackgroundRequest, background_tasks: BackgroundTasks, req: Request) -> TaskResponse:
+    """提交APP背景图生成任务"""
+    try:
+        cleanup_old_tasks()
+        task_id = create_task("generate-app-background", request.dict())
+        background_tasks.add_task(process_task_in_background, task_id)
+        
+        return TaskResponse(
+            task_id=task_id,
+            status=TaskStatus.PENDING,
+            message=t(req, "task.message.created")
+        )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=t(req, "api.error.task_creation_failed", error=str(e)))
+
+@app.post("/tasks/submit/generate-text-image")
+async def submit_generate_text_image_task(request: TextImageRequest, background_tasks: BackgroundTasks, req: Request) -> TaskResponse:
+    """提交文字图像生成任务"""
+    try:
+        cleanup_old_tasks()
+        task_id = create_task("generate-text-image", request.dict())
+        background_tasks.add_task(process_task_in_background, task_id)
+        
+        return TaskResponse(
+            task_id=task_id,
+            status=TaskStatus.PENDING,
+            message=t(req, "task.message.created")
+        )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=t(req, "api.error.task_creation_failed", error=str(e)))
+
+@app.post("/tasks/submit/generate-display-background")
+async def submit_generate_display_background_task(request: DisplayBackgroundRequest, background_tasks: BackgroundTasks, req: Request) -> TaskResponse:
+    """提交显示区背景生成任务"""
     try:
         cleanup_old_tasks()
-        task_id = create_task("generate-app-background", request.dict())
+        task_id = create_task("generate-display-background", request.dict())
         background_tasks.add_task(process_task_in_background, task_id)
         
         return TaskResponse(
@@ -2533,12 +4566,49 @@ async def submit_generate_app_background_task(request: AppBackgroundRequest, bac
     except Exception as e:
         raise HTTPException(status_code=500, detail=t(req, "api.error.task_creation_failed", error=str(e)))
 
-@app.post("/tasks/submit/generate-text-image")
-async def submit_generate_text_image_task(request: TextImageRequest, background_tasks: BackgroundTasks, req: Request) -> TaskResponse:
-    """提交文字图像生成任务"""
+# 每个按键一次计费的图像生成，上限为满网格
+KEYPAD_PATTERNS_MAX_BUTTONS = GRID_MAX_ROWS * GRID_MAX_COLUMNS
+
+def keypad_pattern_targets(request_data: Dict[str, Any]) -> tuple:
+    """
+    返回 (按键ID -> 标签, 要生成的按键ID列表)
+    按键数超过满网格，或给了布局但 button_ids 中有布局里不存在的按键时抛出 ValueError
+    """
+    layout = request_data.get("layout")
+    buttons = (layout or {}).get("buttons") or []
+    labels = {
+        button.get("id"): button.get("label", "")
+        for button in buttons if isinstance(button, dict) and button.get("id")
+    }
+    button_ids = list(dict.fromkeys(request_data.get("button_ids") or labels))
+    if len(button_ids) > KEYPAD_PATTERNS_MAX_BUTTONS:
+        raise ValueError(f"按键数 {len(button_ids)} 超过上限 {KEYPAD_PATTERNS_MAX_BUTTONS}")
+    if layout is not None:
+        unknown = [button_id for button_id in button_ids if button_id not in labels]
+        if unknown:
+            raise ValueError(f"布局中不存在的按键: {', '.join(unknown)}")
+    return labels, button_ids
+
+class KeypadPatternsRequest(BaseModel):
+    prompt: str = Field(..., description="整套按键背景图的主题描述")
+    layout: Optional[Dict[str, Any]] = Field(default=None, description="计算器布局，为其中所有按键生成背景图")
+    button_ids: Optional[List[str]] = Field(
+        default=None, max_length=KEYPAD_PATTERNS_MAX_BUTTONS, description="只为这些按键生成背景图，给了布局时必须是布局中的按键"
+    )
+    style: Optional[str] = Field(default="minimal", description="图案风格")
+    size: Optional[str] = Field(default="128x128", description="按键背景图尺寸")
+
+@app.post("/tasks/submit/generate-keypad-patterns")
+async def submit_generate_keypad_patterns_task(request: KeypadPatternsRequest, background_tasks: BackgroundTasks, req: Request) -> TaskResponse:
+    """提交整套按键背景图生成任务"""
+    try:
+        keypad_pattern_targets(request.dict())
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=t(req, "api.error.keypad_patterns_invalid_buttons", error=str(e)))
+    
     try:
         cleanup_old_tasks()
-        task_id = create_task("generate-text-image", request.dict())
+        task_id = create_task("generate-keypad-patterns", request.dict())
         background_tasks.add_task(process_task_in_background, task_id)
         
         return TaskResponse(
@@ -2549,12 +4619,12 @@ async def submit_generate_text_image_task(request: TextImageRequest, background_
     except Exception as e:
         raise HTTPException(status_code=500, detail=t(req, "api.error.task_creation_failed", error=str(e)))
 
-@app.post("/tasks/submit/generate-display-background")
-async def submit_generate_display_background_task(request: DisplayBackgroundRequest, background_tasks: BackgroundTasks, req: Request) -> TaskResponse:
-    """提交显示区背景生成任务"""
+@app.post("/tasks/submit/generate-glyph-set")
+async def submit_generate_glyph_set_task(request: GlyphSetRequest, background_tasks: BackgroundTasks, req: Request) -> TaskResponse:
+    """提交字形集生成任务"""
     try:
         cleanup_old_tasks()
-        task_id = create_task("generate-display-background", request.dict())
+        task_id = create_task("generate-glyph-set", request.dict())
         background_tasks.add_task(process_task_in_background, task_id)
         
         return TaskResponse(
@@ -2565,6 +4635,169 @@ async def submit_generate_display_background_task(request: DisplayBackgroundRequ
     except Exception as e:
         raise HTTPException(status_code=500, detail=t(req, "api.error.task_creation_failed", error=str(e)))
 
+IMAGE_CACHE_CONTROL = "public, max-age=31536000, immutable"  # 内容寻址，同一URL的内容永不变化
+
+def parse_byte_range(range_header: str, size: int) -> Optional[tuple]:
+    """解析单段 Range: bytes=start-end，返回 (start, end) 闭区间；无法满足时返回None"""
+    match = re.fullmatch(r"\s*bytes=(\d*)-(\d*)\s*", range_header)
+    if not match or not (match.group(1) or match.group(2)):
+        return None
+    if match.group(1):
+        start = int(match.group(1))
+        end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+    else:
+        # bytes=-N 表示最后N个字节
+        start = max(size - int(match.group(2)), 0)
+        end = size - 1
+    if start > end or start >= size:
+        return None
+    return start, end
+
+def image_response(source, mime_type: str, etag: str, req: Request, headers: Dict[str, str]) -> Response:
+    """
+    返回图像，处理 If-None-Match(304) 和单段 Range(206/416)
+    source 为文件路径，或已读入内存的字节（变体在缓存锁内读出，不会在发送前被淘汰）
+    """
+    headers = {**headers, "ETag": etag, "Cache-Control": IMAGE_CACHE_CONTROL, "Accept-Ranges": "bytes",
+               # 图像从API同源返回：禁止嗅探和脚本执行
+               "X-Content-Type-Options": "nosniff", "Content-Security-Policy": "sandbox"}
+    
+    if_none_match = req.headers.get("if-none-match")
+    if if_none_match and (if_none_match.strip() == "*" or etag in [tag.strip() for tag in if_none_match.split(",")]):
+        return Response(status_code=304, headers=headers)
+    
+    in_memory = isinstance(source, bytes)
+    size = len(source) if in_memory else os.path.getsize(source)
+    range_header = req.headers.get("range")
+    if_range = req.headers.get("if-range")
+    if range_header and (not if_range or if_range.strip() == etag):
+        byte_range = parse_byte_range(range_header, size)
+        if byte_range is None:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+        start, end = byte_range
+        if in_memory:
+            data = source[start:end + 1]
+        else:
+            with open(source, 'rb') as f:
+                f.seek(start)
+                data = f.read(end - start + 1)
+        return Response(content=data, status_code=206, media_type=mime_type,
+                        headers={**headers, "Content-Range": f"bytes {start}-{end}/{size}"})
+    
+    if in_memory:
+        data = source
+    else:
+        with open(source, 'rb') as f:
+            data = f.read()
+    return Response(content=data, media_type=mime_type, headers=headers)
+
+def read_image_width(path: str) -> int:
+    """只读取图像头部获取宽度，不解码像素"""
+    from PIL import Image
+    with Image.open(path) as image:
+        return image.width
+
+def read_file_bytes(path: str) -> bytes:
+    with open(path, 'rb') as f:
+        return f.read()
+
+def _float_header(req: Request, *names: str) -> Optional[float]:
+    for name in names:
+        value = req.headers.get(name)
+        if value:
+            try:
+                return float(value)
+            except ValueError:
+                pass
+    return None
+
+def resolve_image_variant(req: Request, w: Optional[int], dpr: Optional[float], image_format: Optional[str]) -> tuple:
+    """
+    根据查询参数或客户端提示计算目标物理像素宽度和输出格式，返回 (width, format)
+    w 为CSS像素宽度，乘以 dpr；Sec-CH-Width/Width 提示已经是物理像素
+    """
+    if dpr is None:
+        dpr = _float_header(req, "sec-ch-dpr", "dpr")
+    dpr = min(max(dpr or 1.0, 1.0), 4.0)
+    
+    width = None
+    if w:
+        width = w * dpr
+    else:
+        hinted_width = _float_header(req, "sec-ch-width", "width")
+        if hinted_width is None:
+            viewport_width = _float_header(req, "sec-ch-viewport-width", "viewport-width")
+            hinted_width = viewport_width * dpr if viewport_width else None
+        if hinted_width:
+            width = hinted_width
+    
+    if image_format not in IMAGE_OUTPUT_MIME_TYPES:
+        if width is None and image_format is None:
+            return None, None
+        image_format = "webp" if "image/webp" in req.headers.get("accept", "") else "png"
+    
+    if width is not None:
+        width = next((bucket for bucket in IMAGE_VARIANT_WIDTHS if bucket >= width), IMAGE_VARIANT_WIDTHS[-1])
+    return width, image_format
+
+@app.get("/images/{image_hash}")
+async def get_image(image_hash: str, req: Request, w: Optional[int] = None, dpr: Optional[float] = None,
+                    image_format: Optional[str] = Query(default=None, alias="format")):
+    """
+    按内容哈希获取图像库中的图像，支持ETag协商缓存和Range分段下载
+    带 w/dpr/format 参数或客户端提示时返回按设备尺寸缩放的变体，变体惰性生成并缓存
+    """
+    image_path = image_store.path(image_hash)
+    if image_path is None:
+        raise HTTPException(status_code=404, detail=t(req, "api.error.image_not_found"))
+    
+    headers = {"Accept-CH": "Sec-CH-Width, Sec-CH-DPR, Sec-CH-Viewport-Width"}
+    # 查询参数没有同时固定宽度、DPR和格式时，客户端提示会影响返回内容（包括是否返回原图），共享缓存必须按提示区分
+    image_format = image_format and image_format.lower()
+    if not (w and dpr is not None and image_format in IMAGE_OUTPUT_MIME_TYPES):
+        headers["Vary"] = "Accept, Sec-CH-Width, Sec-CH-DPR, Sec-CH-Viewport-Width, Width, DPR, Viewport-Width"
+    
+    image_store.touch(image_hash)
+    
+    # 以下文件读取、宽度探测和变体写入都放到线程中，数MB的原图不会阻塞事件循环
+    async def original_response() -> Response:
+        try:
+            return await asyncio.to_thread(
+                image_response, image_path, image_store.mime_type(image_hash), f'"{image_hash}"', req, headers
+            )
+        except FileNotFoundError:
+            # 刚被图像库淘汰
+            raise HTTPException(status_code=404, detail=t(req, "api.error.image_not_found"))
+    
+    width, image_format = resolve_image_variant(req, w, dpr, image_format)
+    if image_format is None:
+        return await original_response()
+    
+    from PIL import UnidentifiedImageError
+    try:
+        original_width = await asyncio.to_thread(read_image_width, image_path)
+    except (UnidentifiedImageError, OSError) as e:
+        # PIL无法解码的内容（如SVG）不做变体，直接返回原图
+        logger.warning(f"⚠️ 无法解码图像，返回原图: {image_hash} - {e}")
+        return await original_response()
+    # 不放大：目标宽度超过原图时使用原图宽度
+    width = min(width or original_width, original_width)
+    filename = ImageVariantCache.filename(image_hash, width, image_format)
+    variant = await asyncio.to_thread(image_variant_cache.get, filename)
+    if variant is None:
+        try:
+            data = await asyncio.to_thread(read_file_bytes, image_path)
+            variant = await run_in_image_process_async(
+                resize_image_to_width, data, width, image_format, IMAGE_OUTPUT_QUALITY
+            )
+        except Exception as e:
+            logger.warning(f"⚠️ 生成图像变体失败，返回原图: {e}")
+            return await original_response()
+        await asyncio.to_thread(image_variant_cache.put, filename, variant)
+        logger.info(f"🖼️ 生成图像变体: {filename} ({len(data)} -> {len(variant)} 字节)")
+    
+    return image_response(variant, IMAGE_OUTPUT_MIME_TYPES[image_format], f'"{filename}"', req, headers)
+
 @app.get("/tasks/{task_id}/status")
 async def get_task_status(task_id: str, req: Request) -> TaskStatusResponse:
     """查询任务状态"""
@@ -2606,14 +4839,14 @@ async def list_tasks(req: Request) -> Dict[str, Any]:
                         "progress": task_dict.get("progress")
                     })
             except Exception as e:
-                print(f"❌ 读取任务文件时出错 {filename}: {e}")
+                logger.error(f"❌ 读取任务文件时出错 {filename}: {e}")
         
         return {
             "total_tasks": len(tasks),
             "tasks": sorted(tasks, key=lambda x: x["created_at"], reverse=True)
         }
     except Exception as e:
-        print(f"❌ 列出任务时出错: {e}")
+        logger.error(f"❌ 列出任务时出错: {e}")
         return {"total_tasks": 0, "tasks": []}
 
 @app.delete("/tasks/{task_id}")
@@ -2637,13 +4870,15 @@ def process_customize_task(task_id: str, request_data: Dict[str, Any]) -> Dict[s
     try:
         user_input = request_data.get("user_input")
         conversation_history = request_data.get("conversation_history", [])
-        current_config = request_data.get("current_config")
+        with span("images"):
+            current_config = externalize_images(request_data.get("current_config"))
         has_image_workshop_content = request_data.get("has_image_workshop_content", False)
         workshop_protected_fields = request_data.get("workshop_protected_fields", [])
         preserve_background_images = request_data.get("preserve_background_images", False)
         
         update_task_status(task_id, TaskStatus.PROCESSING, progress=0.2)
         
+        prompt_started = time.perf_counter()
         protected_fields = []
         workshop_protection_info = ""
         
@@ -2667,15 +4902,15 @@ def process_customize_task(task_id: str, request_data: Dict[str, Any]) -> Dict[s
                     'appBackground.parallaxEffect',
                     'appBackground.parallaxIntensity'
                 ])
-                print(f"🛡️ 自动检测到APP背景图像，已加入保护列表")
+                logger.debug(f"🛡️ 自动检测到APP背景图像，已加入保护列表")
             
             # 🔧 保护透明度设置（即使没有背景图）
             if app_background.get('buttonOpacity') is not None:
                 protected_fields.append('appBackground.buttonOpacity')
-                print(f"🛡️ 自动检测到按键透明度设置，已加入保护列表")
+                logger.debug(f"🛡️ 自动检测到按键透明度设置，已加入保护列表")
             if app_background.get('displayOpacity') is not None:
                 protected_fields.append('appBackground.displayOpacity')
-                print(f"🛡️ 自动检测到显示区域透明度设置，已加入保护列表")
+                logger.debug(f"🛡️ 自动检测到显示区域透明度设置，已加入保护列表")
             
             # 🔧 自动检测主题背景并保护
             if theme.get('backgroundImage'):
@@ -2685,7 +4920,7 @@ def process_customize_task(task_id: str, request_data: Dict[str, Any]) -> Dict[s
                     'theme.backgroundGradient',
                     'theme.backgroundPattern'
                 ])
-                print(f"🛡️ 自动检测到主题背景图像，已加入保护列表")
+                logger.debug(f"🛡️ 自动检测到主题背景图像，已加入保护列表")
             
             if theme.get('backgroundPattern'):
                 protected_fields.extend([
@@ -2693,7 +4928,7 @@ def process_customize_task(task_id: str, request_data: Dict[str, Any]) -> Dict[s
                     'theme.patternColor', 
                     'theme.patternOpacity'
                 ])
-                print(f"🛡️ 自动检测到主题背景图案，已加入保护列表")
+                logger.debug(f"🛡️ 自动检测到主题背景图案，已加入保护列表")
             
             # 🔧 自动检测按键背景并保护
             if layout.get('buttons'):
@@ -2706,19 +4941,19 @@ def process_customize_task(task_id: str, request_data: Dict[str, Any]) -> Dict[s
                             f'layout.buttons[{button_id}].opacity',
                             f'layout.buttons[{button_id}].borderRadius'
                         ])
-                        print(f"🛡️ 自动检测到按键背景图像: {button_id}，已加入保护列表")
+                        logger.debug(f"🛡️ 自动检测到按键背景图像: {button_id}，已加入保护列表")
                     if button.get('backgroundPattern'):
                         protected_fields.extend([
                             f'layout.buttons[{button_id}].backgroundPattern',
                             f'layout.buttons[{button_id}].patternColor',
                             f'layout.buttons[{button_id}].patternOpacity'
                         ])
-                        print(f"🛡️ 自动检测到按键背景图案: {button_id}，已加入保护列表")
+                        logger.debug(f"🛡️ 自动检测到按键背景图案: {button_id}，已加入保护列表")
             
             # 🔧 自动检测其他图像相关属性
             if theme.get('backgroundGradient'):
                 protected_fields.append('theme.backgroundGradient')
-                print(f"🛡️ 自动检测到主题背景渐变，已加入保护列表")
+                logger.debug(f"🛡️ 自动检测到主题背景渐变，已加入保护列表")
             
             if protected_fields:
                 workshop_protection_info = f"""
@@ -2828,48 +5063,58 @@ def process_customize_task(task_id: str, request_data: Dict[str, Any]) -> Dict[s
 💡 **继承式修改提醒**：请严格基于上述现有按键分析，在保留所有现有按键的前提下，实现用户的需求。绝对不要删除任何现有按键ID。
 
 请基于用户需求生成或修改计算器配置。"""
+        add_span("prompt", prompt_started)
 
         start_time = time.time()
-        print(f"🚀 开始AI推理 (用户输入: {user_input[:50]}...)")
+        logger.debug(f"🚀 开始AI推理 (用户输入: {user_input[:50]}...)")
 
         update_task_status(task_id, TaskStatus.PROCESSING, progress=0.8)
 
-        response = model.generate_content(full_prompt)
+        with span("gemini"):
+            response = model.generate_content(full_prompt)
         
         if not response or not response.text:
             raise Exception("AI返回空响应")
 
         ai_response_text = response.text.strip()
-        print(f"📝 AI响应文本长度: {len(ai_response_text)} 字符")
+        logger.debug(f"📝 AI响应文本长度: {len(ai_response_text)} 字符")
 
-        json_match = re.search(r'```json\s*\n(.*?)\n\s*```', ai_response_text, re.DOTALL)
-        if not json_match:
-            json_match = re.search(r'\{.*\}', ai_response_text, re.DOTALL)
-        
-        if not json_match:
-            raise Exception("无法从AI响应中提取JSON配置")
+        with span("extract"):
+            json_match = re.search(r'```json\s*\n(.*?)\n\s*```', ai_response_text, re.DOTALL)
+            if not json_match:
+                json_match = re.search(r'\{.*\}', ai_response_text, re.DOTALL)
+            
+            if not json_match:
+                raise Exception("无法从AI响应中提取JSON配置")
 
-        json_str = json_match.group(1) if json_match.groups() else json_match.group(0)
-        
-        try:
-            generated_config = json.loads(json_str)
-        except json.JSONDecodeError as e:
-            print(f"❌ JSON解析失败: {e}")
-            raise Exception(f"JSON格式错误: {e}")
+            json_str = json_match.group(1) if json_match.groups() else json_match.group(0)
+            
+            try:
+                generated_config = json.loads(json_str)
+            except json.JSONDecodeError as e:
+                logger.error(f"❌ JSON解析失败: {e}")
+                raise Exception(f"JSON格式错误: {e}")
 
         update_task_status(task_id, TaskStatus.PROCESSING, progress=0.9)
 
         if protected_fields:
-            generated_config = remove_protected_fields_from_ai_output(generated_config, protected_fields)
+            with span("merge"):
+                generated_config = remove_protected_fields_from_ai_output(generated_config, ProtectionPolicy(protected_fields))
 
-        generated_config = clean_gradient_format(generated_config)
+        with span("clean_gradient"):
+            generated_config = clean_gradient_format(generated_config)
         
-        # 🛡️ 获取现有按键ID列表以进行保护
-        existing_button_ids = []
-        if current_config and current_config.get('layout', {}).get('buttons'):
-            existing_button_ids = [btn.get('id', '') for btn in current_config['layout']['buttons']]
+        # 📇 当前配置的按键索引只构建一次，按键保护和背景合并共用
+        with span("merge"):
+            current_index = ConfigIndex.from_config(current_config)
         
-        generated_config = clean_invalid_buttons(generated_config, existing_button_ids)
+        # 🛡️ 现有按键ID以进行保护
+        with span("clean_buttons"):
+            generated_config = clean_invalid_buttons(generated_config, list(current_index.by_id))
+
+        # 🔬 对表达式按键做冒烟测试，生成逐按键健康报告
+        with span("verify"):
+            button_health = verify_expression_buttons(generated_config)
 
         # 🚀 优化：去掉二次核验环节以提升生成速度
         # try:
@@ -2877,12 +5122,16 @@ def process_customize_task(task_id: str, request_data: Dict[str, Any]) -> Dict[s
         #         import asyncio
         #         generated_config = asyncio.run(fix_calculator_config(user_input, current_config, generated_config))
         # except Exception as fix_error:
-        #     print(f"⚠️ AI修复失败，使用原始生成结果: {fix_error}")
-        print("🚀 已跳过二次核验环节，直接使用AI生成结果以提升速度")
+        #     logger.warning(f"⚠️ AI修复失败，使用原始生成结果: {fix_error}")
+        logger.debug("🚀 已跳过二次核验环节，直接使用AI生成结果以提升速度")
 
         # 🔧 强制合并现有配置中的背景图像数据，确保不被AI覆盖
         if current_config:
-            generated_config = merge_background_data(current_config, generated_config, protected_fields)
+            logger.debug(f"🔧 开始强制合并背景数据，保护字段: {len(protected_fields)}")
+            with span("merge"):
+                generated_config = merge_config(current_config, generated_config, MERGE_PROFILES["background"],
+                                                current_index=current_index)
+            logger.debug(f"✅ 背景数据强制合并完成")
 
         if not generated_config.get('layout', {}).get('buttons'):
             raise Exception("生成的配置缺少按键布局")
@@ -2893,563 +5142,155 @@ def process_customize_task(task_id: str, request_data: Dict[str, Any]) -> Dict[s
         generated_config['aiResponse'] = ai_response_text
 
         duration = time.time() - start_time
-        print(f"✅ AI定制完成，耗时: {duration:.2f}秒")
+        logger.info(f"✅ AI定制完成，耗时: {duration:.2f}秒")
+
+        if not request_data.get("use_image_refs", False):
+            with span("images"):
+                generated_config = expand_image_refs(generated_config)
 
         return {
             "success": True,
             "config": generated_config,
             "processing_time": duration,
-            "protected_fields": protected_fields
+            "protected_fields": protected_fields,
+            "button_health": button_health
         }
 
     except Exception as e:
-        print(f"❌ 计算器定制任务失败: {str(e)}")
+        logger.error(f"❌ 计算器定制任务失败: {str(e)}")
         raise e
 
 def process_generate_image_task(task_id: str, request_data: Dict[str, Any]) -> Dict[str, Any]:
     """处理图像生成任务"""
     try:
-        prompt = request_data.get("prompt")
-        style = request_data.get("style", "realistic")
-        size = request_data.get("size", "1024x1024")
-        quality = request_data.get("quality", "standard")
-        
-        update_task_status(task_id, TaskStatus.PROCESSING, progress=0.2)
-        
-        # 构建优化的图像生成提示词
-        enhanced_prompt = f"""
-        Generate a high-quality image for calculator theme:
-        {prompt}
-        
-        Style: {style}
-        Requirements:
-        - High resolution and professional quality
-        - Suitable for calculator app background or button design
-        - Clean, modern aesthetic
-        - Good contrast for readability
-        """
-        
-        print(f"🎨 开始生成图像，提示词: {enhanced_prompt}")
-        
-        update_task_status(task_id, TaskStatus.PROCESSING, progress=0.4)
-        
-        # 初始化AI模型
-        initialize_genai()
-        
-        # 使用Gemini 2.0 Flash图像生成模型
-        image_model = genai.GenerativeModel("gemini-2.0-flash-preview-image-generation")
-        
-        # 生成图像 - 使用正确的配置
-        generation_config = {
-            "response_modalities": ["TEXT", "IMAGE"]
-        }
-        
-        update_task_status(task_id, TaskStatus.PROCESSING, progress=0.6)
-        
-        response = image_model.generate_content(
-            contents=[enhanced_prompt],
-            generation_config=generation_config
-        )
-        
-        update_task_status(task_id, TaskStatus.PROCESSING, progress=0.8)
-        
-        # 检查响应中是否包含图像
-        if hasattr(response, 'parts') and response.parts:
-            for part in response.parts:
-                if hasattr(part, 'inline_data') and part.inline_data:
-                    # 获取生成的图像数据
-                    image_data = part.inline_data.data
-                    mime_type = part.inline_data.mime_type
-                    
-                    # 检查数据是否已经是base64格式
-                    if isinstance(image_data, bytes):
-                        # 如果是bytes，需要转换为base64
-                        import base64
-                        image_base64_data = base64.b64encode(image_data).decode('utf-8')
-                    else:
-                        # 如果已经是字符串，直接使用
-                        image_base64_data = str(image_data)
-                    
-                    # 将图像数据转换为base64 URL
-                    image_base64 = f"data:{mime_type};base64,{image_base64_data}"
-                    
-                    print(f"✅ 图像生成成功，MIME类型: {mime_type}")
-                    
-                    return {
-                        "success": True,
-                        "image_url": image_base64,
-                        "image_data": image_base64_data,
-                        "mime_type": mime_type,
-                        "original_prompt": prompt,
-                        "enhanced_prompt": enhanced_prompt,
-                        "style": style,
-                        "size": size,
-                        "quality": quality,
-                        "message": "图像生成成功"
-                    }
-        
-        # 如果没有图像数据，检查文本响应
-        if response.text:
-            print(f"🤖 AI响应: {response.text}")
-            
-        # 如果没有生成图像，返回错误
-        raise Exception("未能生成图像，请检查提示词或稍后重试")
-        
+        return run_image_pipeline("image", request_data, image_task_progress(task_id))
     except Exception as e:
-        print(f"❌ 图像生成任务失败: {str(e)}")
+        logger.error(f"❌ 图像生成任务失败: {str(e)}")
         raise e
 
 def process_generate_pattern_task(task_id: str, request_data: Dict[str, Any]) -> Dict[str, Any]:
     """处理按键背景图生成任务"""
     try:
+        return run_image_pipeline("pattern", request_data, image_task_progress(task_id))
+    except Exception as e:
+        logger.error(f"❌ 按键背景图生成任务失败: {str(e)}")
+        raise e
+
+def generate_keypad_pattern(prompt: str, style: str, size: str, label: str) -> dict:
+    """生成单个按键的背景图，存入图像库并返回引用"""
+    concept = f'{prompt} (for the "{label}" key)' if label else prompt
+    generated_image = generate_image_content(build_pattern_prompt(concept, style))
+    if not generated_image:
+        raise Exception("未能生成图案")
+    image_bytes, mime_type = generated_image
+    return image_payload(image_bytes, mime_type, "pattern_url", return_image_id=True, size=size)
+
+def process_generate_keypad_patterns_task(task_id: str, request_data: Dict[str, Any]) -> Dict[str, Any]:
+    """处理整套按键背景图生成任务：并发生成，每完成一个按键更新一次进度和部分清单"""
+    try:
+        start_time = time.time()
         prompt = request_data.get("prompt")
         style = request_data.get("style", "minimal")
-        size = request_data.get("size", "48x48")
-        
-        update_task_status(task_id, TaskStatus.PROCESSING, progress=0.2)
-        
-        # 🔧 优化按键背景图案生成 - 单一大主体，避免重复元素，确保明亮效果
-        pattern_prompt = f"""
-        Create a clean background pattern for calculator buttons based on this concept:
-        {prompt}
-        
-        Requirements:
-        - {style} style with ONE single large main subject/element (not repeated patterns)
-        - If it's an animal/character, show only ONE instance filling most of the space
-        - If it's geometric, use ONE large shape or form, not repeated small elements
-        - Clear, simple design without text or numbers
-        - Bright, vibrant, and colorful design with vivid and cheerful colors
-        - Use light backgrounds or colorful themes (avoid dark/black backgrounds)
-        - Well-lit appearance with high brightness and saturation
-        - Optimized for small button size (128x128 pixels)
-        - Focus on a single dominant visual element, not repetitive patterns
-        - High contrast and readability-friendly with excellent visibility
-        """
+        size = request_data.get("size", "128x128")
+        labels, button_ids = keypad_pattern_targets(request_data)
         
-        print(f"🎨 开始生成图案，提示词: {pattern_prompt}")
+        if not button_ids:
+            raise Exception("没有需要生成背景图的按键")
         
-        update_task_status(task_id, TaskStatus.PROCESSING, progress=0.4)
+        logger.info(f"🎨 开始批量生成按键背景图: {len(button_ids)} 个按键，并发上限 {IMAGE_GENERATION_CONCURRENCY}")
+        update_task_status(task_id, TaskStatus.PROCESSING, progress=0.1)
         
-        # 初始化AI模型
-        initialize_genai()
+        manifest = {}
+        failed = {}
+        with ThreadPoolExecutor(max_workers=min(len(button_ids), IMAGE_GENERATION_CONCURRENCY)) as pool:
+            futures = {
+                pool.submit(contextvars.copy_context().run, generate_keypad_pattern, prompt, style, size, labels.get(button_id, "")): button_id
+                for button_id in button_ids
+            }
+            for completed, future in enumerate(as_completed(futures), 1):
+                button_id = futures[future]
+                try:
+                    manifest[button_id] = future.result()
+                    logger.debug(f"✅ 按键背景图完成 ({completed}/{len(button_ids)}): {button_id}")
+                except Exception as e:
+                    failed[button_id] = str(e)
+                    logger.error(f"❌ 按键背景图失败 ({completed}/{len(button_ids)}): {button_id} - {e}")
+                # 处理中的任务结果即为部分清单，客户端轮询时可以先应用已完成的按键
+                update_task_status(
+                    task_id, TaskStatus.PROCESSING,
+                    result={"manifest": dict(manifest), "failed": dict(failed), "completed": completed, "total": len(button_ids)},
+                    progress=0.1 + 0.85 * completed / len(button_ids)
+                )
+        
+        if not manifest:
+            raise Exception(f"所有按键背景图生成失败: {failed}")
         
-        # 使用Gemini 2.0 Flash图像生成模型
-        image_model = genai.GenerativeModel("gemini-2.0-flash-preview-image-generation")
+        duration = time.time() - start_time
+        logger.info(f"✅ 批量按键背景图完成: {len(manifest)}/{len(button_ids)}，耗时: {duration:.2f}秒")
         
-        # 生成图案 - 使用正确的配置
-        generation_config = {
-            "response_modalities": ["TEXT", "IMAGE"]
+        return {
+            "success": True,
+            "manifest": manifest,
+            "failed": failed,
+            "completed": len(button_ids),
+            "total": len(button_ids),
+            "original_prompt": prompt,
+            "style": style,
+            "size": size,
+            "processing_time": duration,
+            "message": f"已生成 {len(manifest)}/{len(button_ids)} 个按键背景图"
         }
         
-        update_task_status(task_id, TaskStatus.PROCESSING, progress=0.6)
-        
-        response = image_model.generate_content(
-            contents=[pattern_prompt],
-            generation_config=generation_config
-        )
-        
-        update_task_status(task_id, TaskStatus.PROCESSING, progress=0.8)
-        
-        # 检查响应中是否包含图像
-        if hasattr(response, 'parts') and response.parts:
-            for part in response.parts:
-                if hasattr(part, 'inline_data') and part.inline_data:
-                    # 获取生成的图像数据
-                    image_data = part.inline_data.data
-                    mime_type = part.inline_data.mime_type
-                    
-                    # 检查数据是否已经是base64格式
-                    if isinstance(image_data, bytes):
-                        # 如果是bytes，需要转换为base64
-                        import base64
-                        pattern_base64_data = base64.b64encode(image_data).decode('utf-8')
-                    else:
-                        # 如果已经是字符串，直接使用
-                        pattern_base64_data = str(image_data)
-                    
-                    # 将图像数据转换为base64 URL
-                    pattern_base64 = f"data:{mime_type};base64,{pattern_base64_data}"
-                    
-                    print(f"✅ 图案生成成功，MIME类型: {mime_type}")
-                    
-                    return {
-                        "success": True,
-                        "pattern_url": pattern_base64,
-                        "image_data": pattern_base64_data,
-                        "mime_type": mime_type,
-                        "original_prompt": prompt,
-                        "enhanced_prompt": pattern_prompt,
-                        "style": style,
-                        "is_seamless": True,
-                        "message": "图案生成成功"
-                    }
-        
-        # 如果没有图像数据，检查文本响应
-        if response.text:
-            print(f"🤖 AI响应: {response.text}")
-            
-        # 如果没有生成图案，返回错误
-        raise Exception("未能生成图案，请检查提示词或稍后重试")
-        
     except Exception as e:
-        print(f"❌ 按键背景图生成任务失败: {str(e)}")
+        logger.error(f"❌ 批量按键背景图生成任务失败: {str(e)}")
         raise e
 
 def process_generate_app_background_task(task_id: str, request_data: Dict[str, Any]) -> Dict[str, Any]:
     """处理APP背景图生成任务"""
     try:
-        prompt = request_data.get("prompt")
-        style = request_data.get("style", "modern")
-        size = request_data.get("size", "1080x1920")
-        quality = request_data.get("quality", "high")
-        theme = request_data.get("theme", "calculator")
-        
-        update_task_status(task_id, TaskStatus.PROCESSING, progress=0.2)
-        
-        # 构建专门的APP背景图生成提示词 - 确保明亮效果
-        background_prompt = f"""
-        Generate a beautiful background image for a calculator mobile app:
-        {prompt}
-        
-        Requirements:
-        - Mobile app background (portrait orientation {size})
-        - Style: {style} with {theme} theme
-        - Subtle and elegant, won't interfere with UI elements
-        - Good contrast for calculator buttons and display
-        - Professional and modern aesthetic with bright, vibrant colors
-        - High quality and resolution with excellent brightness and saturation
-        - Use light backgrounds or colorful themes (avoid dark/black backgrounds)
-        - Well-lit appearance with vivid and cheerful colors
-        - Colors should complement calculator interface while maintaining high visibility
-        - Avoid too busy patterns that distract from functionality
-        
-        Theme context: {theme}
-        Quality: {quality}
-        """
-        
-        print(f"🎨 开始生成APP背景图，提示词: {background_prompt}")
-        
-        update_task_status(task_id, TaskStatus.PROCESSING, progress=0.4)
-        
-        # 初始化AI模型
-        initialize_genai()
-        
-        # 使用Gemini 2.0 Flash图像生成模型
-        image_model = genai.GenerativeModel("gemini-2.0-flash-preview-image-generation")
-        
-        # 生成背景图 - 使用正确的配置
-        generation_config = {
-            "response_modalities": ["TEXT", "IMAGE"]
-        }
-        
-        update_task_status(task_id, TaskStatus.PROCESSING, progress=0.6)
-        
-        response = image_model.generate_content(
-            contents=[background_prompt],
-            generation_config=generation_config
-        )
-        
-        update_task_status(task_id, TaskStatus.PROCESSING, progress=0.8)
-        
-        # 检查响应中是否包含图像
-        if hasattr(response, 'parts') and response.parts:
-            for part in response.parts:
-                if hasattr(part, 'inline_data') and part.inline_data:
-                    # 获取生成的图像数据
-                    image_data = part.inline_data.data
-                    mime_type = part.inline_data.mime_type
-                    
-                    # 检查数据是否已经是base64格式
-                    if isinstance(image_data, bytes):
-                        # 如果是bytes，需要转换为base64
-                        import base64
-                        background_base64_data = base64.b64encode(image_data).decode('utf-8')
-                    else:
-                        # 如果已经是字符串，直接使用
-                        background_base64_data = str(image_data)
-                    
-                    # 将图像数据转换为base64 URL
-                    background_base64 = f"data:{mime_type};base64,{background_base64_data}"
-                    
-                    print(f"✅ APP背景图生成成功，MIME类型: {mime_type}")
-                    
-                    return {
-                        "success": True,
-                        "background_url": background_base64,
-                        "image_data": background_base64_data,
-                        "mime_type": mime_type,
-                        "original_prompt": prompt,
-                        "enhanced_prompt": background_prompt,
-                        "style": style,
-                        "theme": theme,
-                        "size": size,
-                        "quality": quality,
-                        "message": "APP背景图生成成功",
-                        "usage_tips": "此背景图已优化用于计算器应用，确保UI元素的可读性"
-                    }
-        
-        # 如果没有图像数据，检查文本响应
-        if response.text:
-            print(f"🤖 AI响应: {response.text}")
-            
-        # 如果没有生成背景图，返回错误
-        raise Exception("未能生成APP背景图，请检查提示词或稍后重试")
-        
+        return run_image_pipeline("app_background", request_data, image_task_progress(task_id))
     except Exception as e:
-        print(f"❌ APP背景图生成任务失败: {str(e)}")
+        logger.error(f"❌ APP背景图生成任务失败: {str(e)}")
         raise e
 
 def process_generate_text_image_task(task_id: str, request_data: Dict[str, Any]) -> Dict[str, Any]:
     """处理文字图像生成任务"""
     try:
-        prompt = request_data.get("prompt")
-        text = request_data.get("text")
-        style = request_data.get("style", "modern")
-        size = request_data.get("size", "512x512")
-        background = request_data.get("background", "transparent")
-        effects = request_data.get("effects", [])
-        
-        update_task_status(task_id, TaskStatus.PROCESSING, progress=0.2)
-        
-        print(f"🎨 正在生成创意字符图片...")
-        print(f"字符内容: {text}")
-        print(f"原始创意描述: {prompt}")
-        print(f"风格: {style}")
-        
-        # 🧹 清理用户输入，去除描述性文字，只保留创意核心
-        def clean_user_prompt(prompt: str) -> str:
-            """清理用户输入的提示词，去除描述性文字，只保留创意核心"""
-            if not prompt:
-                return ""
-            
-            # 需要过滤的描述性词汇和短语
-            descriptive_phrases = [
-                "生成", "图片", "效果", "光影", "文字", "数字", "字符", "符号",
-                "为", "的", "进行", "制作", "创建", "设计", "绘制",
-                "生成光影效果", "光影效果图片", "效果图片", "文字图片", 
-                "数字图片", "字符图片", "背景图", "按键", "按钮",
-                "白底", "透明", "背景", "底色", "不能有其他字出现",
-                "生成光影效果的图片", "为文字.*?生成.*?图片", "光影文字", "特效"
-            ]
-            
-            cleaned = prompt.strip()
-            
-            # 移除描述性短语
-            import re
-            for phrase in descriptive_phrases:
-                # 使用正则表达式匹配包含这些短语的部分
-                pattern = f"[，。、]*{re.escape(phrase)}[^，。]*"
-                cleaned = re.sub(pattern, "", cleaned, flags=re.IGNORECASE)
-                
-                # 移除完整短语
-                cleaned = cleaned.replace(phrase, "")
-            
-            # 清理多余的标点符号和空格
-            cleaned = re.sub(r'[，。、；：！？\s]+', ' ', cleaned)
-            cleaned = re.sub(r'^[，。、；：！？\s]+|[，。、；：！？\s]+$', '', cleaned)
-            cleaned = re.sub(r'\s+', ' ', cleaned).strip()
-            
-            return cleaned
-        
-        # 清理用户输入
-        cleaned_prompt = clean_user_prompt(prompt) if prompt else ""
-        print(f"清理后创意描述: {cleaned_prompt}")
+        logger.debug(f"🎨 正在生成创意字符图片...")
+        logger.debug(f"字符内容: {request_data.get('text')}")
+        logger.debug(f"原始创意描述: {request_data.get('prompt')}")
+        logger.debug(f"风格: {request_data.get('style')}")
         
-        update_task_status(task_id, TaskStatus.PROCESSING, progress=0.4)
-        
-        # 🎨 构建创意字符生成提示词，用指定元素构造字符形状
-        # 根据风格选择不同的视觉风格描述
-        style_effects = {
-            "modern": "in sleek modern style",
-            "neon": "in vibrant neon style with bright colors",
-            "gold": "in luxurious golden metallic style", 
-            "silver": "in polished silver metallic style",
-            "fire": "in fiery red/orange style",
-            "ice": "in crystal clear ice style",
-            "galaxy": "in cosmic space style with stars",
-            "glass": "in transparent glass crystal style"
-        }
-        
-        # 获取对应风格的效果描述，默认为现代风格
-        style_effect = style_effects.get(style, style_effects["modern"])
-        
-        # 🎨 创意字符构造：极简提示词，避免AI误解指令为显示内容
-        if cleaned_prompt and cleaned_prompt.strip():
-            # 极简直接指令，避免任何可能被误解的英文描述
-            detailed_prompt = f"""Show number "{text}" made from {cleaned_prompt}. Pure visual art only. No text anywhere. Clean {background} background."""
-        else:
-            # 标准设计，同样极简
-            detailed_prompt = f"""Show number "{text}" {style_effect}. Pure visual art only. No text anywhere. Clean {background} background."""
+        return run_image_pipeline("text_image", request_data, image_task_progress(task_id))
+    except Exception as e:
+        logger.error(f"❌ 文字图像生成任务失败: {str(e)}")
+        raise e
 
-        print(f"🚀 使用提示词: {detailed_prompt}")
-        
-        update_task_status(task_id, TaskStatus.PROCESSING, progress=0.6)
-        
-        # 初始化AI模型
-        initialize_genai()
-        
-        # 使用图像生成专用模型
-        image_model = genai.GenerativeModel("gemini-2.0-flash-preview-image-generation")
-        
-        # 生成配置
-        generation_config = {
-            "response_modalities": ["TEXT", "IMAGE"]
-        }
-        
-        # 生成图像
-        response = image_model.generate_content(
-            contents=[detailed_prompt],
-            generation_config=generation_config
-        )
-        
-        update_task_status(task_id, TaskStatus.PROCESSING, progress=0.8)
-        
-        # 检查响应中是否包含图像
-        if hasattr(response, 'parts') and response.parts:
-            for part in response.parts:
-                if hasattr(part, 'inline_data') and part.inline_data:
-                    # 获取生成的图像数据
-                    image_data = part.inline_data.data
-                    mime_type = part.inline_data.mime_type
-                    
-                    # 检查数据是否已经是base64格式
-                    if isinstance(image_data, bytes):
-                        # 如果是bytes，需要转换为base64
-                        import base64
-                        text_image_base64_data = base64.b64encode(image_data).decode('utf-8')
-                    else:
-                        # 如果已经是字符串，直接使用
-                        text_image_base64_data = str(image_data)
-                    
-                    # 将图像数据转换为base64 URL
-                    text_image_base64 = f"data:{mime_type};base64,{text_image_base64_data}"
-                    
-                    print(f"✅ 创意字符图片生成成功: '{text}'，MIME类型: {mime_type}")
-                    
-                    return {
-                        "success": True,
-                        "image_url": text_image_base64,
-                        "text": text,
-                        "style": style,
-                        "size": size,
-                        "background": background,
-                        "effects": effects,
-                        "mime_type": mime_type,
-                        "original_prompt": prompt,
-                        "cleaned_prompt": cleaned_prompt,
-                        "enhanced_prompt": detailed_prompt,
-                        "message": f"创意字符 '{text}' 生成成功"
-                    }
-        
-        # 检查是否有文本响应
-        if hasattr(response, 'text') and response.text:
-            print(f"🤖 AI响应: {response.text}")
-            
-        # 如果没有生成图像，返回错误
-        raise Exception("未找到生成的图像数据")
+def process_generate_glyph_set_task(task_id: str, request_data: Dict[str, Any]) -> Dict[str, Any]:
+    """处理字形集生成任务：每完成一个字形更新一次进度和部分清单"""
+    try:
+        def on_progress(completed, total, manifest, failed):
+            update_task_status(
+                task_id, TaskStatus.PROCESSING,
+                result={"manifest": dict(manifest), "failed": dict(failed), "completed": completed, "total": total},
+                progress=0.1 + 0.85 * completed / total
+            )
+        
+        result = generate_glyph_set(request_data, on_progress)
+        if not result["success"]:
+            raise Exception(f"所有字形生成失败: {result['failed']}")
+        return result
         
     except Exception as e:
-        print(f"❌ 文字图像生成任务失败: {str(e)}")
+        logger.error(f"❌ 字形集生成任务失败: {str(e)}")
         raise e
 
 def process_generate_display_background_task(task_id: str, request_data: Dict[str, Any]) -> Dict[str, Any]:
     """处理显示区背景生成任务"""
     try:
-        prompt = request_data.get("prompt")
-        style = request_data.get("style", "clean")
-        size = request_data.get("size", "800x400")
-        quality = request_data.get("quality", "high")
-        theme = request_data.get("theme", "calculator")
-        
-        update_task_status(task_id, TaskStatus.PROCESSING, progress=0.2)
-        
-        # 构建专门的显示区背景生成提示词
-        display_prompt = f"""
-        Generate a beautiful background image for calculator display area:
-        {prompt}
-        
-        Requirements:
-        - Calculator display area background (landscape orientation {size})
-        - Style: {style} with {theme} theme
-        - Must ensure excellent readability for white text and numbers
-        - Subtle and elegant, won't interfere with calculation results
-        - Good contrast for digital display content
-        - Professional and clean aesthetic
-        - High quality and resolution
-        - Colors should be darker or muted to highlight white text
-        - Avoid bright colors that reduce text readability
-        - Perfect for digital calculator display background
-        """
-        
-        print(f"🎨 开始生成显示区背景，提示词: {display_prompt}")
-        
-        update_task_status(task_id, TaskStatus.PROCESSING, progress=0.4)
-        
-        # 初始化AI模型
-        initialize_genai()
-        
-        # 使用Gemini 2.0 Flash图像生成模型
-        image_model = genai.GenerativeModel("gemini-2.0-flash-preview-image-generation")
-        
-        # 生成显示区背景 - 使用正确的配置
-        generation_config = {
-            "response_modalities": ["TEXT", "IMAGE"]
-        }
-        
-        update_task_status(task_id, TaskStatus.PROCESSING, progress=0.6)
-        
-        response = image_model.generate_content(
-            contents=[display_prompt],
-            generation_config=generation_config
-        )
-        
-        update_task_status(task_id, TaskStatus.PROCESSING, progress=0.8)
-        
-        # 检查响应中是否包含图像
-        if hasattr(response, 'parts') and response.parts:
-            for part in response.parts:
-                if hasattr(part, 'inline_data') and part.inline_data:
-                    # 获取生成的图像数据
-                    image_data = part.inline_data.data
-                    mime_type = part.inline_data.mime_type
-                    
-                    # 检查数据是否已经是base64格式
-                    if isinstance(image_data, bytes):
-                        # 如果是bytes，需要转换为base64
-                        import base64
-                        display_base64_data = base64.b64encode(image_data).decode('utf-8')
-                    else:
-                        # 如果已经是字符串，直接使用
-                        display_base64_data = str(image_data)
-                    
-                    # 将图像数据转换为base64 URL
-                    display_base64 = f"data:{mime_type};base64,{display_base64_data}"
-                    
-                    print(f"✅ 显示区背景生成成功，MIME类型: {mime_type}")
-                    
-                    return {
-                        "success": True,
-                        "display_background_url": display_base64,
-                        "image_data": display_base64_data,
-                        "mime_type": mime_type,
-                        "original_prompt": prompt,
-                        "enhanced_prompt": display_prompt,
-                        "style": style,
-                        "size": size,
-                        "quality": quality,
-                        "theme": theme,
-                        "message": "显示区背景生成成功"
-                    }
-        
-        # 如果没有图像数据，检查文本响应
-        if response.text:
-            print(f"🤖 AI响应: {response.text}")
-            
-        # 如果没有生成图像，返回错误
-        raise Exception("未能生成显示区背景，请检查提示词或稍后重试")
-        
+        return run_image_pipeline("display_background", request_data, image_task_progress(task_id))
     except Exception as e:
-        print(f"❌ 显示区背景生成任务失败: {str(e)}")
+        logger.error(f"❌ 显示区背景生成任务失败: {str(e)}")
         raise e
 
 # 可用模型配置
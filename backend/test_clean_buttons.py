@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""clean_invalid_buttons 布局回归检查（离线，不调用AI）：python test_clean_buttons.py 或 pytest"""
+
+import main
+
+
+def full_layout(rows: int, columns: int) -> list:
+    """rows×columns 铺满的现有按键，第一个按键为多参数函数"""
+    buttons = []
+    for row in range(1, rows + 1):
+        for column in range(columns):
+            buttons.append({
+                "id": f"btn_{row}_{column}",
+                "label": f"{row}{column}",
+                "action": {"type": "input", "value": str(column)},
+                "gridPosition": {"row": row, "column": column},
+                "type": "primary",
+            })
+    buttons[0]["action"] = {"type": "multiParamFunction", "value": "pow"}
+    return buttons
+
+
+def test_conflict_in_full_layout_adds_row_instead_of_widening():
+    existing = full_layout(5, 4)
+    new_button = {
+        "id": "btn_sin",
+        "label": "sin",
+        "action": {"type": "expression", "expression": "sin(x)"},
+        "gridPosition": {"row": 2, "column": 1},
+        "type": "secondary",
+    }
+    config = {"layout": {"rows": 5, "columns": 4, "buttons": existing + [new_button]}}
+
+    layout = main.clean_invalid_buttons(config, [button["id"] for button in existing])["layout"]
+    positions = {button["id"]: button["gridPosition"] for button in layout["buttons"]}
+
+    assert layout["columns"] == 4
+    assert layout["rows"] == 6
+    assert positions["btn_sin"] == {"row": 6, "column": 0}
+    assert positions["btn_comma_auto"] == {"row": 6, "column": 1}
+    assert positions["btn_execute_auto"] == {"row": 6, "column": 2}
+    assert all(position["column"] < 4 for position in positions.values())
+
+
+def test_non_int_grid_values_are_coerced():
+    existing = full_layout(2, 4)
+    wide = {
+        "id": "btn_wide",
+        "label": "=",
+        "action": {"type": "equals"},
+        "gridPosition": {"row": "3", "column": 0.0, "columnSpan": 2.0},
+        "type": "operator",
+    }
+    broken = {**existing[1], "gridPosition": "row 1"}
+    config = {"layout": {"rows": 2, "columns": 4, "buttons": [existing[0], broken, *existing[2:], wide]}}
+
+    layout = main.clean_invalid_buttons(config, [button["id"] for button in existing])["layout"]
+    positions = {button["id"]: button["gridPosition"] for button in layout["buttons"]}
+
+    assert positions["btn_wide"] == {"row": 3, "column": 0, "columnSpan": 2}
+    assert isinstance(positions["btn_1_1"], dict)
+    assert layout["rows"] == 3
+
+
+def test_malformed_current_grid_position_in_background_merge():
+    current = {"layout": {"buttons": [
+        {"id": "btn_1", "label": "1", "backgroundImage": "img:abc", "gridPosition": "1,0"},
+        {"id": "btn_2", "label": "2", "gridPosition": {"row": None, "column": "x", "columnSpan": float("inf")}},
+        "not a button",
+    ]}}
+    generated = {"layout": {"buttons": [{"id": "btn_1", "label": "1"}]}}
+
+    index = main.ConfigIndex.from_config(current)
+    assert set(index.by_id) == {"btn_1", "btn_2"}
+    merged = main.merge_config(current, generated, main.MERGE_PROFILES["background"], None, current_index=index)
+    assert merged["layout"]["buttons"][0]["id"] == "btn_1"
+
+
+if __name__ == "__main__":
+    test_conflict_in_full_layout_adds_row_instead_of_widening()
+    test_non_int_grid_values_are_coerced()
+    test_malformed_current_grid_position_in_background_merge()
+    print("✅ 布局回归检查通过")
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""精灵图集装箱回归检查（离线，不调用AI）：python test_sprite_atlas.py 或 pytest"""
+
+from io import BytesIO
+
+from PIL import Image
+
+import main
+
+
+def solid_images(count: int, size: int) -> list:
+    """count 张 size×size 纯色PNG，返回 [(hash, bytes)]"""
+    images = []
+    for index in range(count):
+        output = BytesIO()
+        Image.new("RGB", (size, size), (index % 256, 64, 128)).save(output, format="PNG")
+        images.append((f"sprite{index:03d}", output.getvalue()))
+    return images
+
+
+def assert_packed(images: list, max_sprite_size: int, padding: int = 2):
+    data, frames, (width, height) = main.pack_sprite_atlas(images, max_sprite_size, padding, "png", 80)
+    assert width <= main.SPRITE_ATLAS_MAX_SIZE and height <= main.SPRITE_ATLAS_MAX_SIZE
+    assert set(frames) == {image_hash for image_hash, _ in images}
+    for x, y, w, h in frames.values():
+        assert x + w <= width and y + h <= height
+    with Image.open(BytesIO(data)) as atlas:
+        assert atlas.size == (width, height)
+    return frames
+
+
+def test_large_sprites_shrink_to_fit_atlas():
+    # 20 张 1024 的按键图原样放不进 4096，按数量缩小而不是报“没有按键图”
+    frames = assert_packed(solid_images(20, 1024), 1024)
+    assert all(w == h == main.SPRITE_ATLAS_MAX_SIZE // 5 - 2 for _, _, w, h in frames.values())
+
+
+def test_full_grid_always_packs():
+    # 12×10 满布局、max_sprite_size 取模型上限
+    count = main.GRID_MAX_ROWS * main.GRID_MAX_COLUMNS
+    frames = assert_packed(solid_images(count, 400), 1024)
+    assert all(max(w, h) <= 370 for _, _, w, h in frames.values())
+
+
+def test_too_many_sprites_raise_distinct_error():
+    original = main.SPRITE_ATLAS_MAX_SIZE
+    main.SPRITE_ATLAS_MAX_SIZE = 64
+    try:
+        main.pack_sprite_atlas(solid_images(100, 16), 256, 2, "png", 80)
+    except main.SpriteAtlasTooLargeError:
+        pass
+    else:
+        raise AssertionError("应抛出 SpriteAtlasTooLargeError")
+    finally:
+        main.SPRITE_ATLAS_MAX_SIZE = original
+
+
+if __name__ == "__main__":
+    test_large_sprites_shrink_to_fit_atlas()
+    test_full_grid_always_packs()
+    test_too_many_sprites_raise_distinct_error()
+    print("✅ 精灵图集检查通过")